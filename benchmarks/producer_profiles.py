@@ -0,0 +1,82 @@
+"""
+Compare Kafka producer profiles (see fvhiot.utils.kafkatools.PRODUCER_PROFILES).
+
+Needs a running Kafka cluster, connection is configured with the usual KAFKA_* envs:
+
+    KAFKA_BOOTSTRAP_SERVERS=localhost:9092 python benchmarks/producer_profiles.py --topic benchmark
+
+For every profile, prints throughput (messages/s), mean and 99th percentile latency
+from send() to broker acknowledgement, and producer's own batching metrics.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import time
+
+from fvhiot.utils.data import data_pack
+from fvhiot.utils.kafka import get_kafka_producer_by_envs
+from fvhiot.utils.kafkatools import PRODUCER_PROFILES
+
+
+def sample_message(i: int) -> bytes:
+    """Thingpark uplink sized raw data message"""
+    body = {
+        "DevEUI_uplink": {
+            "Time": "2022-02-10T06:59:28.171+00:00",
+            "DevEUI": f"70B3D57050{i % 5000:06X}",
+            "FPort": 1,
+            "FCntUp": i,
+            "payload_hex": f"0218d7000309d5000f0a{i % 256:02x}",
+            "LrrRSSI": -96.0,
+            "LrrSNR": 13.0,
+        }
+    }
+    return data_pack({"path": "/thingpark", "request": {"body": json.dumps(body).encode()}})
+
+
+def run(profile: str, topic: str, messages: int, rate: float) -> dict:
+    producer = get_kafka_producer_by_envs(profile)
+    latencies = []
+
+    def on_success(sent_at, _metadata):
+        latencies.append(time.monotonic() - sent_at)
+
+    payloads = [sample_message(i) for i in range(messages)]
+    start = time.monotonic()
+    for i, payload in enumerate(payloads):
+        if rate:  # Simulate webhook traffic instead of a backfill
+            delay = start + i / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        producer.send(topic, payload).add_callback(on_success, time.monotonic())
+    producer.flush()
+    elapsed = time.monotonic() - start
+    metrics = producer.metrics()["producer-metrics"]
+    producer.close()
+    latencies.sort()
+    return {
+        "profile": profile,
+        "msg/s": round(messages / elapsed),
+        "latency ms": round(1000 * statistics.mean(latencies), 1),
+        "p99 ms": round(1000 * latencies[int(len(latencies) * 0.99) - 1], 1),
+        "batch bytes": round(metrics.get("batch-size-avg", 0)),
+        "requests": round(metrics.get("request-total", 0)),
+        "compression": round(metrics.get("compression-rate-avg", 0), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--topic", default=os.getenv("KAFKA_BENCHMARK_TOPIC", "benchmark"))
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--rate", type=float, default=0, help="Messages per second, 0 sends as fast as possible")
+    parser.add_argument("--profiles", nargs="+", default=list(PRODUCER_PROFILES))
+    args = parser.parse_args()
+    for profile in args.profiles:
+        print(run(profile, args.topic, args.messages, args.rate))
+
+
+if __name__ == "__main__":
+    main()
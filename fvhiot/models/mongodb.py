@@ -1,5 +1,8 @@
 import datetime
-from pydantic import field_validator, BaseModel, Extra
+import functools
+from typing import List
+
+from pydantic import field_validator, BaseModel, Extra, TypeAdapter, ValidationError
 
 
 class Meta(BaseModel, extra=Extra.allow):
@@ -24,3 +27,70 @@ class MongoDataline(BaseModel, extra=Extra.allow):
         if v.tzinfo is None or v.tzinfo.utcoffset(v) is None:
             raise ValueError("Datetime must be timezone aware, got naive datetime.")
         return v
+
+
+@functools.lru_cache(maxsize=None)
+def get_mongo_datalines_adapter() -> TypeAdapter:
+    """
+    Return (cached) TypeAdapter, which validates a list of MongoDatalines in one call.
+    """
+    return TypeAdapter(List[MongoDataline])
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_datetime(value: str) -> datetime.datetime:
+    """
+    Parse ISO-8601 timestamp string to datetime. Results are cached, because
+    datalines of one message (and often several messages) share the same timestamp.
+
+    Parsers emit datetime.isoformat() strings, e.g. "2022-03-02T12:21:30.123000+00:00",
+    which are handled by datetime.fromisoformat() directly. Other common variants,
+    e.g. "2022-03-02T12:21:30.123Z" and "2022-03-02T12:21:30.123000+0000", are handled too.
+
+    :param value: ISO-8601 timestamp string
+    :return: datetime (naive, if value doesn't contain timezone)
+    """
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    # Python < 3.11 doesn't understand "Z" nor "+0000"
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    elif len(value) > 5 and value[-5] in "+-" and value[-4:].isdigit():
+        value = value[:-2] + ":" + value[-2:]
+    return datetime.datetime.fromisoformat(value)
+
+
+def create_mongo_documents(datalines: List[dict], meta: dict, validate: bool = True) -> List[dict]:
+    """
+    Convert parser's datalines (see fvhiot.parsers) and device meta dict into documents,
+    which can be inserted into a timeseries collection using insert_many().
+    String timestamps are converted to datetimes and all documents are validated
+    in one call against MongoDataline model.
+
+    Note that all documents share the same `meta` dict.
+
+    :param datalines: list of {"time": "2022-03-02T12:21:30.123000+00:00", "data": {...}} dicts
+    :param meta: metadata dict, must contain device_id
+    :param validate: False to skip validation (e.g. if meta and times are known to be valid)
+    :return: list of Mongo documents
+    :raises pydantic.ValidationError: if some document is invalid, or if some time string
+        can't be parsed (also when validate is False)
+    """
+    documents = []
+    for i, dataline in enumerate(datalines):
+        document = dict(dataline)
+        if isinstance(document.get("time"), str):
+            try:
+                document["time"] = parse_datetime(document["time"])
+            except ValueError as err:
+                raise ValidationError.from_exception_data(
+                    "MongoDataline",
+                    [{"type": "value_error", "loc": (i, "time"), "input": document["time"], "ctx": {"error": err}}],
+                ) from None
+        document["meta"] = meta
+        documents.append(document)
+    if validate:
+        get_mongo_datalines_adapter().validate_python(documents)
+    return documents
@@ -1,16 +1,32 @@
 import asyncio
+import datetime
 import logging
 import os
+import time
+import warnings
+import zlib
 
-from typing import List
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional, Union
 
 import certifi
 
-from aiokafka import AIOKafkaConsumer, AIOKafkaProducer, TopicPartition
+from aiokafka import AIOKafkaConsumer, AIOKafkaProducer, ConsumerRebalanceListener, TopicPartition
 from aiokafka.errors import NoBrokersAvailable
 from aiokafka.helpers import create_ssl_context
+from aiokafka.partitioner import DefaultPartitioner
 from aiokafka.structs import RecordMetadata
 
+from fvhiot.utils.data import data_pack, data_unpack, data_unpack_many
+from fvhiot.utils.fakekafka import FakeAIOKafkaConsumer, FakeAIOKafkaProducer, use_memory_backend
+from fvhiot.utils.kafkatools import (
+    ContiguousOffsets,
+    LagMonitor,
+    dead_letter,
+    device_key,
+    get_producer_settings,
+    partition_for_device,
+)
+
 
 def on_send_success(record_metadata: RecordMetadata):
     """Log send success"""
@@ -35,25 +51,32 @@ async def get_aiokafka_producer(
     sasl_mechanism: str = None,
     sasl_plain_username: str = None,
     sasl_plain_password: str = None,
+    backend: str = None,
+    **kwargs,
 ) -> AIOKafkaProducer:
     """
     Simply create and return a KafkaProducer using given arguments.
+    Extra keyword arguments (e.g. from get_producer_settings()) are passed to AIOKafkaProducer.
+    With `backend` (default from KAFKA_BACKEND env) "memory" return an in-memory
+    FakeAIOKafkaProducer instead, see fvhiot.utils.fakekafka.
     """
     ssl_cafile = ssl_cafile or certifi.where()
     ssl_context = create_ssl_context(cafile=ssl_cafile, certfile=ssl_certfile, keyfile=ssl_keyfile)
-    kp = AIOKafkaProducer(
+    producer_class = FakeAIOKafkaProducer if use_memory_backend(backend) else AIOKafkaProducer
+    kp = producer_class(
         bootstrap_servers=bootstrap_servers,
         security_protocol=security_protocol,
         ssl_context=ssl_context,
         sasl_mechanism=sasl_mechanism,
         sasl_plain_username=sasl_plain_username,
         sasl_plain_password=sasl_plain_password,
+        **kwargs,
     )
     await kp.start()
     return kp
 
 
-async def get_aiokafka_producer_by_envs(**kwargs) -> AIOKafkaProducer:
+async def get_aiokafka_producer_by_envs(profile: str = None, **kwargs) -> AIOKafkaProducer:
     """
     Create and return Kafkaproducer, which is initialized by values from environment variables.
     At least these variables must usually be defined to make the connection to brokers:
@@ -62,8 +85,12 @@ async def get_aiokafka_producer_by_envs(**kwargs) -> AIOKafkaProducer:
     KAFKA_BOOTSTRAP_SERVERS
     KAFKA_SECURITY_PROTOCOL
     KAFKA_SASL_MECHANISMS
+    Batching settings come from `profile` or KAFKA_PRODUCER_PROFILE and KAFKA_PRODUCER_* envs,
+    see fvhiot.utils.kafkatools.get_producer_settings(). `kwargs` override them.
     """
     logging.info("Getting KafkaProducer: {}".format(os.getenv("KAFKA_BOOTSTRAP_SERVERS")))
+    settings = get_producer_settings(profile, "aiokafka")
+    settings.update(kwargs)
     try:
         kp = await get_aiokafka_producer(
             bootstrap_servers=os.getenv("KAFKA_BOOTSTRAP_SERVERS", "").split(","),
@@ -74,7 +101,7 @@ async def get_aiokafka_producer_by_envs(**kwargs) -> AIOKafkaProducer:
             sasl_mechanism=os.getenv("KAFKA_SASL_MECHANISMS"),
             sasl_plain_username=os.getenv("KAFKA_SASL_USERNAME"),
             sasl_plain_password=os.getenv("KAFKA_SASL_PASSWORD"),
-            **kwargs,
+            **settings,
         )
         return kp
     except NoBrokersAvailable as err:
@@ -96,6 +123,7 @@ async def get_aiokafka_consumer(
     auto_offset_reset="latest",
     enable_auto_commit: bool = False,
     offset: int = 0,
+    backend: str = None,
     **kwargs,
 ) -> AIOKafkaConsumer:
     """
@@ -106,11 +134,16 @@ async def get_aiokafka_consumer(
         fetch_min_bytes=100 * 1000,
         fetch_max_bytes=1 * 1000_000,
 
-    Use seek_to_offset() to subscribe to given topic(s) and seek to default offset 0.
+    Non-zero `offset` (negative integer, messages below the end of each partition)
+    seeks all partitions with seek_to_offset(), see also seek_partitions().
 
     Note: the consumer is already started here, thus it suffices to simply start
           consuming messages in the main app.
+
+    With `backend` (default from KAFKA_BACKEND env) "memory" return an in-memory
+    FakeAIOKafkaConsumer instead, see fvhiot.utils.fakekafka.
     """
+    consumer_class = FakeAIOKafkaConsumer if use_memory_backend(backend) else AIOKafkaConsumer
     logging.info(
         "KAFKA_BOOTSTRAP_SERVERS={}, KAFKA_GROUP_ID={}, KAFKA_SASL_USERNAME={}, TOPICS={}".format(
             bootstrap_servers, group_id, sasl_plain_username, topics
@@ -121,7 +154,7 @@ async def get_aiokafka_consumer(
 
     if offset != 0:
         logging.info(f"Creating AIOKafkaConsumer with group_id '{group_id}' and seeking to offset {offset}")
-        kc = AIOKafkaConsumer(
+        kc = consumer_class(
             *topics,
             bootstrap_servers=bootstrap_servers,
             security_protocol=security_protocol,
@@ -136,12 +169,11 @@ async def get_aiokafka_consumer(
             **kwargs,
         )
         await kc.start()
-        for topic in topics:
-            await seek_to_offset(kc, topic, offset)
+        await seek_to_offset(kc, topics, offset)
         return kc
     else:
         logging.info(f"Creating AIOKafkaConsumer with group_id '{group_id}' and not seeking")
-        kc = AIOKafkaConsumer(
+        kc = consumer_class(
             *topics,
             bootstrap_servers=bootstrap_servers,
             security_protocol=security_protocol,
@@ -194,21 +226,703 @@ async def get_aiokafka_consumer_by_envs(
         return None
 
 
-async def seek_to_offset(consumer: AIOKafkaConsumer, topic: str, start: int = -1):
-    """
-    Seek to the last message in topic.
-    """
-    partition_number, offset = -1, -1
-    # Loop through partitions and find the latest offset
-    for p in consumer.partitions_for_topic(topic):
-        tp = TopicPartition(topic, p)
-        await consumer.committed(tp)
-        # committed = await consumer.committed(tp)
-        await consumer.seek_to_end(tp)
-        last_offset = await consumer.position(tp)
-        # print("topic: {} partition: {} committed: {} last: {}".format(topic, p, committed, last_offset))
-        if offset < last_offset:
-            offset = last_offset
-            partition_number = p
-    tp = TopicPartition(topic, partition_number)
-    consumer.seek(tp, offset - start)
+async def seek_to_offset(consumer: AIOKafkaConsumer, topic: Union[str, List[str]], start: int = -1):
+    """
+    Seek every partition of topic `-start` messages before its end, like the sync version:
+    `start` must be negative integer or zero (seek to the end).
+    Positive `start` (the old, reversed convention) is deprecated and treated as `-start`.
+    """
+    if start > 0:
+        warnings.warn(
+            "Positive start in seek_to_offset() is deprecated, use negative values", DeprecationWarning, stacklevel=2
+        )
+        start = -start
+    await seek_partitions(consumer, topic, last=-start)
+
+
+async def _wait_for_assignment(consumer: AIOKafkaConsumer, timeout: float):
+    deadline = time.monotonic() + timeout
+    while not consumer.assignment() and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+
+
+async def seek_partitions(
+    consumer: AIOKafkaConsumer,
+    topic: Union[str, List[str]],
+    last: Optional[int] = None,
+    since: Optional[Union[datetime.datetime, int]] = None,
+    offsets: Optional[Dict[Union[int, TopicPartition], int]] = None,
+    assignment_timeout: float = 30.0,
+) -> Dict[TopicPartition, int]:
+    """
+    Seek every partition of topic(s) to
+    - `last` messages before the end of the partition, or
+    - the first message at or after `since` (aware datetime or epoch milliseconds), or
+    - explicit `offsets` ({partition number or TopicPartition: offset}, negative offset counts
+      from the end of the partition). Partitions missing from `offsets` are not seeked.
+    Targets of `last` and `offsets` are clamped to the beginning and end of the partition.
+    End and beginning offsets (and offsets for times) are fetched for all partitions concurrently
+    in one round trip, see fvhiot.utils.kafka.seek_partitions() for the sync version.
+
+    A consumer, which is subscribed to topics, seeks only its currently assigned partitions
+    (waiting up to `assignment_timeout` seconds for the group to assign them).
+    Otherwise all partitions of topic(s) are assigned to consumer.
+
+    :return: dict of seeked offsets
+    """
+    if sum(x is not None for x in (last, since, offsets)) != 1:
+        raise ValueError("Give exactly one of last, since or offsets")
+    topics = [topic] if isinstance(topic, str) else list(topic)
+    if consumer.subscription():
+        await _wait_for_assignment(consumer, assignment_timeout)
+        tps = sorted(tp for tp in consumer.assignment() if tp.topic in topics)
+    else:
+        if any(consumer.partitions_for_topic(t) is None for t in topics):
+            await consumer.topics()  # Refresh metadata
+        tps = [TopicPartition(t, p) for t in topics for p in sorted(consumer.partitions_for_topic(t) or [])]
+        consumer.assign(tps)
+    if not tps:
+        logging.warning(f"No partitions found for topic(s) {topics}")
+        return {}
+    if last is not None:
+        assert last >= 0
+        ends, beginnings = await asyncio.gather(consumer.end_offsets(tps), consumer.beginning_offsets(tps))
+        targets = {tp: max(beginnings[tp], ends[tp] - last) for tp in tps}
+    elif since is not None:
+        if isinstance(since, datetime.datetime):
+            since = int(since.timestamp() * 1000)
+        ends, found = await asyncio.gather(
+            consumer.end_offsets(tps), consumer.offsets_for_times({tp: since for tp in tps})
+        )
+        # Partitions without messages after `since` are seeked to the end
+        targets = {tp: found[tp].offset if found.get(tp) is not None else ends[tp] for tp in tps}
+    else:
+        ends, beginnings = await asyncio.gather(consumer.end_offsets(tps), consumer.beginning_offsets(tps))
+        targets = {}
+        for key, offset in offsets.items():
+            if isinstance(key, TopicPartition):
+                tp = key
+            elif len(topics) == 1:
+                tp = TopicPartition(topics[0], key)
+            else:
+                raise ValueError("Use TopicPartitions as offsets keys with many topics")
+            if tp not in ends:
+                raise ValueError(f"Unknown or unassigned partition {tp}")
+            target = ends[tp] + offset if offset < 0 else offset
+            targets[tp] = min(max(beginnings[tp], target), ends[tp])
+    for tp, offset in targets.items():
+        consumer.seek(tp, offset)
+    logging.info(
+        "Seeked to offsets {}".format(", ".join(f"{tp.topic}/{tp.partition}:{o}" for tp, o in targets.items()))
+    )
+    return targets
+
+
+async def send_for_device(
+    producer: AIOKafkaProducer, topic: str, device_id: str, message: dict, consistent_hash: bool = False, **kwargs
+) -> asyncio.Future:
+    """
+    Pack message with data_pack() and send it keyed by device_id, so that all messages
+    of one device go to the same partition (and thus stay in order and reach the same consumer).
+
+    By default Kafka's partitioner chooses the partition from the key. With `consistent_hash`
+    the partition is chosen with partition_for_device(), which moves fewer devices
+    when partitions are added to the topic. Use the same method for all producers of a topic.
+
+    :return: Future of RecordMetadata from producer.send()
+    """
+    partition = None
+    if consistent_hash:
+        partitions = sorted(await producer.partitions_for(topic))
+        partition = partitions[partition_for_device(device_id, len(partitions))]
+    return await producer.send(
+        topic, value=data_pack(message), key=device_key(device_id), partition=partition, **kwargs
+    )
+
+
+class BatchProducer(object):
+    """
+    Send many messages with AIOKafkaProducer.create_batch() and send_batch().
+
+    Messages are packed with `pack` and appended to one batch per partition. A full batch
+    is sent immediately, the rest when all messages have been appended. Messages with a key
+    are partitioned like AIOKafkaProducer.send() does (murmur2 of the key), messages without
+    a key fill one partition's batch at a time, rotating partitions between batches.
+
+    At most `max_in_flight` batches are waiting for delivery at a time, send_many()
+    waits for a free slot (backpressure). Delivery is tracked per batch: successes are only
+    counted in `counters` and logged at DEBUG level every `log_every` batches,
+    failures are logged as errors.
+
+    Usage:
+
+        batch_producer = BatchProducer(producer, max_in_flight=20)
+        await batch_producer.send_many(topic, messages, key=lambda m: m["device"]["device_id"])
+
+    :param producer: started AIOKafkaProducer
+    :param max_in_flight: maximum number of batches waiting for delivery
+    :param pack: function to encode message (None sends values as is)
+    :param log_every: log a debug line every n delivered batches (0 disables logging)
+    """
+
+    def __init__(
+        self,
+        producer: AIOKafkaProducer,
+        max_in_flight: int = 10,
+        pack: Optional[Callable[[Any], bytes]] = data_pack,
+        log_every: int = 100,
+    ):
+        self.producer = producer
+        self.pack = pack
+        self.log_every = log_every
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._partitioner = DefaultPartitioner()
+        self._next_partition: Dict[str, int] = {}
+        self.counters = {"sent": 0, "failed": 0, "batches": 0, "failed_batches": 0}
+
+    def _on_delivered(self, future: asyncio.Future, topic: str, partition: int, count: int):
+        self._in_flight.release()
+        if future.cancelled() or future.exception() is not None:
+            self.counters["failed"] += count
+            self.counters["failed_batches"] += 1
+            err = None if future.cancelled() else future.exception()
+            logging.error(f"Failed to send batch of {count} messages to {topic}/{partition}", exc_info=err)
+            return
+        self.counters["sent"] += count
+        self.counters["batches"] += 1
+        if self.log_every and self.counters["batches"] % self.log_every == 0:
+            logging.debug(
+                f"Sent batch of {count} messages to {topic}/{partition} at offset {future.result().offset}, "
+                f"totals: {self.counters}"
+            )
+
+    async def _send_batch(self, batch, topic: str, partition: int, count: int) -> asyncio.Future:
+        await self._in_flight.acquire()
+        try:
+            future = await self.producer.send_batch(batch, topic, partition=partition)
+        except BaseException:
+            self._in_flight.release()
+            raise
+        future.add_done_callback(lambda f: self._on_delivered(f, topic, partition, count))
+        return future
+
+    async def send_many(
+        self,
+        topic: str,
+        messages: Iterable[Any],
+        key: Optional[Callable[[Any], Union[str, bytes, None]]] = None,
+        wait: bool = True,
+    ) -> Union[int, List[asyncio.Future]]:
+        """
+        Send messages to topic in batches.
+
+        :param topic: topic name
+        :param messages: messages to send
+        :param key: function returning the key of a message (str, bytes or None)
+        :param wait: wait for delivery of all batches
+        :return: number of sent messages, or list of batch delivery futures if `wait` is False
+        :raises: the first delivery error, if `wait` is True. If packing, a key function or
+            an oversized message raises, batches sent so far are awaited before re-raising.
+        """
+        partitions = sorted(await self.producer.partitions_for(topic))
+        sticky = self._next_partition.get(topic, 0) % len(partitions)
+        batches: Dict[int, list] = {}  # partition -> [batch, message count]
+        futures = []
+        total = 0
+
+        def append(partition: int, message_key: Optional[bytes], value: bytes) -> bool:
+            entry = batches.setdefault(partition, [self.producer.create_batch(), 0])
+            if entry[0].append(key=message_key, value=value, timestamp=None) is None:
+                return False
+            entry[1] += 1
+            return True
+
+        try:
+            for message in messages:
+                value = message if self.pack is None else self.pack(message)
+                message_key = key(message) if key is not None else None
+                if isinstance(message_key, str):
+                    message_key = device_key(message_key)
+                if message_key is None:
+                    partition = partitions[sticky]
+                else:
+                    partition = self._partitioner(message_key, partitions, partitions)
+                while not append(partition, message_key, value):
+                    # Batch is full, send it and continue with a new one
+                    batch, count = batches.pop(partition)
+                    if count == 0:
+                        raise ValueError(f"Message of {len(value)} bytes doesn't fit in a batch")
+                    futures.append(await self._send_batch(batch, topic, partition, count))
+                    if message_key is None:
+                        sticky = (sticky + 1) % len(partitions)
+                        partition = partitions[sticky]
+                total += 1
+        except BaseException:
+            # Wait for batches sent so far, their delivery errors are logged by _on_delivered()
+            await asyncio.gather(*futures, return_exceptions=True)
+            raise
+        for partition, (batch, count) in batches.items():
+            futures.append(await self._send_batch(batch, topic, partition, count))
+        self._next_partition[topic] = sticky + 1
+        if not wait:
+            return futures
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            raise errors[0]
+        return total
+
+
+class AIOKafkaLagMonitor(LagMonitor):
+    """
+    Lag and throughput monitor for an AIOKafkaConsumer, see fvhiot.utils.kafkatools.LagMonitor.
+    Call observe() with every getmany() result. start() runs a background task, which
+    fetches end offsets of assigned partitions every `interval` seconds, so the consume loop
+    never waits for the broker.
+
+    Usage:
+
+        monitor = AIOKafkaLagMonitor(consumer, labels={"group": os.getenv("KAFKA_GROUP_ID")})
+        monitor.start()
+        while True:
+            records = await consumer.getmany(timeout_ms=1000)
+            monitor.observe(records)
+            ...
+        # e.g. in a HTTP endpoint: monitor.snapshot() or monitor.prometheus()
+    """
+
+    def __init__(self, consumer: AIOKafkaConsumer, interval: float = 15.0, window: float = 60.0, labels=None):
+        super().__init__(interval, window, labels)
+        self.consumer = consumer
+        self._task: Optional[asyncio.Task] = None
+
+    async def refresh(self):
+        """Update positions and end offsets of assigned partitions"""
+        tps = list(self.consumer.assignment())
+        if not tps:
+            self.update({}, {})
+            return
+        ends = await self.consumer.end_offsets(tps)
+        positions = dict(zip(tps, await asyncio.gather(*(self.consumer.position(tp) for tp in tps))))
+        self.update(positions, ends)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                logging.warning(f"Failed to update consumer lag: {err}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """Start updating offsets in the background"""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stop the background task"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+class DeadLetterQueue(object):
+    """
+    Route records, whose processing failed, to a dead-letter topic instead of crashing
+    (and reprocessing everything) or dropping them silently.
+
+    add() buffers a dead_letter() message (original record, parser_module, exception class
+    and timestamp), which are sent packed with data_pack() in batches of `batch_size`
+    with BatchProducer. Await flush() before committing offsets of the failed records.
+
+    Usage:
+
+        dlq = DeadLetterQueue(producer, os.getenv("KAFKA_DLQ_TOPIC_NAME"))
+        for record in partition_records:
+            try:
+                await process(record)
+            except Exception as err:
+                await dlq.add(record, err, device.parser_module)
+        await dlq.flush()
+        await consumer.commit()
+
+    Replay dead letters with replay_dead_letters() once the bug has been fixed.
+    """
+
+    def __init__(self, producer: AIOKafkaProducer, topic: str, batch_size: int = 100):
+        self.producer = BatchProducer(producer)
+        self.topic = topic
+        self.batch_size = batch_size
+        self._buffer: List[dict] = []
+        self.count = 0
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    async def add(self, record, error: BaseException, parser_module: Optional[str] = None):
+        """Add a failed record, send buffered dead letters if the batch is full"""
+        logging.warning(
+            f"Sending record {record.topic}/{record.partition}:{record.offset} to {self.topic}: "
+            f"{type(error).__name__}: {error}"
+        )
+        self._buffer.append(dead_letter(record, error, parser_module))
+        if len(self._buffer) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self) -> int:
+        """
+        Send buffered dead letters and wait until they are delivered, return number of sent messages.
+        If delivery fails, the letters stay in the buffer and are sent again on the next flush().
+        """
+        letters = list(self._buffer)
+        if letters:
+            await self.producer.send_many(self.topic, letters, key=lambda letter: letter["key"])
+        del self._buffer[: len(letters)]  # Letters added while sending stay in the buffer
+        self.count += len(letters)
+        return len(letters)
+
+
+async def replay_dead_letters(
+    consumer: AIOKafkaConsumer,
+    producer: AIOKafkaProducer,
+    parser_module: Optional[str] = None,
+    topic: Optional[str] = None,
+    timeout_ms: int = 5000,
+    commit: bool = True,
+) -> int:
+    """
+    Send original records from a dead-letter topic back to their original topic (or `topic`),
+    so they are processed again. Consumes until there are no new dead letters for `timeout_ms`.
+
+    :param consumer: AIOKafkaConsumer subscribed to (or assigned) the dead-letter topic
+    :param producer: AIOKafkaProducer
+    :param parser_module: replay only dead letters of this parser module
+    :param topic: send records to this topic instead of the original one
+    :param timeout_ms: stop after no dead letters were received for this long
+    :param commit: commit consumer's offsets after each replayed batch. Offsets are never committed
+        with `parser_module`, because that would drop dead letters of other parser modules,
+        so use a throwaway group id (or none) for filtered replays.
+    :return: number of replayed records
+    """
+    commit = commit and parser_module is None
+    batch_producer = BatchProducer(producer, pack=lambda letter: letter["value"])
+    replayed = 0
+    while True:
+        records = await consumer.getmany(timeout_ms=timeout_ms)
+        if not any(records.values()):
+            break
+        by_topic: Dict[str, List[dict]] = {}
+        for partition_records in records.values():
+            for record in partition_records:
+                letter = data_unpack(record.value)
+                if parser_module is None or letter.get("parser_module") == parser_module:
+                    by_topic.setdefault(topic or letter["topic"], []).append(letter)
+        for target, letters in by_topic.items():
+            replayed += await batch_producer.send_many(target, letters, key=lambda letter: letter["key"])
+        if commit:
+            await consumer.commit()
+    logging.info(f"Replayed {replayed} dead letters")
+    return replayed
+
+
+class PartitionBatch(object):
+    """
+    Batch of messages from one partition, yielded by iter_batches().
+    Call `await batch.commit()` after the batch has been processed.
+    """
+
+    def __init__(self, consumer: AIOKafkaConsumer, tp: TopicPartition, messages: list, last_offset: int):
+        self.consumer = consumer
+        self.tp = tp
+        self.messages = messages
+        self.last_offset = last_offset
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    async def commit(self):
+        """Commit offset after the last message of this batch"""
+        await self.consumer.commit({self.tp: self.last_offset + 1})
+
+
+async def iter_batches(
+    consumer: AIOKafkaConsumer,
+    max_records: int = 500,
+    timeout_ms: int = 1000,
+    unpack: Optional[Callable[[bytes], Any]] = data_unpack,
+) -> AsyncIterator[PartitionBatch]:
+    """
+    Fetch messages with consumer.getmany() and yield them as per-partition batches.
+    Message values are decoded with `unpack` (None yields values as is) and envelopes
+    (see fvhiot.utils.kafka.send_envelopes()) are flattened to the messages they contain.
+    Combine with consumer's fetch_max_wait_ms and fetch_min_bytes to get larger batches.
+
+    Usage:
+
+        async for batch in iter_batches(consumer, max_records=1000):
+            await collection.insert_many(batch.messages)
+            await batch.commit()
+
+    :param consumer: started AIOKafkaConsumer with enable_auto_commit=False
+    :param max_records: maximum number of records returned by one getmany()
+    :param timeout_ms: getmany() timeout in milliseconds
+    :param unpack: function to decode message value
+    :return: Async iterator of PartitionBatches
+    """
+    while True:
+        records = await consumer.getmany(timeout_ms=timeout_ms, max_records=max_records)
+        for tp, partition_records in records.items():
+            if not partition_records:
+                continue
+            if unpack is None:
+                messages = [r.value for r in partition_records]
+            else:
+                messages = [m for r in partition_records for m in data_unpack_many(r.value, unpack=unpack)]
+            yield PartitionBatch(consumer, tp, messages, partition_records[-1].offset)
+
+
+class OffsetTracker(object):
+    """
+    Track consumed offsets, which are completed in any order, and commit per partition
+    the offset after the highest contiguous completed offset (see ContiguousOffsets).
+
+    maybe_commit() commits when `commit_every` offsets have been completed or `commit_interval`
+    seconds have passed since the last commit. Call it e.g. after every getmany().
+
+    Usage:
+
+        def done(future, tp, offset):
+            # Never complete failed records, offsets would be committed past them
+            if not future.cancelled() and future.exception() is None:
+                tracker.complete(tp, offset)
+
+        tracker = OffsetTracker(consumer, commit_interval=5.0, commit_every=1000)
+        records = await consumer.getmany(timeout_ms=1000)
+        for tp, partition_records in records.items():
+            for record in partition_records:
+                tracker.add(tp, record.offset)
+                asyncio.ensure_future(process(record)).add_done_callback(
+                    functools.partial(done, tp=tp, offset=record.offset)
+                )
+        await tracker.maybe_commit()
+
+    To skip records which can't be processed, catch the error in process() and
+    send the record to a DeadLetterQueue, so that the record completes normally.
+
+    :param consumer: started AIOKafkaConsumer with enable_auto_commit=False
+    :param commit_interval: maximum seconds between commits (0 disables time based commits)
+    :param commit_every: commit after this many completed offsets (0 disables count based commits)
+    """
+
+    def __init__(self, consumer: AIOKafkaConsumer, commit_interval: float = 5.0, commit_every: int = 0):
+        self.consumer = consumer
+        self.commit_interval = commit_interval
+        self.commit_every = commit_every
+        self._offsets: Dict[TopicPartition, ContiguousOffsets] = {}
+        self._committed: Dict[TopicPartition, int] = {}
+        self._completed_since_commit = 0
+        self._last_commit = time.monotonic()
+
+    def __len__(self) -> int:
+        """Number of added but not yet completed offsets"""
+        return sum(len(o) for o in self._offsets.values())
+
+    def add(self, tp: TopicPartition, offset: int):
+        """Add a consumed offset, offsets of a partition must be added in increasing order"""
+        self._offsets.setdefault(tp, ContiguousOffsets()).add(offset)
+
+    def complete(self, tp: TopicPartition, offset: int):
+        """Mark offset completed"""
+        offsets = self._offsets.get(tp)
+        if offsets is not None:  # None if partition has been revoked
+            offsets.complete(offset)
+            self._completed_since_commit += 1
+
+    def committable(self) -> Dict[TopicPartition, int]:
+        """Return offsets which have advanced since the last commit"""
+        return {
+            tp: offsets.committable
+            for tp, offsets in self._offsets.items()
+            if offsets.committable is not None and offsets.committable != self._committed.get(tp)
+        }
+
+    async def commit(self, tps: Optional[List[TopicPartition]] = None):
+        """Commit completed offsets (of `tps` or all partitions), forget partitions which are no longer assigned"""
+        assignment = self.consumer.assignment()
+        self.forget([tp for tp in self._offsets if tp not in assignment])
+        commit = self.committable()
+        if tps is not None:
+            commit = {tp: o for tp, o in commit.items() if tp in tps}
+        else:
+            self._completed_since_commit = 0
+            self._last_commit = time.monotonic()
+        if commit:
+            await self.consumer.commit(commit)
+            self._committed.update(commit)
+
+    async def maybe_commit(self) -> bool:
+        """Commit if enough offsets have been completed or enough time has passed, return True if committed"""
+        if (self.commit_every and self._completed_since_commit >= self.commit_every) or (
+            self.commit_interval and time.monotonic() - self._last_commit >= self.commit_interval
+        ):
+            await self.commit()
+            return True
+        return False
+
+    def forget(self, tps: List[TopicPartition]):
+        """Stop tracking (revoked) partitions"""
+        for tp in tps:
+            self._offsets.pop(tp, None)
+            self._committed.pop(tp, None)
+
+
+def _key_hash(key: Hashable) -> int:
+    if isinstance(key, bytes):
+        return zlib.crc32(key)
+    if isinstance(key, str):
+        return zlib.crc32(key.encode("utf-8"))
+    return hash(key)
+
+
+class KeyOrderedDispatcher(ConsumerRebalanceListener):
+    """
+    Process consumed records concurrently, but in order per key.
+
+    Records are hashed by key to `workers` worker coroutines, each with a bounded queue.
+    Records with the same key are processed one at a time in consuming order, while records
+    with different keys are processed concurrently. Full queues make run() wait (backpressure).
+    Offsets are committed only up to the lowest not yet processed offset of each partition.
+
+    Default key is the Kafka message key, or the partition if the message has no key.
+    Use e.g. `key=lambda r: data_unpack_paths(r.value, [("device", "device_id")])[0]`
+    to order by device id, when producers don't set keys.
+
+    If the handler raises, run() stops and raises the exception. Offsets of the failed
+    record and any later record of its partition are not committed.
+
+    Usage:
+
+        dispatcher = KeyOrderedDispatcher(consumer, save_to_database, workers=16)
+        await dispatcher.run()
+
+    :param consumer: started AIOKafkaConsumer with enable_auto_commit=False
+    :param handler: coroutine function called with each (unpacked) message, also for each message of an envelope
+    :param workers: number of worker coroutines
+    :param queue_size: maximum number of queued records per worker
+    :param key: function returning the ordering key of a ConsumerRecord
+    :param unpack: function to decode message value (None passes values as is)
+    :param commit_interval: seconds between commits
+    """
+
+    def __init__(
+        self,
+        consumer: AIOKafkaConsumer,
+        handler: Callable[[Any], Awaitable],
+        workers: int = 8,
+        queue_size: int = 100,
+        key: Optional[Callable[[Any], Hashable]] = None,
+        unpack: Optional[Callable[[bytes], Any]] = data_unpack,
+        commit_interval: float = 5.0,
+    ):
+        self.consumer = consumer
+        self.handler = handler
+        self.key = key
+        self.unpack = unpack
+        self.commit_interval = commit_interval
+        self._queues = [asyncio.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._tasks: List[asyncio.Task] = []
+        self.offsets = OffsetTracker(consumer, commit_interval)
+        self._error: Optional[BaseException] = None
+        self._running = False
+
+    async def _worker(self, q: asyncio.Queue):
+        while True:
+            tp, record = await q.get()
+            try:
+                if self._error is None:
+                    if self.unpack is None:
+                        await self.handler(record.value)
+                    else:
+                        for message in data_unpack_many(record.value, unpack=self.unpack):
+                            await self.handler(message)
+                    self.offsets.complete(tp, record.offset)
+            except Exception as err:
+                logging.exception(f"Failed to process record {tp.topic}/{tp.partition}:{record.offset}")
+                self._error = err
+            finally:
+                q.task_done()
+
+    def _start_workers(self):
+        if not self._tasks:
+            self._tasks = [asyncio.ensure_future(self._worker(q)) for q in self._queues]
+
+    async def submit(self, tp: TopicPartition, record):
+        """
+        Queue a record for processing, wait if the worker's queue is full.
+        Records of partitions, which have been revoked meanwhile (e.g. while waiting), are skipped.
+        """
+        if self._error is not None:
+            raise self._error
+        if tp not in self.consumer.assignment():
+            return
+        self._start_workers()
+        key = self.key(record) if self.key is not None else record.key
+        if key is None:
+            key = (tp.topic, tp.partition)
+        self.offsets.add(tp, record.offset)
+        await self._queues[_key_hash(key) % len(self._queues)].put((tp, record))
+
+    async def drain(self):
+        """Wait until all queued records are processed"""
+        await asyncio.gather(*(q.join() for q in self._queues))
+
+    async def commit(self, tps: Optional[List[TopicPartition]] = None):
+        """Commit processed offsets"""
+        await self.offsets.commit(tps)
+
+    async def on_partitions_revoked(self, revoked):
+        logging.info(f"Partitions revoked: {revoked}")
+        await self.drain()
+        await self.commit(list(revoked))
+        self.offsets.forget(list(revoked))
+
+    async def on_partitions_assigned(self, assigned):
+        logging.info(f"Partitions assigned: {assigned}")
+
+    def stop(self):
+        """Ask run() to stop"""
+        self._running = False
+
+    async def close(self):
+        """Wait for queued records, commit and stop workers"""
+        if self._error is None:
+            await self.drain()
+        await self.commit()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def run(self, max_records: int = 500, timeout_ms: int = 1000):
+        """Consume and dispatch records until stop() is called or a handler raises"""
+        if self.consumer.subscription():
+            # Re-subscribe to get notified about rebalances
+            self.consumer.subscribe(topics=list(self.consumer.subscription()), listener=self)
+        self._running = True
+        try:
+            while self._running and self._error is None:
+                records = await self.consumer.getmany(timeout_ms=timeout_ms, max_records=max_records)
+                for tp, partition_records in records.items():
+                    for record in partition_records:
+                        await self.submit(tp, record)
+                await self.offsets.maybe_commit()
+        finally:
+            await self.close()
+        if self._error is not None:
+            raise self._error
@@ -0,0 +1,250 @@
+"""
+Optional compression layer for packed payloads.
+
+Compressed payload starts with a 6 byte header:
+
+    0xc1 marker (never used by msgpack, so uncompressed payloads are recognized)
+    codec id (1 = zlib, 2 = zstd)
+    dictionary id, big-endian uint32 (0 = no dictionary)
+
+zlib is always available, zstd requires `zstandard` package (`fvhiot[zstd]` extra).
+Both codecs can use a shared dictionary, which makes a big difference for small,
+repetitive messages (e.g. Thingpark DevEUI_uplink JSON bodies).
+Dictionaries are identified by CRC32 of their content, so a new version of a dictionary
+gets a new id and old messages can still be decompressed, if the old dictionary is kept.
+
+Train a dictionary from an archive created with data_pack_stream():
+
+    python -m fvhiot.utils.compression raw_data.msgpack thingpark.dict --size 32768
+"""
+
+import argparse
+import collections
+import logging
+import os
+import struct
+import threading
+import zlib
+from typing import Dict, Iterable, List, Optional, Union
+
+from fvhiot.utils.data import data_pack, data_unpack, data_unpack_stream
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, zlib is always available
+    zstandard = None
+
+COMPRESSION_MARKER = 0xC1
+COMPRESSION_HEADER = struct.Struct(">BBI")
+CODECS = {"zlib": 1, "zstd": 2}
+CODEC_NAMES = {v: k for k, v in CODECS.items()}
+ZLIB_MAX_DICTIONARY_SIZE = 32 * 1024
+
+_local = threading.local()
+
+
+def preferred_codec() -> str:
+    """Return "zstd" if zstandard is installed, otherwise "zlib" """
+    return "zstd" if zstandard is not None else "zlib"
+
+
+class CompressionDictionary(object):
+    """
+    Shared compression dictionary. dict_id is CRC32 of the content.
+    """
+
+    def __init__(self, data: bytes):
+        self.data = bytes(data)
+        self.dict_id = zlib.crc32(self.data) or 1  # 0 means "no dictionary"
+        self._zstd_dict = None
+
+    def __repr__(self):
+        return f"<CompressionDictionary id={self.dict_id} size={len(self.data)}>"
+
+    @property
+    def zstd_dict(self):
+        if self._zstd_dict is None:
+            self._zstd_dict = zstandard.ZstdCompressionDict(self.data)
+        return self._zstd_dict
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            f.write(self.data)
+
+    @classmethod
+    def load(cls, path: str) -> "CompressionDictionary":
+        with open(path, "rb") as f:
+            return cls(f.read())
+
+
+def train_dictionary(samples: List[bytes], size: int = ZLIB_MAX_DICTIONARY_SIZE, codec: Optional[str] = None):
+    """
+    Train a dictionary from a sample of (packed) messages.
+
+    zstd uses zstandard's dictionary trainer, which picks common substrings of the samples.
+    zlib has no trainer: whole samples are concatenated, the most common ones at the end of
+    the dictionary (zlib finds matches from the end of the dictionary more cheaply).
+    Packed messages rarely repeat exactly (timestamps, counters), so in practice the zlib
+    dictionary is just the first samples that fit. That still helps, because zlib matches
+    any substring of the dictionary (map keys, device ids, static fields), but give it
+    a representative sample and prefer zstd when it is available.
+    Samples larger than the dictionary are skipped.
+
+    :param samples: list of packed messages
+    :param size: maximum size of the dictionary in bytes (zlib uses at most 32 kB)
+    :param codec: "zlib" or "zstd", default is preferred_codec()
+    :return: CompressionDictionary
+    :raises ValueError: if no sample fits in a zlib dictionary
+    """
+    codec = codec or preferred_codec()
+    if codec == "zstd":
+        return CompressionDictionary(zstandard.train_dictionary(size, samples).as_bytes())
+    size = min(size, ZLIB_MAX_DICTIONARY_SIZE)
+    parts, total = [], 0
+    for sample, _ in collections.Counter(samples).most_common():
+        if total + len(sample) > size:
+            continue
+        parts.append(sample)
+        total += len(sample)
+    if not parts:
+        raise ValueError(f"No sample fits in a dictionary of {size} bytes")
+    return CompressionDictionary(b"".join(reversed(parts)))
+
+
+def _zstd_compressor(level: int, dictionary: Optional[CompressionDictionary]):
+    # ZstdCompressors are not thread safe, so they are cached per thread
+    key = ("c", level, dictionary.dict_id if dictionary else 0)
+    cache = _local.__dict__.setdefault("zstd", {})
+    if key not in cache:
+        cache[key] = zstandard.ZstdCompressor(level=level, dict_data=dictionary.zstd_dict if dictionary else None)
+    return cache[key]
+
+
+def _zstd_decompressor(dictionary: Optional[CompressionDictionary]):
+    key = ("d", dictionary.dict_id if dictionary else 0)
+    cache = _local.__dict__.setdefault("zstd", {})
+    if key not in cache:
+        cache[key] = zstandard.ZstdDecompressor(dict_data=dictionary.zstd_dict if dictionary else None)
+    return cache[key]
+
+
+def is_compressed(payload: Union[bytes, bytearray, memoryview]) -> bool:
+    """Return True if payload is created by compress()"""
+    return len(payload) >= COMPRESSION_HEADER.size and payload[0] == COMPRESSION_MARKER
+
+
+def compress(
+    payload: bytes,
+    codec: Optional[str] = None,
+    level: Optional[int] = None,
+    dictionary: Optional[CompressionDictionary] = None,
+) -> bytes:
+    """
+    Compress a packed payload and prepend compression header.
+
+    :param payload: packed message (or envelope)
+    :param codec: "zlib" or "zstd", default is preferred_codec()
+    :param level: compression level, default is codec's default
+    :param dictionary: optional shared dictionary
+    :return: compressed payload
+    """
+    codec = codec or preferred_codec()
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec '{codec}', must be one of {list(CODECS)}")
+    header = COMPRESSION_HEADER.pack(COMPRESSION_MARKER, CODECS[codec], dictionary.dict_id if dictionary else 0)
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd codec requires zstandard package")
+        return header + _zstd_compressor(3 if level is None else level, dictionary).compress(payload)
+    level = -1 if level is None else level
+    if dictionary is None:
+        return header + zlib.compress(payload, level)
+    compressor = zlib.compressobj(level, zdict=dictionary.data)
+    return header + compressor.compress(payload) + compressor.flush()
+
+
+def decompress(
+    payload: Union[bytes, bytearray, memoryview],
+    dictionaries: Optional[Union[Dict[int, CompressionDictionary], Iterable[CompressionDictionary]]] = None,
+) -> bytes:
+    """
+    Decompress payload created by compress(). Uncompressed payloads are returned as is.
+
+    :param payload: compressed or uncompressed payload
+    :param dictionaries: dictionaries the payload may have been compressed with
+    :return: packed message (or envelope)
+    """
+    if not is_compressed(payload):
+        return payload
+    _, codec_id, dict_id = COMPRESSION_HEADER.unpack_from(payload)
+    data = memoryview(payload)[COMPRESSION_HEADER.size :]
+    dictionary = None
+    if dict_id:
+        if dictionaries is not None and not isinstance(dictionaries, dict):
+            dictionaries = {d.dict_id: d for d in dictionaries}
+        if not dictionaries or dict_id not in dictionaries:
+            raise ValueError(f"Payload is compressed with unknown dictionary {dict_id}")
+        dictionary = dictionaries[dict_id]
+    if CODEC_NAMES.get(codec_id) == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Payload is compressed with zstd, which requires zstandard package")
+        return _zstd_decompressor(dictionary).decompress(data)
+    elif CODEC_NAMES.get(codec_id) == "zlib":
+        if dictionary is None:
+            return zlib.decompress(data)
+        decompressor = zlib.decompressobj(zdict=dictionary.data)
+        return decompressor.decompress(data) + decompressor.flush()
+    raise ValueError(f"Unknown codec id {codec_id}")
+
+
+def data_pack_compressed(
+    message: dict,
+    codec: Optional[str] = None,
+    level: Optional[int] = None,
+    dictionary: Optional[CompressionDictionary] = None,
+    datetimes: bool = False,
+) -> bytes:
+    """
+    Pack message using data_pack() and compress it, see compress().
+    """
+    return compress(data_pack(message, datetimes), codec, level, dictionary)
+
+
+def data_unpack_compressed(
+    payload: bytes,
+    dictionaries: Optional[Union[Dict[int, CompressionDictionary], Iterable[CompressionDictionary]]] = None,
+    datetimes: bool = False,
+) -> dict:
+    """
+    Decompress (if necessary) and unpack message using data_unpack(), see decompress().
+    """
+    return data_unpack(decompress(payload, dictionaries), datetimes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train a compression dictionary from a data_pack_stream() archive")
+    parser.add_argument("input", help="Archive file created with data_pack_stream()")
+    parser.add_argument("output", help="Dictionary file to write")
+    parser.add_argument("--size", type=int, default=ZLIB_MAX_DICTIONARY_SIZE, help="Dictionary size in bytes")
+    parser.add_argument("--samples", type=int, default=10000, help="Maximum number of messages to sample")
+    parser.add_argument("--codec", choices=list(CODECS), default=preferred_codec())
+    args = parser.parse_args()
+    samples = []
+    for message in data_unpack_stream(args.input):
+        samples.append(data_pack(message))
+        if len(samples) >= args.samples:
+            break
+    dictionary = train_dictionary(samples, args.size, args.codec)
+    dictionary.save(args.output)
+    sample_size = sum(len(s) for s in samples)
+    compressed_size = sum(len(compress(s, args.codec, dictionary=dictionary)) for s in samples)
+    logging.info(f"Saved {dictionary} to {args.output}")
+    print(
+        f"Dictionary id {dictionary.dict_id}, {len(dictionary.data)} bytes, trained from {len(samples)} messages. "
+        f"Compressed size {compressed_size}/{sample_size} bytes ({100 * compressed_size / max(sample_size, 1):.1f}%) "
+        f"in {os.path.basename(args.output)}"
+    )
+
+
+if __name__ == "__main__":
+    main()
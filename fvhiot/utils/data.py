@@ -1,21 +1,324 @@
+import mmap
+import os
+import struct
+import threading
+from typing import Any, BinaryIO, Callable, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
 import msgpack
 
+READ_SIZE = 1024 * 1024
+
+# Envelope frame starts with a msgpack fixext 4 (0xd6) object of ext type 1, containing
+# the number of messages as big-endian uint32. Packed messages follow the header.
+# Normal data_pack()ed messages are maps, so they never start with these bytes.
+ENVELOPE_EXT_TYPE = 1
+ENVELOPE_MAGIC = bytes([0xD6, ENVELOPE_EXT_TYPE])
+ENVELOPE_HEADER = struct.Struct(">2sI")
+
+# msgpack Packers are not thread safe, so reusable Packers are kept per thread
+_local = threading.local()
+
+
+def get_packer(datetimes: bool = False, autoreset: bool = True) -> msgpack.Packer:
+    """
+    Return a reusable thread-local msgpack.Packer initialized with data_pack() arguments.
+    Reusing a Packer avoids creating a new Packer and its internal buffer for every message.
+
+    :param datetimes: pack aware datetimes as msgpack Timestamps, see data_pack()
+    :param autoreset: False to get a Packer, which keeps packed data in its buffer until reset()
+    :return: msgpack.Packer
+    """
+    key = (datetimes, autoreset)
+    try:
+        return _local.packers[key]
+    except AttributeError:
+        _local.packers = {}
+    except KeyError:
+        pass
+    packer = msgpack.Packer(use_bin_type=True, strict_types=True, datetime=datetimes, autoreset=autoreset)
+    _local.packers[key] = packer
+    return packer
+
 
-def data_pack(message: dict):
+def data_pack(message: dict, datetimes: bool = False):
     """
-    Pack message using msgpack.packb() and known arguments.
+    Pack message using a reusable msgpack.Packer and known arguments.
+
+    If `datetimes` is True, timezone aware datetimes are packed using msgpack's native
+    Timestamp extension type (naive datetimes raise ValueError). Unpack such messages
+    with data_unpack(message, datetimes=True).
 
     :param dict message:
+    :param bool datetimes: pack aware datetimes as msgpack Timestamps
     :return: Packed message
     """
-    return msgpack.packb(message, use_bin_type=True, strict_types=True)
+    return get_packer(datetimes).pack(message)
+
+
+def data_pack_into(buffer: bytearray, messages: Iterable[dict], datetimes: bool = False) -> int:
+    """
+    Pack messages one after another to the end of `buffer` without allocating
+    a new bytes object for each message. If some message can't be packed,
+    the exception is raised and `buffer` is left untouched.
+
+    :param buffer: bytearray to extend
+    :param messages: iterable of messages
+    :param datetimes: pack aware datetimes as msgpack Timestamps, see data_pack()
+    :return: Number of packed messages
+    """
+    packer = get_packer(datetimes, autoreset=False)
+    count = 0
+    try:
+        for message in messages:
+            packer.pack(message)
+            count += 1
+        with packer.getbuffer() as view:
+            buffer += view
+    finally:
+        packer.reset()
+    return count
 
 
-def data_unpack(message: bytes):
+def data_unpack(message: bytes, datetimes: bool = False):
     """
     Unpack message using msgpack.unpackb() and known arguments.
 
+    If `datetimes` is True, msgpack Timestamps are unpacked to timezone aware UTC datetimes.
+    Messages without Timestamps (e.g. with isoformat() strings) unpack as before.
+
+    `message` can be any bytes-like object, e.g. a memoryview slice of a larger buffer.
+
     :param bytes message:
+    :param bool datetimes: unpack msgpack Timestamps to aware datetimes
     :return: Message in dict
     """
-    return msgpack.unpackb(message, use_list=True, raw=False, strict_map_key=True)
+    return msgpack.unpackb(message, use_list=True, raw=False, strict_map_key=True, timestamp=3 if datetimes else 0)
+
+
+def data_pack_stream(fileobj: BinaryIO, messages: Iterable[dict], datetimes: bool = False) -> int:
+    """
+    Pack messages one after another into a binary file object using the same
+    arguments as data_pack(). Use data_unpack_stream() to read them back.
+
+    :param fileobj: writable binary file object
+    :param messages: iterable of messages
+    :param datetimes: pack aware datetimes as msgpack Timestamps, see data_pack()
+    :return: Number of packed messages
+    """
+    packer = get_packer(datetimes)
+    count = 0
+    for message in messages:
+        fileobj.write(packer.pack(message))
+        count += 1
+    return count
+
+
+def data_unpack_stream(
+    source: Union[str, os.PathLike, BinaryIO, bytes, bytearray, memoryview, Iterable[bytes]],
+    read_size: int = READ_SIZE,
+    datetimes: bool = False,
+) -> Iterator[dict]:
+    """
+    Unpack a stream of messages (e.g. created by data_pack_stream()) one message at a time,
+    using the same arguments as data_unpack(). Memory usage is bounded by `read_size`
+    and the size of the largest message, not by the size of the stream.
+
+    :param source: file path (which is memory-mapped), binary file object (e.g. open file or mmap),
+                   bytes-like object or iterable of bytes chunks
+    :param read_size: number of bytes to read (or feed) at a time
+    :param datetimes: unpack msgpack Timestamps to aware datetimes, see data_unpack()
+    :return: Iterator of messages
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield from data_unpack_stream(mm, read_size, datetimes)
+        return
+    kwargs = dict(use_list=True, raw=False, strict_map_key=True, timestamp=3 if datetimes else 0)
+    if hasattr(source, "read"):
+        yield from msgpack.Unpacker(source, read_size=read_size, **kwargs)
+        return
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        source = (view[i : i + read_size] for i in range(0, len(view), read_size))
+    unpacker = msgpack.Unpacker(**kwargs)
+    for chunk in source:
+        unpacker.feed(chunk)
+        yield from unpacker
+
+
+def data_pack_envelope(messages: List[dict], datetimes: bool = False) -> bytes:
+    """
+    Pack many messages into one envelope frame, e.g. to send them in one Kafka message.
+    Use data_unpack_many() or Envelope to read them back.
+
+    :param messages: list of messages
+    :param datetimes: pack aware datetimes as msgpack Timestamps, see data_pack()
+    :return: Packed envelope
+    """
+    buffer = bytearray(ENVELOPE_HEADER.pack(ENVELOPE_MAGIC, len(messages)))
+    data_pack_into(buffer, messages, datetimes)
+    return bytes(buffer)
+
+
+def data_pack_batches(
+    messages: Iterable[dict], max_count: int = 1000, max_bytes: int = 900_000, datetimes: bool = False
+) -> Iterator[bytes]:
+    """
+    Pack messages into envelope frames having at most `max_count` messages and
+    (unless a single message is larger) at most `max_bytes` bytes.
+    Default max_bytes stays below Kafka's default 1 MB message size limit.
+
+    :param messages: iterable of messages
+    :param max_count: maximum number of messages in one envelope
+    :param max_bytes: maximum size of one envelope in bytes
+    :param datetimes: pack aware datetimes as msgpack Timestamps, see data_pack()
+    :return: Iterator of packed envelopes
+    """
+    packer = get_packer(datetimes)
+    parts: List[bytes] = []
+    size = ENVELOPE_HEADER.size
+    for message in messages:
+        packed = packer.pack(message)
+        if parts and (len(parts) >= max_count or size + len(packed) > max_bytes):
+            yield ENVELOPE_HEADER.pack(ENVELOPE_MAGIC, len(parts)) + b"".join(parts)
+            parts, size = [], ENVELOPE_HEADER.size
+        parts.append(packed)
+        size += len(packed)
+    if parts:
+        yield ENVELOPE_HEADER.pack(ENVELOPE_MAGIC, len(parts)) + b"".join(parts)
+
+
+def is_envelope(payload: Union[bytes, bytearray, memoryview]) -> bool:
+    """Return True if payload is created by data_pack_envelope() or data_pack_batches()"""
+    return bytes(payload[:2]) == ENVELOPE_MAGIC and len(payload) >= ENVELOPE_HEADER.size
+
+
+class Envelope(object):
+    """
+    Lazy reader for envelope frames. len() is available without unpacking,
+    messages are unpacked one at a time while iterating.
+    """
+
+    def __init__(self, payload: Union[bytes, bytearray, memoryview], datetimes: bool = False):
+        if not is_envelope(payload):
+            raise ValueError("Payload is not an envelope")
+        self.payload = memoryview(payload)
+        self.datetimes = datetimes
+        self.count = ENVELOPE_HEADER.unpack_from(self.payload)[1]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[dict]:
+        unpacker = msgpack.Unpacker(use_list=True, raw=False, strict_map_key=True, timestamp=3 if self.datetimes else 0)
+        unpacker.feed(self.payload[ENVELOPE_HEADER.size :])
+        for _ in range(self.count):
+            yield unpacker.unpack()
+
+
+def data_unpack_many(
+    payload: Union[bytes, bytearray, memoryview],
+    datetimes: bool = False,
+    unpack: Optional[Callable[[bytes], Any]] = None,
+) -> Iterator[dict]:
+    """
+    Unpack an envelope or a single data_pack()ed message. This lets consumers
+    handle both batched and unbatched producers transparently.
+
+    :param payload: packed envelope or message
+    :param datetimes: unpack msgpack Timestamps to aware datetimes, see data_unpack()
+    :param unpack: function to decode a single message (default data_unpack())
+    :return: Iterator of messages
+    """
+    if is_envelope(payload):
+        return iter(Envelope(payload, datetimes))
+    if unpack is not None:
+        return iter([unpack(payload)])
+    return iter([data_unpack(payload, datetimes)])
+
+
+_LEAF = object()
+
+
+class _PathsFound(Exception):
+    """Raised to stop walking when all requested paths are found"""
+
+
+def _resolve(value: Any, node: dict, results: list, remaining: list):
+    """Set results for all paths in `node` subtree from an already unpacked value"""
+    for key, child in node.items():
+        if key is _LEAF:
+            for i in child:
+                results[i] = value
+            remaining[0] -= len(child)
+            continue
+        try:
+            _resolve(value[key], child, results, remaining)
+        except (KeyError, IndexError, TypeError):
+            pass
+
+
+def _walk(unpacker: msgpack.Unpacker, node: dict, results: list, remaining: list):
+    """Walk msgpack map or array, unpack values of requested keys and skip everything else"""
+    try:
+        n = unpacker.read_map_header()
+        is_map = True
+    except ValueError:
+        try:
+            n = unpacker.read_array_header()
+            is_map = False
+        except ValueError:
+            unpacker.skip()
+            return
+    for i in range(n):
+        key = unpacker.unpack() if is_map else i
+        child = node.get(key)
+        if child is None:
+            unpacker.skip()
+        elif _LEAF in child:
+            _resolve(unpacker.unpack(), child, results, remaining)
+        else:
+            _walk(unpacker, child, results, remaining)
+        if remaining[0] <= 0:
+            raise _PathsFound()
+
+
+def data_unpack_paths(
+    message: Union[bytes, bytearray, memoryview],
+    paths: Sequence[Tuple[Union[str, int], ...]],
+    default: Any = None,
+    datetimes: bool = False,
+) -> list:
+    """
+    Unpack only values at given paths, e.g. [("device", "device_id"), ("request", "path")],
+    from a data_pack()ed message. Other subtrees (e.g. large request bodies) are skipped
+    without decoding them and walking stops as soon as all paths are found.
+    Integers in paths are list indexes.
+
+    :param message: packed message
+    :param paths: list of key tuples
+    :param default: value for paths which are not found
+    :param datetimes: unpack msgpack Timestamps to aware datetimes, see data_unpack()
+    :return: list of values in the same order as paths
+    """
+    trie: dict = {}
+    for i, path in enumerate(paths):
+        node = trie
+        for key in path:
+            node = node.setdefault(key, {})
+        node.setdefault(_LEAF, []).append(i)
+    results = [default] * len(paths)
+    remaining = [len(paths)]
+    if _LEAF in trie:  # empty path means the whole message
+        _resolve(data_unpack(message, datetimes), trie, results, remaining)
+        return results
+    unpacker = msgpack.Unpacker(use_list=True, raw=False, strict_map_key=True, timestamp=3 if datetimes else 0)
+    unpacker.feed(message)
+    try:
+        _walk(unpacker, trie, results, remaining)
+    except _PathsFound:
+        pass
+    return results
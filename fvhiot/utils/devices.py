@@ -0,0 +1,195 @@
+"""
+In-process cache for device registry lookups.
+
+Parser services need device's parser_module and device_state for every message.
+DeviceCache keeps recently used Devices in memory (TTL + LRU), remembers unknown
+device ids for a while (negative caching) and applies PatchDevice / StumpDevice
+messages from the device service so that only affected entries are touched.
+
+Usage:
+
+    cache = DeviceCache(loader=get_device_from_api, snapshot_path="/data/devices.json")
+    cache.load_snapshot()
+    ...
+    device = cache.get(device_id)  # None if the device is unknown
+    ...
+    cache.apply(patch_message)  # e.g. from a device update topic
+"""
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Optional, Union
+
+from pydantic import ValidationError
+
+from fvhiot.models.device import Device, PatchDevice, StumpDevice
+
+SNAPSHOT_VERSION = 1
+
+
+def _merge(base: dict, patch: dict) -> dict:
+    """Recursively merge patch dict into base dict"""
+    for k, v in patch.items():
+        if isinstance(v, dict) and isinstance(base.get(k), dict):
+            _merge(base[k], v)
+        else:
+            base[k] = v
+    return base
+
+
+class DeviceCache(object):
+    """
+    Device cache with TTL, bounded LRU size and negative caching.
+
+    :param loader: function which returns a Device (or a dict) or None if device is unknown
+    :param ttl: seconds a found device is kept in cache
+    :param negative_ttl: seconds an unknown device id is kept in cache, 0 disables negative caching
+    :param maxsize: maximum number of entries, the least recently used entry is evicted first
+    :param snapshot_path: default file for save_snapshot() and load_snapshot()
+    """
+
+    def __init__(
+        self,
+        loader: Optional[Callable[[str], Optional[Union[Device, dict]]]] = None,
+        ttl: float = 300,
+        negative_ttl: float = 60,
+        maxsize: int = 10000,
+        snapshot_path: Optional[str] = None,
+    ):
+        self.loader = loader
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self.snapshot_path = snapshot_path
+        # device_id -> (Device or None, expires at)
+        self._entries: collections.OrderedDict = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, device_id: str) -> bool:
+        return device_id in self._entries
+
+    def get(self, device_id: str) -> Optional[Device]:
+        """
+        Return Device from cache or from loader, if it is not cached or entry has expired.
+        Return None if device is unknown.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(device_id)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(device_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        if self.loader is None:
+            return None
+        device = self.loader(device_id)
+        if isinstance(device, dict):
+            device = Device.model_validate(device)
+        self.put(device_id, device)
+        return device
+
+    def put(self, device_id: str, device: Optional[Device]):
+        """Add a Device to cache, None marks device_id unknown"""
+        ttl = self.ttl if device is not None else self.negative_ttl
+        with self._lock:
+            if ttl <= 0:
+                self._entries.pop(device_id, None)
+                return
+            self._entries[device_id] = (device, time.monotonic() + ttl)
+            self._entries.move_to_end(device_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, device_id: Optional[str] = None):
+        """Remove one device or (if device_id is None) all devices from cache"""
+        with self._lock:
+            if device_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(device_id, None)
+
+    def apply(self, event: Union[PatchDevice, StumpDevice, dict]):
+        """
+        Apply an update message from the device service.
+        PatchDevice is merged into the cached Device (only explicitly set fields),
+        StumpDevice (and a PatchDevice for not cached or unknown device) removes the entry.
+        """
+        if isinstance(event, dict):
+            if "device_metadata" in event or "device_state" in event:
+                event = PatchDevice.model_validate(event)
+            else:
+                event = StumpDevice.model_validate(event)
+        device_id = event.device_id
+        if not isinstance(event, PatchDevice):
+            self.invalidate(device_id)
+            return
+        with self._lock:
+            entry = self._entries.get(device_id)
+            if entry is None or entry[0] is None:
+                self._entries.pop(device_id, None)
+                return
+            device = entry[0].model_dump()
+            try:
+                patched = Device.model_validate(_merge(device, event.model_dump(exclude_unset=True)))
+            except ValidationError as err:
+                logging.warning(f"Failed to patch cached device {device_id}, dropping it: {err}")
+                self._entries.pop(device_id, None)
+                return
+            self._entries[device_id] = (patched, entry[1])
+
+    def save_snapshot(self, path: Optional[str] = None) -> int:
+        """
+        Save known (not expired) devices to a JSON file, which can be loaded with load_snapshot().
+        The file is written atomically. Return number of saved devices.
+        Raise ValueError if neither `path` nor `snapshot_path` is given.
+        """
+        path = path or self.snapshot_path
+        if not path:
+            raise ValueError("No snapshot path given")
+        now = time.monotonic()
+        with self._lock:
+            devices = [e[0].model_dump(mode="json") for e in self._entries.values() if e[0] is not None and e[1] > now]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": SNAPSHOT_VERSION, "devices": devices}, f)
+        os.replace(tmp_path, path)
+        logging.info(f"Saved {len(devices)} devices to {path}")
+        return len(devices)
+
+    def load_snapshot(self, path: Optional[str] = None) -> int:
+        """
+        Warm up cache from a file created by save_snapshot(). Loaded devices get a fresh TTL.
+        Missing or invalid snapshot file is not an error, cache just starts cold.
+        Only the last `maxsize` devices are kept. Return number of loaded devices.
+        Raise ValueError if neither `path` nor `snapshot_path` is given.
+        """
+        path = path or self.snapshot_path
+        if not path:
+            raise ValueError("No snapshot path given")
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+            if snapshot.get("version") != SNAPSHOT_VERSION:
+                raise ValueError("Unsupported snapshot version: {}".format(snapshot.get("version")))
+            devices = [Device.model_validate(d) for d in snapshot["devices"]]
+        except FileNotFoundError:
+            logging.info(f"Device snapshot {path} not found, starting with empty cache")
+            return 0
+        except (ValueError, KeyError, TypeError, ValidationError) as err:
+            logging.warning(f"Failed to load device snapshot {path}: {err}")
+            return 0
+        devices = devices[-self.maxsize :]
+        for device in devices:
+            self.put(device.device_id, device)
+        logging.info(f"Loaded {len(devices)} devices from {path}")
+        return len(devices)
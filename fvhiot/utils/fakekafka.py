@@ -0,0 +1,682 @@
+"""
+In-memory Kafka stand-in for tests and offline benchmarks.
+
+FakeBroker keeps topics, partitions, offsets and committed offsets of consumer groups
+in process memory. FakeKafkaProducer and FakeKafkaConsumer mimic kafka-python's
+KafkaProducer and KafkaConsumer, FakeAIOKafkaProducer and FakeAIOKafkaConsumer
+aiokafka's AIOKafkaProducer and AIOKafkaConsumer, closely enough for the helpers
+in fvhiot.utils.kafka and fvhiot.utils.aiokafka.
+
+Select the memory backend with KAFKA_BACKEND=memory environment variable or `backend="memory"`
+argument of get_kafka_producer(), get_kafka_consumer(), get_aiokafka_producer() and
+get_aiokafka_consumer(). All clients share the default broker (see get_broker()),
+unless a `broker` argument is given.
+
+Differences to a real broker:
+- topics are created on first use with KAFKA_MEMORY_PARTITIONS (default 1) partitions
+- keyed messages are partitioned with CRC32 of the key, not Kafka's murmur2
+- group members get new assignments on their next poll after a member joins or leaves,
+  there is no generation fencing or session timeout
+- messages are never deleted
+"""
+
+import asyncio
+import dataclasses
+import inspect
+import itertools
+import os
+import threading
+import time
+import zlib
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+try:
+    from kafka.consumer.fetcher import ConsumerRecord as KafkaConsumerRecord
+    from kafka.producer.future import RecordMetadata as KafkaRecordMetadata
+    from kafka.structs import OffsetAndTimestamp as KafkaOffsetAndTimestamp
+    from kafka.structs import TopicPartition as KafkaTopicPartition
+except ImportError:  # kafka-python is needed only for the sync classes
+    KafkaTopicPartition = None
+
+try:
+    from aiokafka.structs import ConsumerRecord as AIOConsumerRecord
+    from aiokafka.structs import OffsetAndTimestamp as AIOOffsetAndTimestamp
+    from aiokafka.structs import RecordMetadata as AIORecordMetadata
+    from aiokafka.structs import TopicPartition as AIOTopicPartition
+except ImportError:  # aiokafka is needed only for the async classes
+    AIOTopicPartition = None
+
+BACKENDS = ("kafka", "memory")
+
+
+def use_memory_backend(backend: Optional[str] = None) -> bool:
+    """Return True if `backend` (default from KAFKA_BACKEND env) is "memory" """
+    backend = (backend or os.getenv("KAFKA_BACKEND") or "kafka").lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown Kafka backend '{backend}', must be one of {list(BACKENDS)}")
+    return backend == "memory"
+
+
+def _make(cls, **values):
+    """Create a namedtuple or dataclass instance, ignoring fields the class doesn't have"""
+    fields = getattr(cls, "_fields", None) or [f.name for f in dataclasses.fields(cls)]
+    return cls(**{name: values.get(name) for name in fields})
+
+
+def _size(data: Optional[bytes]) -> int:
+    return -1 if data is None else len(data)
+
+
+class _Record(object):
+    __slots__ = ("offset", "timestamp", "key", "value", "headers")
+
+    def __init__(self, offset: int, timestamp: int, key: Optional[bytes], value: Optional[bytes], headers: list):
+        self.offset = offset
+        self.timestamp = timestamp
+        self.key = key
+        self.value = value
+        self.headers = headers
+
+
+class FakeBroker(object):
+    """
+    In-memory broker: topics with partitions of records, committed offsets of consumer groups
+    and group membership. All methods are thread safe.
+
+    :param partitions: number of partitions of automatically created topics
+    """
+
+    def __init__(self, partitions: Optional[int] = None):
+        self.partitions = partitions or int(os.getenv("KAFKA_MEMORY_PARTITIONS", "1"))
+        self.topics: Dict[str, List[List[_Record]]] = {}
+        self.committed: Dict[tuple, int] = {}  # (group_id, topic, partition) -> offset
+        self.groups: Dict[str, list] = {}  # group_id -> member consumers in join order
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+
+    def create_topic(self, topic: str, partitions: Optional[int] = None):
+        """Create topic, if it doesn't exist"""
+        with self._lock:
+            if topic not in self.topics:
+                self.topics[topic] = [[] for _ in range(partitions or self.partitions)]
+
+    def partitions_for(self, topic: str) -> set:
+        self.create_topic(topic)
+        return set(range(len(self.topics[topic])))
+
+    def append(
+        self,
+        topic: str,
+        partition: Optional[int],
+        key: Optional[bytes],
+        value: Optional[bytes],
+        timestamp_ms: Optional[int] = None,
+        headers: Optional[list] = None,
+        counter: Optional[Iterable[int]] = None,
+    ) -> tuple:
+        """Append a record and return (partition, offset, timestamp)"""
+        with self._lock:
+            self.create_topic(topic)
+            partitions = self.topics[topic]
+            if partition is None:
+                if key is not None:
+                    partition = zlib.crc32(key) % len(partitions)
+                else:
+                    partition = next(counter) % len(partitions) if counter is not None else 0
+            if not 0 <= partition < len(partitions):
+                raise ValueError(f"Unknown partition {topic}/{partition}")
+            timestamp = int(time.time() * 1000) if timestamp_ms is None else timestamp_ms
+            log = partitions[partition]
+            log.append(_Record(len(log), timestamp, key, value, headers or []))
+            self._changed.notify_all()
+            return partition, len(log) - 1, timestamp
+
+    def read(self, topic: str, partition: int, offset: int, max_records: int) -> List[_Record]:
+        with self._lock:
+            return self.topics[topic][partition][offset : offset + max_records]
+
+    def end_offset(self, topic: str, partition: int) -> int:
+        with self._lock:
+            return len(self.topics[topic][partition])
+
+    def offset_for_time(self, topic: str, partition: int, timestamp: int) -> Optional[_Record]:
+        with self._lock:
+            for record in self.topics[topic][partition]:
+                if record.timestamp >= timestamp:
+                    return record
+        return None
+
+    def wait(self, timeout: float):
+        """Wait until a record is appended or group membership changes"""
+        with self._changed:
+            self._changed.wait(timeout)
+
+    def join(self, group_id: str, member):
+        with self._lock:
+            members = self.groups.setdefault(group_id, [])
+            if member not in members:
+                members.append(member)
+                self._changed.notify_all()
+
+    def leave(self, group_id: str, member):
+        with self._lock:
+            if member in self.groups.get(group_id, []):
+                self.groups[group_id].remove(member)
+                self._changed.notify_all()
+
+    def assignment_for(self, group_id: Optional[str], member, topics: Iterable[str]) -> List[tuple]:
+        """
+        Return [(topic, partition), ...] assigned to member: partitions of each topic are
+        distributed round-robin among the group members subscribed to the topic.
+        """
+        with self._lock:
+            assigned = []
+            for topic in sorted(topics):
+                partitions = sorted(self.partitions_for(topic))
+                if group_id is None:
+                    assigned.extend((topic, p) for p in partitions)
+                    continue
+                members = [m for m in self.groups.get(group_id, []) if topic in m._subscription]
+                index = members.index(member)
+                assigned.extend((topic, p) for p in partitions[index :: len(members)])
+            return assigned
+
+    def commit(self, group_id: str, topic: str, partition: int, offset: int):
+        with self._lock:
+            self.committed[(group_id, topic, partition)] = offset
+
+    def committed_offset(self, group_id: Optional[str], topic: str, partition: int) -> Optional[int]:
+        with self._lock:
+            return self.committed.get((group_id, topic, partition))
+
+
+_default_broker = FakeBroker()
+
+
+def get_broker() -> FakeBroker:
+    """Return the default broker shared by all clients"""
+    return _default_broker
+
+
+def reset_broker(partitions: Optional[int] = None) -> FakeBroker:
+    """Replace the default broker with an empty one (e.g. between tests) and return it"""
+    global _default_broker
+    _default_broker = FakeBroker(partitions)
+    return _default_broker
+
+
+class _FakeProducerBase(object):
+    def __init__(
+        self,
+        broker: Optional[FakeBroker] = None,
+        key_serializer: Optional[Callable] = None,
+        value_serializer: Optional[Callable] = None,
+        **kwargs,
+    ):
+        self.broker = broker or get_broker()
+        self.key_serializer = key_serializer
+        self.value_serializer = value_serializer
+        self._counter = itertools.count()
+
+    def _append(self, topic, value, key, partition, timestamp_ms, headers) -> dict:
+        if self.key_serializer is not None and key is not None:
+            key = self.key_serializer(key)
+        if self.value_serializer is not None and value is not None:
+            value = self.value_serializer(value)
+        partition, offset, timestamp = self.broker.append(
+            topic, partition, key, value, timestamp_ms, headers, self._counter
+        )
+        return {
+            "topic": topic,
+            "partition": partition,
+            "offset": offset,
+            "timestamp": timestamp,
+            "timestamp_type": 0,
+            "log_start_offset": 0,
+            "serialized_key_size": _size(key),
+            "serialized_value_size": _size(value),
+            "serialized_header_size": -1,
+        }
+
+
+class _FakeFuture(object):
+    """Already resolved future, like kafka-python's FutureRecordMetadata"""
+
+    def __init__(self, value=None, exception: Optional[BaseException] = None):
+        self.value = value
+        self.exception = exception
+        self.is_done = True
+
+    def succeeded(self) -> bool:
+        return self.exception is None
+
+    def failed(self) -> bool:
+        return self.exception is not None
+
+    def get(self, timeout=None):
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+    def add_callback(self, f, *args, **kwargs):
+        if self.exception is None:
+            f(*args, self.value, **kwargs)
+        return self
+
+    def add_errback(self, f, *args, **kwargs):
+        if self.exception is not None:
+            f(*args, self.exception, **kwargs)
+        return self
+
+
+class FakeKafkaProducer(_FakeProducerBase):
+    """In-memory replacement for kafka-python's KafkaProducer, connection arguments are ignored"""
+
+    def send(self, topic, value=None, key=None, headers=None, partition=None, timestamp_ms=None) -> _FakeFuture:
+        try:
+            values = self._append(topic, value, key, partition, timestamp_ms, headers)
+        except Exception as err:
+            return _FakeFuture(exception=err)
+        tp = KafkaTopicPartition(topic, values["partition"])
+        return _FakeFuture(_make(KafkaRecordMetadata, topic_partition=tp, **values))
+
+    def partitions_for(self, topic: str) -> set:
+        return self.broker.partitions_for(topic)
+
+    def flush(self, timeout=None):
+        pass
+
+    def close(self, timeout=None):
+        pass
+
+
+class _FakeBatch(object):
+    """Batch returned by FakeAIOKafkaProducer.create_batch()"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.records: list = []
+        self._size = 0
+
+    def append(self, *, timestamp, key, value, headers=()):
+        size = max(_size(key), 0) + max(_size(value), 0) + 32
+        if self.records and self._size + size > self.max_size:
+            return None
+        self.records.append((timestamp, key, value, list(headers)))
+        self._size += size
+        return self
+
+    def record_count(self) -> int:
+        return len(self.records)
+
+
+class FakeAIOKafkaProducer(_FakeProducerBase):
+    """In-memory replacement for aiokafka's AIOKafkaProducer, connection arguments are ignored"""
+
+    def __init__(self, *args, max_batch_size: int = 16384, **kwargs):
+        super().__init__(**kwargs)
+        self.max_batch_size = max_batch_size
+
+    def _metadata(self, values: dict):
+        tp = AIOTopicPartition(values["topic"], values["partition"])
+        return _make(AIORecordMetadata, topic_partition=tp, **values)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def flush(self):
+        pass
+
+    async def partitions_for(self, topic: str) -> set:
+        return self.broker.partitions_for(topic)
+
+    async def send(self, topic, value=None, key=None, partition=None, timestamp_ms=None, headers=None):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(self._metadata(self._append(topic, value, key, partition, timestamp_ms, headers)))
+        return future
+
+    async def send_and_wait(self, topic, value=None, key=None, partition=None, timestamp_ms=None, headers=None):
+        return await (await self.send(topic, value, key, partition, timestamp_ms, headers))
+
+    def create_batch(self) -> _FakeBatch:
+        return _FakeBatch(self.max_batch_size)
+
+    async def send_batch(self, batch: _FakeBatch, topic: str, *, partition: int):
+        metadata = None
+        for timestamp, key, value, headers in batch.records:
+            values = self.broker.append(topic, partition, key, value, timestamp, headers)
+            if metadata is None:  # Like Kafka, batch's metadata has the offset of its first record
+                metadata = {"topic": topic, "partition": values[0], "offset": values[1], "timestamp": values[2]}
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(self._metadata(metadata or {"topic": topic, "partition": partition, "offset": -1}))
+        return future
+
+
+class _FakeConsumerBase(object):
+    """Consumer state shared by sync and async fake consumers"""
+
+    _tp_class: Any = None
+    _record_class: Any = None
+    _offset_and_timestamp_class: Any = None
+
+    def __init__(
+        self,
+        *topics,
+        group_id: Optional[str] = None,
+        auto_offset_reset: str = "latest",
+        enable_auto_commit: bool = False,
+        key_deserializer: Optional[Callable] = None,
+        value_deserializer: Optional[Callable] = None,
+        broker: Optional[FakeBroker] = None,
+        **kwargs,
+    ):
+        self.broker = broker or get_broker()
+        self.group_id = group_id
+        self.auto_offset_reset = auto_offset_reset
+        self.enable_auto_commit = enable_auto_commit
+        self.key_deserializer = key_deserializer
+        self.value_deserializer = value_deserializer
+        self._subscription: set = set()
+        self._listener = None
+        self._assignment: list = []
+        self._positions: Dict[Any, Optional[int]] = {}
+        self._paused: set = set()
+        if topics:
+            self.subscribe(list(topics))
+
+    # Subscription and assignment
+
+    def subscribe(self, topics: List[str] = (), pattern=None, listener=None):
+        if pattern is not None:
+            raise NotImplementedError("Pattern subscriptions are not supported by the memory backend")
+        self._subscription = set(topics)
+        self._listener = listener
+        for topic in self._subscription:
+            self.broker.create_topic(topic)
+        if self.group_id is not None:
+            self.broker.join(self.group_id, self)
+
+    def subscription(self) -> set:
+        return set(self._subscription)
+
+    def unsubscribe(self):
+        if self.group_id is not None:
+            self.broker.leave(self.group_id, self)
+        self._subscription = set()
+        self._set_assignment([])
+
+    def assign(self, partitions: List[Any]):
+        if self._subscription:
+            raise RuntimeError("Subscription to topics and manual assignment are mutually exclusive")
+        self._set_assignment(list(partitions))
+
+    def assignment(self) -> set:
+        return set(self._assignment)
+
+    def _set_assignment(self, tps: list):
+        self._assignment = tps
+        self._positions = {tp: self._positions.get(tp) for tp in tps}
+        self._paused &= set(tps)
+        for tp in tps:
+            self._position(tp)  # Reset position on assignment, like the fetcher of a real consumer
+
+    def _rebalance(self) -> Optional[tuple]:
+        """Update assignment of a subscribed consumer, return (revoked, assigned) if it changed"""
+        if not self._subscription:
+            return None
+        assigned = [
+            self._tp_class(t, p) for t, p in self.broker.assignment_for(self.group_id, self, self._subscription)
+        ]
+        if assigned == self._assignment:
+            return None
+        revoked = self._assignment
+        return revoked, assigned
+
+    # Offsets
+
+    def partitions_for_topic(self, topic: str) -> set:
+        return self.broker.partitions_for(topic)
+
+    def _position(self, tp) -> int:
+        if self._positions.get(tp) is None:
+            committed = self.broker.committed_offset(self.group_id, tp.topic, tp.partition)
+            if committed is not None:
+                self._positions[tp] = committed
+            elif self.auto_offset_reset == "earliest":
+                self._positions[tp] = 0
+            else:
+                self._positions[tp] = self.broker.end_offset(tp.topic, tp.partition)
+        return self._positions[tp]
+
+    def seek(self, partition, offset: int):
+        if partition not in self._positions:
+            raise RuntimeError(f"No current assignment for partition {partition}")
+        self._positions[partition] = offset
+
+    def _seek_to(self, partitions, end: bool):
+        for tp in partitions or self._assignment:
+            self.seek(tp, self.broker.end_offset(tp.topic, tp.partition) if end else 0)
+
+    def highwater(self, partition) -> Optional[int]:
+        return self.broker.end_offset(partition.topic, partition.partition)
+
+    def _end_offsets(self, partitions) -> dict:
+        return {tp: self.broker.end_offset(tp.topic, tp.partition) for tp in partitions}
+
+    def _offsets_for_times(self, timestamps: dict) -> dict:
+        found = {}
+        for tp, timestamp in timestamps.items():
+            record = self.broker.offset_for_time(tp.topic, tp.partition, timestamp)
+            found[tp] = None
+            if record is not None:
+                found[tp] = _make(self._offset_and_timestamp_class, offset=record.offset, timestamp=record.timestamp)
+        return found
+
+    def _commit(self, offsets: Optional[dict] = None):
+        if self.group_id is None:
+            raise RuntimeError("Committing offsets requires group_id")
+        if offsets is None:
+            offsets = {tp: self._position(tp) for tp in self._assignment}
+        for tp, offset in offsets.items():
+            self.broker.commit(self.group_id, tp.topic, tp.partition, getattr(offset, "offset", offset))
+
+    def _committed(self, partition) -> Optional[int]:
+        return self.broker.committed_offset(self.group_id, partition.topic, partition.partition)
+
+    # Fetching
+
+    def pause(self, *partitions):
+        self._paused.update(partitions)
+
+    def resume(self, *partitions):
+        self._paused.difference_update(partitions)
+
+    def paused(self) -> set:
+        return set(self._paused)
+
+    def _fetch(self, max_records: int, partitions=None) -> dict:
+        result = {}
+        remaining = max_records
+        for tp in partitions or self._assignment:
+            if remaining <= 0:
+                break
+            if tp in self._paused or tp not in self._positions:
+                continue
+            records = self.broker.read(tp.topic, tp.partition, self._position(tp), remaining)
+            if not records:
+                continue
+            result[tp] = [self._consumer_record(tp, r) for r in records]
+            self._positions[tp] = records[-1].offset + 1
+            remaining -= len(records)
+        if result and self.enable_auto_commit and self.group_id is not None:
+            self._commit()
+        return result
+
+    def _consumer_record(self, tp, record: _Record):
+        key, value = record.key, record.value
+        if self.key_deserializer is not None and key is not None:
+            key = self.key_deserializer(key)
+        if self.value_deserializer is not None and value is not None:
+            value = self.value_deserializer(value)
+        return _make(
+            self._record_class,
+            topic=tp.topic,
+            partition=tp.partition,
+            leader_epoch=-1,
+            offset=record.offset,
+            timestamp=record.timestamp,
+            timestamp_type=0,
+            key=key,
+            value=value,
+            headers=record.headers,
+            serialized_key_size=_size(record.key),
+            serialized_value_size=_size(record.value),
+            serialized_header_size=-1,
+        )
+
+
+class FakeKafkaConsumer(_FakeConsumerBase):
+    """In-memory replacement for kafka-python's KafkaConsumer, connection arguments are ignored"""
+
+    if KafkaTopicPartition is not None:
+        _tp_class = KafkaTopicPartition
+        _record_class = KafkaConsumerRecord
+        _offset_and_timestamp_class = KafkaOffsetAndTimestamp
+
+    def _update_assignment(self):
+        change = self._rebalance()
+        if change is None:
+            return
+        revoked, assigned = change
+        if self._listener is not None and revoked:
+            self._listener.on_partitions_revoked(set(revoked))
+        self._set_assignment(assigned)
+        if self._listener is not None:
+            self._listener.on_partitions_assigned(set(assigned))
+
+    def poll(self, timeout_ms: int = 0, max_records: Optional[int] = None, update_offsets: bool = True) -> dict:
+        deadline = time.monotonic() + timeout_ms / 1000
+        while True:
+            self._update_assignment()
+            records = self._fetch(max_records or 500)
+            remaining = deadline - time.monotonic()
+            if records or remaining <= 0:
+                return records
+            self.broker.wait(remaining)
+
+    def topics(self) -> set:
+        return set(self.broker.topics)
+
+    def position(self, partition) -> int:
+        return self._position(partition)
+
+    def seek_to_beginning(self, *partitions):
+        self._seek_to(partitions, end=False)
+
+    def seek_to_end(self, *partitions):
+        self._seek_to(partitions, end=True)
+
+    def end_offsets(self, partitions) -> dict:
+        return self._end_offsets(partitions)
+
+    def beginning_offsets(self, partitions) -> dict:
+        return {tp: 0 for tp in partitions}
+
+    def offsets_for_times(self, timestamps: dict) -> dict:
+        return self._offsets_for_times(timestamps)
+
+    def commit(self, offsets: Optional[dict] = None):
+        self._commit(offsets)
+
+    def committed(self, partition, metadata: bool = False) -> Optional[int]:
+        return self._committed(partition)
+
+    def close(self, autocommit: bool = True, timeout_ms=None):
+        if autocommit and self.enable_auto_commit and self.group_id is not None:
+            self._commit()
+        self.unsubscribe()
+
+
+class FakeAIOKafkaConsumer(_FakeConsumerBase):
+    """In-memory replacement for aiokafka's AIOKafkaConsumer, connection arguments are ignored"""
+
+    if AIOTopicPartition is not None:
+        _tp_class = AIOTopicPartition
+        _record_class = AIOConsumerRecord
+        _offset_and_timestamp_class = AIOOffsetAndTimestamp
+
+    async def start(self):
+        await self._update_assignment()
+
+    async def stop(self):
+        if self.enable_auto_commit and self.group_id is not None:
+            self._commit()
+        self.unsubscribe()
+
+    async def _call_listener(self, method: str, tps: list):
+        if self._listener is not None:
+            result = getattr(self._listener, method)(set(tps))
+            if inspect.isawaitable(result):
+                await result
+
+    async def _update_assignment(self):
+        change = self._rebalance()
+        if change is None:
+            return
+        revoked, assigned = change
+        if revoked:
+            await self._call_listener("on_partitions_revoked", revoked)
+        self._set_assignment(assigned)
+        await self._call_listener("on_partitions_assigned", assigned)
+
+    async def getmany(self, *partitions, timeout_ms: int = 0, max_records: Optional[int] = None) -> dict:
+        deadline = time.monotonic() + timeout_ms / 1000
+        while True:
+            await self._update_assignment()
+            records = self._fetch(max_records or 500, partitions)
+            remaining = deadline - time.monotonic()
+            if records or remaining <= 0:
+                return records
+            await asyncio.sleep(min(remaining, 0.005))
+
+    async def getone(self, *partitions):
+        while True:
+            records = await self.getmany(*partitions, timeout_ms=1000, max_records=1)
+            for partition_records in records.values():
+                return partition_records[0]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.getone()
+
+    async def topics(self) -> set:
+        return set(self.broker.topics)
+
+    async def position(self, partition) -> int:
+        return self._position(partition)
+
+    async def seek_to_beginning(self, *partitions):
+        self._seek_to(partitions, end=False)
+
+    async def seek_to_end(self, *partitions):
+        self._seek_to(partitions, end=True)
+
+    async def end_offsets(self, partitions) -> dict:
+        return self._end_offsets(partitions)
+
+    async def beginning_offsets(self, partitions) -> dict:
+        return {tp: 0 for tp in partitions}
+
+    async def offsets_for_times(self, timestamps: dict) -> dict:
+        return self._offsets_for_times(timestamps)
+
+    async def commit(self, offsets: Optional[dict] = None):
+        self._commit(offsets)
+
+    async def committed(self, partition) -> Optional[int]:
+        return self._committed(partition)
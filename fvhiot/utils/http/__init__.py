@@ -6,7 +6,7 @@ def validate_data_from_request(data: dict) -> bool:
     :return:
     """
     # Check that mandatory keys are present in data
-    for k in ["timestamp", "path", "url", "shceme", "request"]:
+    for k in ["timestamp", "path", "url", "scheme", "request"]:
         if k not in data:
             return False
     # Check that mandatory keys are present data["request"]
@@ -4,18 +4,36 @@ from starlette.datastructures import UploadFile
 from starlette.requests import Request
 
 from fvhiot.models.requests import RequestModel
+from fvhiot.utils.http import validate_data_from_request
 import logging
+from typing import Union
 from pydantic import ValidationError
 
+EXTRACT_MODES = ("dict", "model", "original", "light")
 
-async def extract_data_from_starlette_request(request: Request) -> dict:
+
+async def extract_data_from_starlette_request(request: Request, mode: str = "dict") -> Union[dict, RequestModel]:
     """
     Extract all available data from `starlette.requests.Request` and put it into a dict.
     NOTE: all other extractors (e.g. Django) should follow this structure.
 
+    `mode` controls validation and the return value:
+    - "dict": validate with RequestModel and return model_dump() of it (a copy of the data)
+    - "model": validate with RequestModel and return the model itself
+    - "original": validate with RequestModel and return the original dict, without copying it
+    - "light": check only that mandatory keys are present and return the original dict,
+      meant for known-good internal traffic
+
+    If validation fails, mode "model" raises pydantic.ValidationError,
+    while modes "dict" and "original" log the error and return the original dict.
+
     :param request: starlette.requests.Request
-    :return: dict containing request data
+    :param mode: one of "dict", "model", "original" or "light"
+    :return: dict (RequestModel in mode "model") containing request data
+    :raises pydantic.ValidationError: if validation fails in mode "model"
     """
+    if mode not in EXTRACT_MODES:
+        raise ValueError(f"Invalid mode '{mode}', must be one of {EXTRACT_MODES}")
     data = {
         "timestamp": datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
         "path": request.url.path,
@@ -44,10 +62,21 @@ async def extract_data_from_starlette_request(request: Request) -> dict:
     if data["request"]["post"] == {} and data["request"]["files"] == {}:
         data["request"]["body"] = await request.body()
     # Validate data
+    if mode == "light":
+        if not validate_data_from_request(data):
+            logging.error("Serialized request data is missing mandatory keys")
+            logging.debug(data)
+        return data
     try:
-        request_data = RequestModel(**data)
-        return request_data.dict()
+        request_data = RequestModel.model_validate(data)
+        if mode == "model":
+            return request_data
+        elif mode == "original":
+            return data
+        return request_data.model_dump()
     except ValidationError:
         logging.exception("Failed to validate serialized request data")
         logging.debug(data)
+        if mode == "model":
+            raise
         return data
@@ -1,11 +1,25 @@
 from __future__ import annotations  # Python 3.9 compatibility
 
+import abc
+import atexit
+import collections
+import datetime
 import logging
 import os
+import queue
+import threading
+import time
+import weakref
+from typing import Any, Callable, Iterable, Iterator, Optional
 
 import certifi
-from kafka import KafkaConsumer, KafkaProducer, TopicPartition
+from kafka import ConsumerRebalanceListener, KafkaConsumer, KafkaProducer, TopicPartition
 from kafka.errors import NoBrokersAvailable
+from kafka.structs import OffsetAndMetadata
+
+from fvhiot.utils.data import data_pack, data_pack_batches, data_unpack, data_unpack_many
+from fvhiot.utils.fakekafka import FakeKafkaConsumer, FakeKafkaProducer, use_memory_backend
+from fvhiot.utils.kafkatools import LagMonitor, dead_letter, device_key, get_producer_settings, partition_for_device
 
 
 # New try 03/2022 here:
@@ -20,11 +34,17 @@ def get_kafka_producer(
     sasl_mechanism: str = None,
     sasl_plain_username: str = None,
     sasl_plain_password: str = None,
+    backend: Optional[str] = None,
+    **kwargs,
 ) -> KafkaProducer:
     """
     Simply create and return a KafkaProducer using given arguments.
+    Extra keyword arguments (e.g. from get_producer_settings()) are passed to KafkaProducer.
+    With `backend` (default from KAFKA_BACKEND env) "memory" return an in-memory
+    FakeKafkaProducer instead, see fvhiot.utils.fakekafka.
     """
-    return KafkaProducer(
+    producer_class = FakeKafkaProducer if use_memory_backend(backend) else KafkaProducer
+    return producer_class(
         bootstrap_servers=bootstrap_servers,
         security_protocol=security_protocol,
         # ssl_check_hostname=self.app.config.get('ssl_check_hostname'],
@@ -34,10 +54,11 @@ def get_kafka_producer(
         sasl_mechanism=sasl_mechanism,
         sasl_plain_username=sasl_plain_username,
         sasl_plain_password=sasl_plain_password,
+        **kwargs,
     )
 
 
-def get_kafka_producer_by_envs():
+def get_kafka_producer_by_envs(profile: Optional[str] = None, **kwargs):
     """
     Create and return Kafkaproducer, which is initialized by values from environment variables.
     At least these variables must usually be defined to make the connection to brokers:
@@ -46,8 +67,12 @@ def get_kafka_producer_by_envs():
     KAFKA_BOOTSTRAP_SERVERS
     KAFKA_SECURITY_PROTOCOL
     KAFKA_SASL_MECHANISMS
+    Batching settings come from `profile` or KAFKA_PRODUCER_PROFILE and KAFKA_PRODUCER_* envs,
+    see fvhiot.utils.kafkatools.get_producer_settings(). `kwargs` override them.
     """
     logging.info("Getting KafkaProducer: {}".format(os.getenv("KAFKA_BOOTSTRAP_SERVERS")))
+    settings = get_producer_settings(profile)
+    settings.update(kwargs)
     try:
         kc = get_kafka_producer(
             bootstrap_servers=os.getenv("KAFKA_BOOTSTRAP_SERVERS", "").split(","),
@@ -58,6 +83,7 @@ def get_kafka_producer_by_envs():
             sasl_mechanism=os.getenv("KAFKA_SASL_MECHANISMS"),
             sasl_plain_username=os.getenv("KAFKA_SASL_USERNAME"),
             sasl_plain_password=os.getenv("KAFKA_SASL_PASSWORD"),
+            **settings,
         )
         return kc
     except NoBrokersAvailable as err:
@@ -78,14 +104,19 @@ def get_kafka_consumer(
     group_id: str = None,
     enable_auto_commit: bool = False,
     offset: int = 0,
+    backend: Optional[str] = None,
 ):
     """
     Simply create and return a KafkaConsumer using given arguments.
     Use seek_to_offset() to subscribe to given topic(s) and seek to default offset 0
+
+    With `backend` (default from KAFKA_BACKEND env) "memory" return an in-memory
+    FakeKafkaConsumer instead, see fvhiot.utils.fakekafka.
     """
+    consumer_class = FakeKafkaConsumer if use_memory_backend(backend) else KafkaConsumer
     if offset != 0:
         logging.info(f"Creating KafkaConsumer with group_id '{group_id}' and seeking to offset {offset}")
-        kc = KafkaConsumer(
+        kc = consumer_class(
             bootstrap_servers=bootstrap_servers,
             security_protocol=security_protocol,
             ssl_cafile=ssl_cafile or certifi.where(),
@@ -100,7 +131,7 @@ def get_kafka_consumer(
         seek_to_offset(kc, topic, offset)
     else:
         logging.info(f"Creating KafkaConsumer with group_id '{group_id}' and not seeking")
-        kc = KafkaConsumer(
+        kc = consumer_class(
             bootstrap_servers=bootstrap_servers,
             security_protocol=security_protocol,
             ssl_cafile=ssl_cafile or certifi.where(),
@@ -152,26 +183,482 @@ def get_kafka_consumer_by_envs(topic: str | list[str], offset: int = 0):
         return None
 
 
-def seek_to_offset(consumer: KafkaConsumer, topic: str, start: int = 0):
+def seek_to_offset(consumer: KafkaConsumer, topic: str | list[str], start: int = 0):
     """
-    Seek to a message in topic. `start` must be negative integer or zero (no effect)
+    Seek to a message in topic. `start` must be negative integer or zero (seek to the end).
+    All partitions are assigned and every partition is seeked `-start` messages before its end.
     """
-    # topic = os.getenv("KAFKA_RAW_DATA_TOPIC_NAME")
     assert start <= 0
-    partition_number, offset = -1, -1
-    # Loop through partitions and find the latest offset
-    for p in consumer.partitions_for_topic(topic):
-        tp = TopicPartition(topic, p)
-        consumer.assign([tp])
-        # committed = consumer.committed(tp)
-        consumer.seek_to_end(tp)
-        last_offset = consumer.position(tp)
-        # print("topic: {} partition: {} committed: {} last: {}".format(topic, p, committed, last_offset))
-        if offset < last_offset:
-            offset = last_offset
-            partition_number = p
-    tp = TopicPartition(topic, partition_number)
-    consumer.seek(tp, offset + start)
+    seek_partitions(consumer, topic, last=-start)
+
+
+def seek_partitions(
+    consumer: KafkaConsumer,
+    topic: str | list[str],
+    last: Optional[int] = None,
+    since: Optional[datetime.datetime | int] = None,
+    offsets: Optional[dict[int | TopicPartition, int]] = None,
+) -> dict[TopicPartition, int]:
+    """
+    Assign all partitions of topic(s) to consumer at once and seek every partition to
+    - `last` messages before the end of the partition, or
+    - the first message at or after `since` (aware datetime or epoch milliseconds), or
+    - explicit `offsets` ({partition number or TopicPartition: offset}, negative offset counts
+      from the end of the partition). Partitions missing from `offsets` are not seeked.
+    Targets of `last` and `offsets` are clamped to the beginning and end of the partition.
+    End and beginning offsets (and offsets for times) are fetched for all partitions in one request.
+
+    :return: dict of seeked offsets
+    """
+    if sum(x is not None for x in (last, since, offsets)) != 1:
+        raise ValueError("Give exactly one of last, since or offsets")
+    topics = [topic] if isinstance(topic, str) else list(topic)
+    tps = [TopicPartition(t, p) for t in topics for p in sorted(consumer.partitions_for_topic(t) or [])]
+    consumer.assign(tps)
+    if not tps:
+        logging.warning(f"No partitions found for topic(s) {topics}")
+        return {}
+    ends = consumer.end_offsets(tps)
+    if last is not None:
+        assert last >= 0
+        beginnings = consumer.beginning_offsets(tps)
+        targets = {tp: max(beginnings[tp], ends[tp] - last) for tp in tps}
+    elif since is not None:
+        if isinstance(since, datetime.datetime):
+            since = int(since.timestamp() * 1000)
+        found = consumer.offsets_for_times({tp: since for tp in tps})
+        # Partitions without messages after `since` are seeked to the end
+        targets = {tp: found[tp].offset if found.get(tp) is not None else ends[tp] for tp in tps}
+    else:
+        beginnings = consumer.beginning_offsets(tps)
+        targets = {}
+        for key, offset in offsets.items():
+            if isinstance(key, TopicPartition):
+                tp = key
+            elif len(topics) == 1:
+                tp = TopicPartition(topics[0], key)
+            else:
+                raise ValueError("Use TopicPartitions as offsets keys with many topics")
+            if tp not in ends:
+                raise ValueError(f"Unknown partition {tp}")
+            target = ends[tp] + offset if offset < 0 else offset
+            targets[tp] = min(max(beginnings[tp], target), ends[tp])
+    for tp, offset in targets.items():
+        consumer.seek(tp, offset)
+    logging.info(
+        "Seeked to offsets {}".format(", ".join(f"{tp.topic}/{tp.partition}:{o}" for tp, o in targets.items()))
+    )
+    return targets
+
+
+def offset_and_metadata(offset: int) -> OffsetAndMetadata:
+    """
+    Return OffsetAndMetadata for consumer.commit(). kafka-python 2.1 added leader_epoch field.
+    """
+    if "leader_epoch" in OffsetAndMetadata._fields:
+        return OffsetAndMetadata(offset, "", -1)
+    return OffsetAndMetadata(offset, "")
+
+
+def consume_batches(
+    consumer: KafkaConsumer,
+    max_records: int = 500,
+    timeout_ms: int = 1000,
+    unpack: Optional[Callable[[bytes], Any]] = data_unpack,
+) -> Iterator[tuple[TopicPartition, list]]:
+    """
+    Poll messages from consumer and yield them as (TopicPartition, list of messages) batches.
+    Message values are decoded with `unpack` (None yields values as is) and envelopes
+    (see send_envelopes()) are flattened to the messages they contain.
+    Partition's offset is committed after the caller has processed the batch,
+    i.e. when the next batch is requested. If the caller stops iterating in the middle
+    of a batch (e.g. an exception is raised), the batch is not committed.
+
+    Usage:
+
+        for tp, messages in consume_batches(consumer, max_records=1000):
+            collection.insert_many(messages)
+
+    :param consumer: KafkaConsumer with enable_auto_commit=False
+    :param max_records: maximum number of records returned by one poll()
+    :param timeout_ms: poll() timeout in milliseconds
+    :param unpack: function to decode message value
+    :return: Iterator of (TopicPartition, messages) tuples
+    """
+    while True:
+        records = consumer.poll(timeout_ms=timeout_ms, max_records=max_records)
+        for tp, partition_records in records.items():
+            if not partition_records:
+                continue
+            if unpack is None:
+                messages = [r.value for r in partition_records]
+            else:
+                messages = [m for r in partition_records for m in data_unpack_many(r.value, unpack=unpack)]
+            yield tp, messages
+            consumer.commit({tp: offset_and_metadata(partition_records[-1].offset + 1)})
+
+
+class KafkaLagMonitor(LagMonitor):
+    """
+    Lag and throughput monitor for a KafkaConsumer, see fvhiot.utils.kafkatools.LagMonitor.
+    Call observe() with every poll() result in the consuming thread. Every `interval` seconds
+    it also updates lag from consumer's position() and highwater(), which are known locally
+    from fetch responses, so monitoring never waits for the broker.
+
+    Usage:
+
+        monitor = KafkaLagMonitor(consumer, labels={"group": os.getenv("KAFKA_GROUP_ID")})
+        while True:
+            records = consumer.poll(timeout_ms=1000)
+            monitor.observe(records)
+            ...
+        # e.g. in a HTTP endpoint (another thread): monitor.prometheus()
+    """
+
+    def __init__(self, consumer: KafkaConsumer, interval: float = 15.0, window: float = 60.0, labels=None):
+        super().__init__(interval, window, labels)
+        self.consumer = consumer
+
+    def observe(self, records: dict):
+        super().observe(records)
+        if self.due():
+            self.refresh()
+
+    def refresh(self):
+        """Update positions and end offsets of assigned partitions, must be called in the consuming thread"""
+        positions, ends = {}, {}
+        for tp in self.consumer.assignment():
+            highwater = self.consumer.highwater(tp)
+            if highwater is not None:  # None until the partition has been fetched
+                positions[tp] = self.consumer.position(tp)
+                ends[tp] = highwater
+        self.update(positions, ends)
+
+
+class _PartitionWorker(threading.Thread):
+    """
+    Process records of one partition in order. `processed` is the offset after
+    the last successfully processed record, i.e. the offset to commit.
+    """
+
+    _STOP = object()
+
+    def __init__(self, tp: TopicPartition, handler: Callable[[Any], Any], unpack, queue_size: int):
+        super().__init__(name=f"kafka-worker-{tp.topic}-{tp.partition}", daemon=True)
+        self.tp = tp
+        self.handler = handler
+        self.unpack = unpack
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.processed: Optional[int] = None
+        self.committed: Optional[int] = None
+        self.error: Optional[BaseException] = None
+        self.stopping = False
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is self._STOP:
+                return
+            if self.stopping or self.error is not None:
+                continue  # drop queued records, they will be redelivered
+            try:
+                if self.unpack is None:
+                    self.handler(record.value)
+                else:
+                    for message in data_unpack_many(record.value, unpack=self.unpack):
+                        self.handler(message)
+                self.processed = record.offset + 1
+            except Exception as err:
+                logging.exception(f"Failed to process record {self.tp.topic}/{self.tp.partition}:{record.offset}")
+                self.error = err
+
+    def stop(self):
+        """Stop after the record being processed now, drop the rest"""
+        self.stopping = True
+        self.queue.put(self._STOP)
+        self.join()
+
+
+class PartitionWorkerRunner(ConsumerRebalanceListener):
+    """
+    Process records of each assigned partition in a dedicated worker thread.
+    Ordering within a partition is preserved, while I/O bound handlers (e.g. database sinks)
+    run in parallel for different partitions.
+
+    Worker queues are bounded: if a worker falls behind, its partition is paused until
+    the queue has room again. Offsets of processed records are committed centrally
+    every `commit_interval` seconds, when partitions are revoked in a rebalance and on stop.
+    If a handler raises, the runner stops and re-raises the exception from run(),
+    after committing offsets processed so far.
+
+    Usage:
+
+        consumer = get_kafka_consumer_by_envs(topic)
+        runner = PartitionWorkerRunner(consumer, save_to_database)
+        runner.run()
+
+    :param consumer: KafkaConsumer with enable_auto_commit=False
+    :param handler: function called with each (unpacked) message, also for each message of an envelope
+    :param unpack: function to decode message value (None passes values as is)
+    :param queue_size: maximum number of queued records per partition
+    :param max_records: maximum number of records returned by one poll()
+    :param poll_timeout_ms: poll() timeout in milliseconds
+    :param commit_interval: seconds between commits
+    """
+
+    def __init__(
+        self,
+        consumer: KafkaConsumer,
+        handler: Callable[[Any], Any],
+        unpack: Optional[Callable[[bytes], Any]] = data_unpack,
+        queue_size: int = 1000,
+        max_records: int = 500,
+        poll_timeout_ms: int = 1000,
+        commit_interval: float = 5.0,
+    ):
+        self.consumer = consumer
+        self.handler = handler
+        self.unpack = unpack
+        self.queue_size = queue_size
+        self.max_records = max_records
+        self.poll_timeout_ms = poll_timeout_ms
+        self.commit_interval = commit_interval
+        self._workers: dict[TopicPartition, _PartitionWorker] = {}
+        self._pending: dict[TopicPartition, collections.deque] = {}
+        self._paused: set[TopicPartition] = set()
+        self._stop_event = threading.Event()
+
+    def _get_worker(self, tp: TopicPartition) -> _PartitionWorker:
+        worker = self._workers.get(tp)
+        if worker is None:
+            worker = _PartitionWorker(tp, self.handler, self.unpack, self.queue_size)
+            worker.start()
+            self._workers[tp] = worker
+        return worker
+
+    def _dispatch(self):
+        """Move pending records to worker queues, pause partitions whose queue is full"""
+        for tp, pending in self._pending.items():
+            worker = self._get_worker(tp)
+            try:
+                while pending:
+                    worker.queue.put_nowait(pending[0])
+                    pending.popleft()
+            except queue.Full:
+                pass
+            if pending and tp not in self._paused:
+                self.consumer.pause(tp)
+                self._paused.add(tp)
+            elif not pending and tp in self._paused:
+                self.consumer.resume(tp)
+                self._paused.discard(tp)
+
+    def _commit(self, workers: list[_PartitionWorker]):
+        # Read `processed` once: workers may advance it while commit() is running
+        offsets = {}
+        for worker in workers:
+            processed = worker.processed
+            if processed is not None and processed != worker.committed:
+                offsets[worker] = processed
+        if offsets:
+            self.consumer.commit({worker.tp: offset_and_metadata(o) for worker, o in offsets.items()})
+            for worker, offset in offsets.items():
+                worker.committed = offset
+
+    def _stop_workers(self, tps: list[TopicPartition]):
+        workers = [self._workers.pop(tp) for tp in tps if tp in self._workers]
+        for worker in workers:
+            worker.stop()
+        for tp in tps:
+            self._pending.pop(tp, None)
+            self._paused.discard(tp)
+        self._commit(workers)
+
+    def on_partitions_revoked(self, revoked):
+        logging.info(f"Partitions revoked: {revoked}")
+        self._stop_workers(list(revoked))
+
+    def on_partitions_assigned(self, assigned):
+        logging.info(f"Partitions assigned: {assigned}")
+
+    def stop(self):
+        """Ask run() to stop, may be called from another thread or a signal handler"""
+        self._stop_event.set()
+
+    def run(self):
+        """Consume and dispatch records until stop() is called or a handler raises"""
+        if self.consumer.subscription():
+            # Re-subscribe to get notified about rebalances
+            self.consumer.subscribe(topics=list(self.consumer.subscription()), listener=self)
+        last_commit = time.monotonic()
+        error = None
+        try:
+            while not self._stop_event.is_set():
+                records = self.consumer.poll(timeout_ms=self.poll_timeout_ms, max_records=self.max_records)
+                for tp, partition_records in records.items():
+                    self._pending.setdefault(tp, collections.deque()).extend(partition_records)
+                self._dispatch()
+                failed = [w for w in self._workers.values() if w.error is not None]
+                if failed:
+                    error = failed[0].error
+                    break
+                if time.monotonic() - last_commit >= self.commit_interval:
+                    self._commit(list(self._workers.values()))
+                    last_commit = time.monotonic()
+        finally:
+            self._stop_workers(list(self._workers))
+        if error is not None:
+            raise error
+
+
+def send_for_device(
+    producer: KafkaProducer, topic: str, device_id: str, message: dict, consistent_hash: bool = False, **kwargs
+):
+    """
+    Pack message with data_pack() and send it keyed by device_id, so that all messages
+    of one device go to the same partition (and thus stay in order and reach the same consumer).
+
+    By default Kafka's partitioner chooses the partition from the key. With `consistent_hash`
+    the partition is chosen with partition_for_device(), which moves fewer devices
+    when partitions are added to the topic. Use the same method for all producers of a topic.
+
+    :return: FutureRecordMetadata from producer.send()
+    """
+    partition = None
+    if consistent_hash:
+        partitions = sorted(producer.partitions_for(topic))
+        partition = partitions[partition_for_device(device_id, len(partitions))]
+    return producer.send(topic, value=data_pack(message), key=device_key(device_id), partition=partition, **kwargs)
+
+
+def send_envelopes(
+    producer: KafkaProducer,
+    topic: str,
+    messages: Iterable[dict],
+    max_count: int = 1000,
+    max_bytes: int = 900_000,
+    **kwargs,
+) -> list:
+    """
+    Pack messages into envelopes with data_pack_batches() and send each envelope as one Kafka message.
+    Consumer helpers of this module (and fvhiot.utils.aiokafka) unpack envelopes transparently,
+    other consumers can use data_unpack_many().
+
+    :param producer: KafkaProducer
+    :param topic: topic name
+    :param messages: messages to send
+    :param max_count: maximum number of messages in one envelope
+    :param max_bytes: maximum size of one envelope in bytes
+    :param kwargs: extra arguments for producer.send(), e.g. key
+    :return: list of FutureRecordMetadata, one per envelope
+    """
+    return [
+        producer.send(topic, value=envelope, **kwargs)
+        for envelope in data_pack_batches(messages, max_count=max_count, max_bytes=max_bytes)
+    ]
+
+
+class DeadLetterQueue(object):
+    """
+    Route records, whose processing failed, to a dead-letter topic instead of crashing
+    (and reprocessing everything) or dropping them silently.
+
+    add() buffers a dead_letter() message (original record, parser_module, exception class
+    and timestamp), which are sent packed with data_pack() in batches of `batch_size`.
+    Call flush() before committing offsets of the failed records.
+
+    Usage:
+
+        dlq = DeadLetterQueue(producer, os.getenv("KAFKA_DLQ_TOPIC_NAME"))
+        for record in records:
+            try:
+                process(record)
+            except Exception as err:
+                dlq.add(record, err, device.parser_module)
+        dlq.flush()
+        consumer.commit()
+
+    Replay dead letters with replay_dead_letters() once the bug has been fixed.
+    """
+
+    def __init__(self, producer: KafkaProducer, topic: str, batch_size: int = 100):
+        self.producer = producer
+        self.topic = topic
+        self.batch_size = batch_size
+        self._buffer: list[dict] = []
+        self.count = 0
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def add(self, record, error: BaseException, parser_module: Optional[str] = None):
+        """Add a failed record, send buffered dead letters if the batch is full"""
+        logging.warning(
+            f"Sending record {record.topic}/{record.partition}:{record.offset} to {self.topic}: "
+            f"{type(error).__name__}: {error}"
+        )
+        self._buffer.append(dead_letter(record, error, parser_module))
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Send buffered dead letters and wait until they are delivered, return number of sent messages.
+        If delivery fails, the letters stay in the buffer and are sent again on the next flush().
+        """
+        letters = list(self._buffer)
+        futures = [self.producer.send(self.topic, value=data_pack(letter), key=letter["key"]) for letter in letters]
+        self.producer.flush()
+        for future in futures:
+            future.get()  # Raise delivery error
+        del self._buffer[: len(letters)]
+        self.count += len(letters)
+        return len(letters)
+
+
+def replay_dead_letters(
+    consumer: KafkaConsumer,
+    producer: KafkaProducer,
+    parser_module: Optional[str] = None,
+    topic: Optional[str] = None,
+    timeout_ms: int = 5000,
+    commit: bool = True,
+) -> int:
+    """
+    Send original records from a dead-letter topic back to their original topic (or `topic`),
+    so they are processed again. Consumes until there are no new dead letters for `timeout_ms`.
+
+    :param consumer: KafkaConsumer subscribed to (or assigned) the dead-letter topic
+    :param producer: KafkaProducer
+    :param parser_module: replay only dead letters of this parser module
+    :param topic: send records to this topic instead of the original one
+    :param timeout_ms: stop after no dead letters were received for this long
+    :param commit: commit consumer's offsets after each replayed batch. Offsets are never committed
+        with `parser_module`, because that would drop dead letters of other parser modules,
+        so use a throwaway group id (or none) for filtered replays.
+    :return: number of replayed records
+    """
+    commit = commit and parser_module is None
+    replayed = 0
+    while True:
+        records = consumer.poll(timeout_ms=timeout_ms)
+        if not records:
+            break
+        futures = []
+        for partition_records in records.values():
+            for record in partition_records:
+                letter = data_unpack(record.value)
+                if parser_module is not None and letter.get("parser_module") != parser_module:
+                    continue
+                futures.append(producer.send(topic or letter["topic"], value=letter["value"], key=letter["key"]))
+        producer.flush()
+        for future in futures:
+            future.get()  # Raise delivery error before committing
+        replayed += len(futures)
+        if commit:
+            consumer.commit()
+    logging.info(f"Replayed {replayed} dead letters")
+    return replayed
 
 
 # NOTE: arguments are probably about to change
@@ -223,43 +710,125 @@ def get_consumer(
     )
 
 
-class FvhKafkaProducer(object):
+# Flask extensions which create their clients lazily, once per process.
+# KafkaProducer's and KafkaConsumer's sockets and I/O threads don't survive fork(),
+# so clients inherited from the parent process (e.g. gunicorn --preload) are dropped in the child.
+_per_process_clients: weakref.WeakSet = weakref.WeakSet()
+
+
+def _reset_clients_after_fork():
+    for client in list(_per_process_clients):
+        client._reset_after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_clients_after_fork)
+
+
+class _PerProcessClient(abc.ABC):
+    """
+    Base class for Flask extensions, which keep one lazily created Kafka client per process.
+    Subclasses implement _create_client().
+    """
+
+    extension_name = ""
+
     def __init__(self, app=None):
         self.app = app
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+        _per_process_clients.add(self)
         if app is not None:
             self.init_app(app)
-        self._producer = self.get_producer()
 
     def init_app(self, app):
+        if self.app is None:
+            self.app = app
         app.config.setdefault("BOOTSTRAP_SERVERS", "localhost:9092")
         app.config.setdefault("SECURITY_PROTOCOL", "PLAINTEXT")
+        app.extensions[self.extension_name] = self
+        atexit.register(self.close)
+
+    @abc.abstractmethod
+    def _create_client(self):
+        """Create the client of the current process"""
+
+    def _get_client(self):
+        client = self._client
+        if client is not None and self._pid == os.getpid():
+            return client
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                logging.info(f"Creating {self.extension_name} client for process {os.getpid()}")
+                self._client = self._create_client()
+                self._pid = os.getpid()
+            return self._client
+
+    def _reset_after_fork(self):
+        # Never close or use the parent's client in the child, just forget it
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def close(self, timeout: Optional[float] = None):
+        """Close this process' client, if it has been created. A new one is created on next use."""
+        with self._lock:
+            client, self._client = self._client, None
+            if client is not None and self._pid == os.getpid():
+                self._close_client(client, timeout)
+
+    def _close_client(self, client, timeout: Optional[float]):
+        client.close()
+
+
+class FvhKafkaProducer(_PerProcessClient):
+    """
+    Flask extension for a long-lived KafkaProducer. The producer is created on first use
+    in each process, so the extension can be initialized before forking web workers.
+    Producer is flushed and closed at exit, call flush() to wait for sent messages earlier.
+    Batching settings come from PRODUCER_PROFILE config (default KAFKA_PRODUCER_PROFILE env
+    or "balanced") and KAFKA_PRODUCER_* envs, see fvhiot.utils.kafkatools.get_producer_settings().
+    """
+
+    extension_name = "fvhkafkaproducer"
+
+    def _create_client(self):
+        return self.get_producer()
 
     def get_producer(self):
-        return get_producer(
+        profile = self.app.config.get("PRODUCER_PROFILE") or os.getenv("KAFKA_PRODUCER_PROFILE") or "balanced"
+        return get_kafka_producer(
             bootstrap_servers=self.app.config["BOOTSTRAP_SERVERS"].split(","),
             security_protocol=self.app.config.get("SECURITY_PROTOCOL"),
             sasl_mechanism=self.app.config.get("SASL_MECHANISM"),
             sasl_plain_username=self.app.config.get("USERNAME"),
             sasl_plain_password=self.app.config.get("PASSWORD"),
+            **get_producer_settings(profile),
         )
 
     @property
-    def producer(self):
-        if self._producer is None:
-            self._producer = self.get_producer()
-        return self._producer
+    def producer(self) -> KafkaProducer:
+        return self._get_client()
 
+    def _close_client(self, client: KafkaProducer, timeout: Optional[float]):
+        client.close(timeout=timeout)
 
-class FvhKafkaConsumer(object):
-    def __init__(self, app=None):
-        self.app = app
-        if app is not None:
-            self.init_app(app)
-        self._consumer = self.get_consumer()
+    def flush(self, timeout: Optional[float] = None):
+        """Wait until all buffered messages of this process' producer are sent"""
+        if self._client is not None and self._pid == os.getpid():
+            self._client.flush(timeout)
 
-    def init_app(self, app):
-        app.config.setdefault("BOOTSTRAP_SERVERS", "localhost:9092")
-        app.config.setdefault("SECURITY_PROTOCOL", "PLAINTEXT")
+
+class FvhKafkaConsumer(_PerProcessClient):
+    """
+    Flask extension for a KafkaConsumer, which is created on first use in each process.
+    """
+
+    extension_name = "fvhkafkaconsumer"
+
+    def _create_client(self):
+        return self.get_consumer()
 
     def get_consumer(self):
         return get_consumer(
@@ -272,7 +841,5 @@ class FvhKafkaConsumer(object):
         )
 
     @property
-    def consumer(self):
-        if self._consumer is None:
-            self._consumer = self.get_consumer()
-        return self._consumer
+    def consumer(self) -> KafkaConsumer:
+        return self._get_client()
@@ -0,0 +1,281 @@
+"""
+Kafka helpers, which are shared by fvhiot.utils.kafka (kafka-python) and
+fvhiot.utils.aiokafka (aiokafka) and don't depend on either of them.
+"""
+
+import collections
+import datetime
+import hashlib
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+
+class ContiguousOffsets(object):
+    """
+    Track offsets of one partition, which are completed in any order.
+    `committable` is the offset to commit: the offset after the last record,
+    whose all predecessors (added with add()) are completed too.
+
+    Offsets must be added in increasing order (the order they are consumed) and completed once.
+    Offsets skipped between added offsets (e.g. in compacted topics) count as completed.
+    Completed offsets above the first incomplete one are kept as merged [start, end) intervals,
+    so memory depends on the number of gaps, not the number of offsets, and add() and
+    complete() take O(1) time.
+    """
+
+    def __init__(self):
+        self._next: Optional[int] = None  # Lowest not completed offset
+        self._last: Optional[int] = None  # Last added offset
+        self._ends: Dict[int, int] = {}  # Completed interval start -> end
+        self._starts: Dict[int, int] = {}  # Completed interval end -> start
+        self._pending = 0
+        self.committable: Optional[int] = None
+
+    def __len__(self) -> int:
+        """Number of added but not yet completed offsets"""
+        return self._pending
+
+    def _complete_range(self, start: int, end: int):
+        # Merge [start, end) with adjacent completed intervals
+        if start in self._starts:
+            start = self._starts.pop(start)
+            del self._ends[start]
+        if end in self._ends:
+            end = self._ends.pop(end)
+            del self._starts[end]
+        if start == self._next:
+            self._next = end
+            self.committable = end
+            return
+        self._ends[start] = end
+        self._starts[end] = start
+
+    def add(self, offset: int):
+        if self._last is None:
+            self._next = offset
+        elif offset <= self._last:
+            raise ValueError(f"Offset {offset} added after {self._last}, offsets must be increasing")
+        elif offset > self._last + 1:
+            self._complete_range(self._last + 1, offset)
+        self._last = offset
+        self._pending += 1
+
+    def complete(self, offset: int) -> Optional[int]:
+        """Mark offset completed and return (possibly advanced) committable offset"""
+        if self._next is not None and self._next <= offset <= self._last:
+            self._pending -= 1
+            self._complete_range(offset, offset + 1)
+        return self.committable
+
+
+def device_key(device_id: str) -> bytes:
+    """
+    Return Kafka message key for a device. Kafka's default partitioner hashes the key,
+    so all messages of one device end up in the same partition.
+    """
+    return str(device_id).encode("utf-8")
+
+
+def jump_hash(key: int, num_buckets: int) -> int:
+    """
+    Jump consistent hash (Lamping & Veach 2014): map 64-bit key to a bucket in [0, num_buckets).
+    When the number of buckets grows from n to n+1, only 1/(n+1) of the keys move.
+    """
+    if num_buckets < 1:
+        raise ValueError("num_buckets must be positive")
+    b, j = -1, 0
+    while j < num_buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+def partition_for_device(device_id: str, num_partitions: int) -> int:
+    """
+    Return partition number for a device using jump consistent hash over a stable 64-bit hash
+    of device_id. Unlike Kafka's default partitioner (murmur2 modulo partition count),
+    adding partitions moves only a minimal share of devices to new partitions.
+    """
+    key = int.from_bytes(hashlib.blake2b(device_key(device_id), digest_size=8).digest(), "big")
+    return jump_hash(key, num_partitions)
+
+
+def dead_letter(record, error: BaseException, parser_module: Optional[str] = None) -> dict:
+    """
+    Return a dead-letter message for a consumed record (kafka-python or aiokafka ConsumerRecord),
+    whose processing failed with `error`. Original key and value are kept as is, so the record
+    can be replayed to its original topic later.
+
+    :param record: ConsumerRecord
+    :param error: exception raised when processing the record
+    :param parser_module: parser module of the device, if known
+    :return: dict to be packed with data_pack()
+    """
+    return {
+        "topic": record.topic,
+        "partition": record.partition,
+        "offset": record.offset,
+        "timestamp": record.timestamp,
+        "key": record.key,
+        "value": record.value,
+        "parser_module": parser_module,
+        "error": f"{type(error).__module__}.{type(error).__qualname__}",
+        "error_message": str(error),
+        "failed_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+
+
+# Producer throughput profiles, see README.md for the trade-offs.
+# Setting names are kafka-python's, get_producer_settings() translates them for aiokafka.
+PRODUCER_PROFILES = {
+    # Send immediately: lowest latency, one request per message under light load (webhook endpoints)
+    "low_latency": {"linger_ms": 0, "batch_size": 16384, "compression_type": None, "acks": 1},
+    # Wait a little to fill batches: a few ms of extra latency, several times fewer requests (parsers)
+    "balanced": {"linger_ms": 20, "batch_size": 131072, "compression_type": None, "acks": 1},
+    # Big compressed batches: highest throughput and smallest network/disk usage, 100 ms+ latency (backfills)
+    "bulk": {"linger_ms": 200, "batch_size": 1048576, "compression_type": "gzip", "acks": "all"},
+}
+
+# Environment variables which override single profile settings
+PRODUCER_SETTING_ENVS = {
+    "linger_ms": ("KAFKA_PRODUCER_LINGER_MS", int),
+    "batch_size": ("KAFKA_PRODUCER_BATCH_SIZE", int),
+    "compression_type": ("KAFKA_PRODUCER_COMPRESSION_TYPE", lambda x: None if x.lower() in ("", "none") else x),
+    "acks": ("KAFKA_PRODUCER_ACKS", lambda x: x if x == "all" else int(x)),
+    "max_request_size": ("KAFKA_PRODUCER_MAX_REQUEST_SIZE", int),
+}
+
+
+def get_producer_settings(profile: Optional[str] = None, flavor: str = "kafka") -> dict:
+    """
+    Return producer settings of a named profile (default from KAFKA_PRODUCER_PROFILE env),
+    overridden by KAFKA_PRODUCER_* envs. Without profile and overrides return empty dict,
+    i.e. client library defaults.
+
+    :param profile: "low_latency", "balanced" or "bulk"
+    :param flavor: "kafka" for kafka-python's KafkaProducer or "aiokafka" for AIOKafkaProducer
+    :return: dict of keyword arguments for producer
+    """
+    profile = profile or os.getenv("KAFKA_PRODUCER_PROFILE")
+    if profile and profile not in PRODUCER_PROFILES:
+        raise ValueError(f"Unknown producer profile '{profile}', must be one of {list(PRODUCER_PROFILES)}")
+    settings = dict(PRODUCER_PROFILES[profile]) if profile else {}
+    for name, (env, convert) in PRODUCER_SETTING_ENVS.items():
+        if os.getenv(env) is not None:
+            settings[name] = convert(os.getenv(env))
+    if flavor == "aiokafka" and "batch_size" in settings:
+        settings["max_batch_size"] = settings.pop("batch_size")
+    return settings
+
+
+def _prometheus_labels(labels: dict) -> str:
+    escaped = (
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels.items()
+    )
+    return "{" + ",".join(escaped) + "}" if labels else ""
+
+
+class LagMonitor(object):
+    """
+    Consumer lag and throughput metrics.
+
+    observe() counts consumed records and bytes, update() stores consumer positions and
+    partition end offsets. Lag of a partition is end offset - position, i.e. the number
+    of messages not yet consumed. Rates are messages and bytes per second over the last
+    `window` seconds. Use fvhiot.utils.kafka.KafkaLagMonitor or
+    fvhiot.utils.aiokafka.AIOKafkaLagMonitor, which update offsets every `interval` seconds.
+
+    :param interval: seconds between offset updates
+    :param window: seconds to calculate rates over
+    :param labels: extra labels for prometheus(), e.g. {"group": "parser"}
+    """
+
+    def __init__(self, interval: float = 15.0, window: float = 60.0, labels: Optional[dict] = None):
+        self.interval = interval
+        self.window = window
+        self.labels = labels or {}
+        self.messages = 0
+        self.bytes = 0
+        self.updated: Optional[float] = None  # Epoch time of the last update()
+        self._positions: dict = {}
+        self._ends: dict = {}
+        self._samples = collections.deque([(time.monotonic(), 0, 0)])
+        self._last_update = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, records: dict):
+        """Count records of a poll() or getmany() result ({TopicPartition: [ConsumerRecord, ...]})"""
+        messages = nbytes = 0
+        for partition_records in records.values():
+            messages += len(partition_records)
+            for record in partition_records:
+                nbytes += max(record.serialized_value_size, 0) + max(record.serialized_key_size, 0)
+        with self._lock:
+            self.messages += messages
+            self.bytes += nbytes
+
+    def due(self) -> bool:
+        """Return True if offsets should be updated"""
+        return time.monotonic() - self._last_update >= self.interval
+
+    def update(self, positions: dict, ends: dict):
+        """Store positions and end offsets ({TopicPartition: offset}) of currently assigned partitions"""
+        now = time.monotonic()
+        with self._lock:
+            self._positions = dict(positions)
+            self._ends = dict(ends)
+            self._samples.append((now, self.messages, self.bytes))
+            while len(self._samples) > 2 and now - self._samples[1][0] >= self.window:
+                self._samples.popleft()
+        self._last_update = now
+        self.updated = time.time()
+
+    def snapshot(self) -> dict:
+        """Return lag (total and per partition), message and byte counts and rates"""
+        with self._lock:
+            started, messages0, bytes0 = self._samples[0]
+            elapsed = time.monotonic() - started
+            partitions = {}
+            for tp, position in sorted(self._positions.items()):
+                end = self._ends.get(tp)
+                lag = max(0, end - position) if end is not None and position is not None else None
+                partitions[f"{tp.topic}/{tp.partition}"] = {"position": position, "end": end, "lag": lag}
+            lags = [p["lag"] for p in partitions.values() if p["lag"] is not None]
+            return {
+                "lag": sum(lags) if lags else None,
+                "partitions": partitions,
+                "messages": self.messages,
+                "bytes": self.bytes,
+                "messages_per_second": (self.messages - messages0) / elapsed if elapsed > 0 else 0.0,
+                "bytes_per_second": (self.bytes - bytes0) / elapsed if elapsed > 0 else 0.0,
+                "updated": self.updated,
+            }
+
+    def prometheus(self, prefix: str = "fvhiot_kafka_consumer") -> str:
+        """Return snapshot() in Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = [
+            f"# HELP {prefix}_lag Messages between consumer position and partition end offset",
+            f"# TYPE {prefix}_lag gauge",
+        ]
+        for name, partition in snapshot["partitions"].items():
+            if partition["lag"] is not None:
+                topic, number = name.rsplit("/", 1)
+                labels = _prometheus_labels({**self.labels, "topic": topic, "partition": number})
+                lines.append(f"{prefix}_lag{labels} {partition['lag']}")
+        labels = _prometheus_labels(self.labels)
+        for name, kind, help_text in [
+            ("messages", "counter", "Consumed messages"),
+            ("bytes", "counter", "Consumed bytes (keys and values)"),
+            ("messages_per_second", "gauge", "Consumed messages per second"),
+            ("bytes_per_second", "gauge", "Consumed bytes per second"),
+        ]:
+            metric = f"{prefix}_{name}_total" if kind == "counter" else f"{prefix}_{name}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            lines.append(f"{metric}{labels} {snapshot[name]}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,132 @@
+"""
+Change-only emission for OCPP StatusNotification streams.
+
+Charge points repeat the same StatusNotification (status + errorCode) for every
+connector on every heartbeat. ConnectorStateCache remembers the last emitted state
+per (chargeBoxId, connectorId) and tells whether a message is a real transition
+which should be written to databases, or just a repetition which can be dropped.
+
+Usage:
+
+    cache = ConnectorStateCache(keepalive=3600, max_connectors=10000)
+    for msg in messages:
+        if cache.should_emit(msg):
+            write(msg)
+"""
+
+import collections
+import logging
+import time
+from typing import Any, Optional, Tuple
+
+SNAPSHOT_VERSION = 1
+
+
+def _value(v: Any) -> Any:
+    """Return plain value of a str Enum (e.g. StatusEnum.Available -> "Available")"""
+    return getattr(v, "value", v)
+
+
+class ConnectorStateCache(object):
+    """
+    Keep track of the last emitted status and errorCode per (chargeBoxId, connectorId).
+
+    :param keepalive: emit an unchanged state anyway, if the previous emit is older than this (seconds)
+    :param max_connectors: maximum number of connectors kept in memory, the least recently
+                           seen connector is evicted first. None means unbounded.
+    """
+
+    def __init__(self, keepalive: Optional[float] = None, max_connectors: Optional[int] = 100_000):
+        self.keepalive = keepalive
+        self.max_connectors = max_connectors
+        # (chargeBoxId, connectorId) -> (status, errorCode, last emit time)
+        self._states: collections.OrderedDict = collections.OrderedDict()
+        self.emitted = 0
+        self.suppressed = 0
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def __contains__(self, key: Tuple[str, int]) -> bool:
+        return key in self._states
+
+    def get(self, charge_box_id: str, connector_id: int) -> Optional[Tuple[str, str, float]]:
+        """Return last emitted (status, errorCode, emit time) of a connector or None"""
+        return self._states.get((charge_box_id, int(connector_id)))
+
+    def update(
+        self, charge_box_id: str, connector_id: int, status: str, error_code: str, now: Optional[float] = None
+    ) -> bool:
+        """
+        Register a StatusNotification and return True if it should be emitted,
+        i.e. state changed, connector was not known or keepalive interval has passed.
+        """
+        if now is None:
+            now = time.time()
+        key = (charge_box_id, int(connector_id))
+        status, error_code = _value(status), _value(error_code)
+        old = self._states.get(key)
+        if old is not None:
+            self._states.move_to_end(key)
+            if old[0] == status and old[1] == error_code:
+                if self.keepalive is None or now - old[2] < self.keepalive:
+                    self.suppressed += 1
+                    return False
+        self._states[key] = (status, error_code, now)
+        self.emitted += 1
+        if old is None and self.max_connectors is not None:
+            while len(self._states) > self.max_connectors:
+                self._states.popitem(last=False)
+                self.evicted += 1
+        return True
+
+    def should_emit(self, message: dict, now: Optional[float] = None) -> bool:
+        """
+        Check OCPP message (dict with chargeBoxId, messageType and payload).
+        Messages other than StatusNotifications are always emitted.
+        """
+        if message.get("messageType") != "StatusNotification":
+            return True
+        payload = message.get("payload") or message.get("data")
+        try:
+            return self.update(
+                message["chargeBoxId"], payload["connectorId"], payload["status"], payload["errorCode"], now=now
+            )
+        except (KeyError, TypeError, ValueError) as err:
+            # Let malformed messages through, someone else may want to see them
+            logging.warning(f"Invalid StatusNotification, emitting anyway: {err}")
+            return True
+
+    def forget(self, charge_box_id: str, connector_id: Optional[int] = None):
+        """Remove one connector or all connectors of a charge box from the cache"""
+        if connector_id is not None:
+            self._states.pop((charge_box_id, int(connector_id)), None)
+        else:
+            for key in [k for k in self._states if k[0] == charge_box_id]:
+                del self._states[key]
+
+    def snapshot(self) -> dict:
+        """Return JSON and msgpack serializable snapshot of the cache, see restore()"""
+        return {
+            "version": SNAPSHOT_VERSION,
+            "connectors": [[k[0], k[1], v[0], v[1], v[2]] for k, v in self._states.items()],
+        }
+
+    def restore(self, snapshot: dict):
+        """Replace cache contents with a snapshot created by snapshot()"""
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            raise ValueError("Unsupported snapshot version: {}".format(snapshot.get("version")))
+        connectors = snapshot["connectors"]
+        if self.max_connectors is not None:
+            connectors = connectors[-self.max_connectors :] if self.max_connectors > 0 else []
+        self._states = collections.OrderedDict(
+            ((charge_box_id, int(connector_id)), (status, error_code, float(ts)))
+            for charge_box_id, connector_id, status, error_code, ts in connectors
+        )
+
+    @classmethod
+    def from_snapshot(cls, snapshot: dict, **kwargs) -> "ConnectorStateCache":
+        cache = cls(**kwargs)
+        cache.restore(snapshot)
+        return cache
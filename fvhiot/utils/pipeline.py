@@ -0,0 +1,321 @@
+"""
+Raw-to-parsed Kafka pipeline runner.
+
+Parser services share the same loop: consume the raw data topic, unpack the message,
+parse it (get_uplink_obj(), device lookup, create_datalines() etc.), pack the result
+and produce it to the parsed data topic. ParserPipeline runs the loop in three stages
+connected by bounded queues, so that a slow stage applies backpressure to the previous one:
+
+    consume (calling thread) -> parse (worker pool) -> produce (producer thread)
+
+Offsets are committed only up to the last record whose results (if any) have been
+successfully produced, so a crash never loses messages (but may duplicate some).
+Note that with more than one parse worker, results of one partition may be produced
+in a different order than they were consumed. Use workers=1 to keep the order.
+
+Usage:
+
+    def parse(message: dict) -> list:
+        uplink_obj = get_uplink_obj(message)
+        device = device_cache.get(uplink_obj.DevEUI)
+        ...
+        return [parsed_data]
+
+    consumer = get_kafka_consumer_by_envs(os.getenv("KAFKA_RAW_DATA_TOPIC_NAME"))
+    producer = get_kafka_producer_by_envs()
+    pipeline = ParserPipeline(consumer, producer, os.getenv("KAFKA_PARSED_DATA_TOPIC_NAME"), parse, workers=4)
+    pipeline.run()
+"""
+
+from __future__ import annotations  # Python 3.9 compatibility
+
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from kafka import ConsumerRebalanceListener, KafkaConsumer, KafkaProducer, TopicPartition
+
+from fvhiot.utils.data import data_pack, data_unpack, data_unpack_many
+from fvhiot.utils.kafka import offset_and_metadata
+from fvhiot.utils.kafkatools import ContiguousOffsets
+
+_STOP = object()
+
+
+class _InFlight(object):
+    """
+    Consumed record, which is done when all its results are produced.
+    `offsets` is the tracker of the partition assignment the record was consumed in:
+    records consumed before a rebalance never complete offsets redelivered after it.
+    """
+
+    __slots__ = ("tp", "offset", "value", "offsets", "remaining")
+
+    def __init__(self, tp: TopicPartition, offset: int, value: bytes, offsets: ContiguousOffsets):
+        self.tp = tp
+        self.offset = offset
+        self.value = value
+        self.offsets = offsets
+        self.remaining = 0
+
+
+class ParserPipeline(ConsumerRebalanceListener):
+    """
+    Consume raw messages, parse them in a worker pool and produce results to `topic`.
+
+    `parse` gets an unpacked message (or each message of an envelope, see fvhiot.utils.kafka.send_envelopes())
+    and returns None, a message or a list of messages, which are packed with `pack` and
+    produced to `topic`. If `parse` raises, `on_error(message, exception)` is called
+    (default logs the exception) and the message is treated as done.
+    If producing fails, the pipeline stops and run() raises the error.
+
+    :param consumer: KafkaConsumer with enable_auto_commit=False
+    :param producer: KafkaProducer
+    :param topic: topic for parsed messages
+    :param parse: parser function
+    :param workers: number of parse workers
+    :param executor: "thread" or "process" (parse function must be picklable) parse pool
+    :param queue_size: maximum size of queues between stages
+    :param max_records: maximum number of records returned by one poll()
+    :param poll_timeout_ms: poll() timeout in milliseconds
+    :param commit_interval: seconds between commits
+    :param unpack: function to decode raw message value
+    :param pack: function to encode parsed message
+    :param on_error: function called with a raw message and an exception, if parsing fails
+    """
+
+    def __init__(
+        self,
+        consumer: KafkaConsumer,
+        producer: KafkaProducer,
+        topic: str,
+        parse: Callable[[Any], Any],
+        workers: int = 1,
+        executor: str = "thread",
+        queue_size: int = 1000,
+        max_records: int = 500,
+        poll_timeout_ms: int = 1000,
+        commit_interval: float = 5.0,
+        unpack: Callable[[bytes], Any] = data_unpack,
+        pack: Callable[[Any], bytes] = data_pack,
+        on_error: Optional[Callable[[Any, Exception], Any]] = None,
+    ):
+        if executor not in ("thread", "process"):
+            raise ValueError(f"Invalid executor '{executor}', must be 'thread' or 'process'")
+        self.consumer = consumer
+        self.producer = producer
+        self.topic = topic
+        self.parse = parse
+        self.workers = workers
+        self.executor = executor
+        self.max_records = max_records
+        self.poll_timeout_ms = poll_timeout_ms
+        self.commit_interval = commit_interval
+        self.unpack = unpack
+        self.pack = pack
+        self.on_error = on_error
+        self._parse_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._produce_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._offsets: dict[TopicPartition, ContiguousOffsets] = {}
+        self._committed: dict[TopicPartition, int] = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._started: Optional[float] = None
+        self.counters = {"consumed": 0, "parsed": 0, "parse_errors": 0, "produced": 0, "committed": 0}
+        self.lag = 0
+
+    # Stage 2: parse
+
+    def _parse_one(self, pool: Optional[concurrent.futures.Executor], message: Any) -> list:
+        if pool is None:
+            result = self.parse(message)
+        else:
+            result = pool.submit(self.parse, message).result()
+        if result is None:
+            return []
+        return result if isinstance(result, list) else [result]
+
+    def _parse_worker(self, pool: Optional[concurrent.futures.Executor]):
+        while True:
+            item = self._parse_queue.get()
+            if item is _STOP:
+                return
+            try:
+                messages = list(data_unpack_many(item.value, unpack=self.unpack))
+            except Exception as err:
+                self._parse_failed(item, err)
+                messages = []
+            results = []
+            for message in messages:
+                try:
+                    results.extend(self._parse_one(pool, message))
+                    self._count("parsed")
+                except Exception as err:
+                    self._parse_failed(item, err)
+            if not results:
+                self._complete(item)
+                continue
+            item.remaining = len(results)
+            for result in results:
+                self._produce_queue.put((item, result))
+
+    def _parse_failed(self, item: _InFlight, err: Exception):
+        self._count("parse_errors")
+        if self.on_error is not None:
+            self.on_error(item.value, err)
+        else:
+            logging.exception(f"Failed to parse record {item.tp.topic}/{item.tp.partition}:{item.offset}")
+
+    # Stage 3: produce
+
+    def _produce_worker(self):
+        while True:
+            entry = self._produce_queue.get()
+            if entry is _STOP:
+                return
+            item, result = entry
+            try:
+                future = self.producer.send(self.topic, value=self.pack(result))
+            except Exception as err:
+                self._fail(err)
+                continue
+            future.add_callback(self._on_produced, item)
+            future.add_errback(self._fail)
+
+    def _on_produced(self, item: _InFlight, _record_metadata):
+        self._count("produced")
+        with self._lock:
+            item.remaining -= 1
+            if item.remaining > 0:
+                return
+        self._complete(item)
+
+    def _fail(self, err: BaseException):
+        logging.error("Failed to produce parsed message, stopping pipeline", exc_info=err)
+        self._error = err
+        self._stop_event.set()
+
+    # Stage 1: consume and commit (consumer is not thread safe, so both happen in run())
+
+    def _complete(self, item: _InFlight):
+        with self._lock:
+            # The tracker may have been dropped (partition revoked), then this is a no-op
+            item.offsets.complete(item.offset)
+
+    def _count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] += n
+
+    def _commit(self, tps: Optional[list[TopicPartition]] = None):
+        if self._error is not None:
+            return  # Don't commit past records whose results may be lost
+        commit = {}
+        with self._lock:
+            for tp, offsets in self._offsets.items():
+                if tps is not None and tp not in tps:
+                    continue
+                if offsets.committable is not None and offsets.committable != self._committed.get(tp):
+                    commit[tp] = offsets.committable
+        if commit:
+            self.consumer.commit({tp: offset_and_metadata(o) for tp, o in commit.items()})
+            self._committed.update(commit)
+            self._count("committed", len(commit))
+
+    def _update_lag(self):
+        lag = 0
+        for tp in self.consumer.assignment():
+            highwater = self.consumer.highwater(tp)
+            if highwater is not None:
+                lag += max(0, highwater - self.consumer.position(tp))
+        self.lag = lag
+
+    def _put(self, item: _InFlight) -> bool:
+        """Put item into parse queue, wait while the queue is full (backpressure)"""
+        while not self._stop_event.is_set():
+            try:
+                self._parse_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def on_partitions_revoked(self, revoked):
+        logging.info(f"Partitions revoked: {revoked}")
+        self._commit(list(revoked))
+        with self._lock:
+            for tp in revoked:
+                self._offsets.pop(tp, None)
+                self._committed.pop(tp, None)
+
+    def on_partitions_assigned(self, assigned):
+        logging.info(f"Partitions assigned: {assigned}")
+
+    def stats(self) -> dict:
+        """Return counters, throughput (messages per second since start), queue sizes and consumer lag"""
+        with self._lock:
+            stats = dict(self.counters)
+            stats["in_flight"] = sum(len(o) for o in self._offsets.values())
+        elapsed = time.monotonic() - self._started if self._started else 0
+        stats["consumed_per_second"] = stats["consumed"] / elapsed if elapsed else 0.0
+        stats["produced_per_second"] = stats["produced"] / elapsed if elapsed else 0.0
+        stats["parse_queue"] = self._parse_queue.qsize()
+        stats["produce_queue"] = self._produce_queue.qsize()
+        stats["lag"] = self.lag
+        return stats
+
+    def stop(self):
+        """Ask run() to stop, may be called from another thread or a signal handler"""
+        self._stop_event.set()
+
+    def run(self):
+        """Run pipeline until stop() is called or producing fails"""
+        if self.consumer.subscription():
+            # Re-subscribe to get notified about rebalances
+            self.consumer.subscribe(topics=list(self.consumer.subscription()), listener=self)
+        pool = None
+        if self.executor == "process":
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        parsers = [
+            threading.Thread(target=self._parse_worker, args=(pool,), name=f"pipeline-parse-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        producer_thread = threading.Thread(target=self._produce_worker, name="pipeline-produce", daemon=True)
+        for t in parsers + [producer_thread]:
+            t.start()
+        self._started = time.monotonic()
+        last_commit = self._started
+        try:
+            while not self._stop_event.is_set():
+                records = self.consumer.poll(timeout_ms=self.poll_timeout_ms, max_records=self.max_records)
+                for tp, partition_records in records.items():
+                    for record in partition_records:
+                        with self._lock:
+                            offsets = self._offsets.setdefault(tp, ContiguousOffsets())
+                            offsets.add(record.offset)
+                        item = _InFlight(tp, record.offset, record.value, offsets)
+                        if not self._put(item):
+                            break
+                        self._count("consumed")
+                if time.monotonic() - last_commit >= self.commit_interval:
+                    self._commit()
+                    self._update_lag()
+                    last_commit = time.monotonic()
+        finally:
+            # Let queued records finish, then commit what has been produced
+            for _ in parsers:
+                self._parse_queue.put(_STOP)
+            for t in parsers:
+                t.join()
+            self._produce_queue.put(_STOP)
+            producer_thread.join()
+            self.producer.flush()
+            if pool is not None:
+                pool.shutdown()
+            self._commit()
+            logging.info(f"Pipeline stopped: {self.stats()}")
+        if self._error is not None:
+            raise self._error
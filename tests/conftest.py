@@ -0,0 +1,117 @@
+import asyncio
+import collections
+
+import pytest
+
+from fvhiot.utils.fakekafka import (
+    FakeAIOKafkaConsumer,
+    FakeAIOKafkaProducer,
+    FakeBroker,
+    FakeKafkaConsumer,
+    FakeKafkaProducer,
+    _FakeFuture,
+)
+
+Record = collections.namedtuple("Record", "topic partition offset timestamp key value")
+
+
+class Clock:
+    """Stand-in for the `time` module, monotonic() returns `now`"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def fake_time(monkeypatch):
+    """Return a function, which replaces the `time` module of given modules with a Clock"""
+
+    def install(*modules) -> Clock:
+        clock = Clock()
+        for module in modules:
+            monkeypatch.setattr(module, "time", clock)
+        return clock
+
+    return install
+
+
+class FailingKafkaProducer(FakeKafkaProducer):
+    """FakeKafkaProducer, whose deliveries fail while `fail` is True"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fail = True
+
+    def send(self, *args, **kwargs):
+        if self.fail:
+            return _FakeFuture(exception=RuntimeError("broker down"))
+        return super().send(*args, **kwargs)
+
+
+class FailingAIOKafkaProducer(FakeAIOKafkaProducer):
+    """FakeAIOKafkaProducer, whose batch deliveries fail while `fail` is True"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fail = True
+
+    async def send_batch(self, batch, topic, *, partition):
+        if not self.fail:
+            return await super().send_batch(batch, topic, partition=partition)
+        future = asyncio.get_running_loop().create_future()
+        future.set_exception(RuntimeError("broker down"))
+        return future
+
+
+@pytest.fixture
+def broker() -> FakeBroker:
+    return FakeBroker(partitions=1)
+
+
+@pytest.fixture
+def failing_producer(broker) -> FailingKafkaProducer:
+    return FailingKafkaProducer(broker=broker)
+
+
+@pytest.fixture
+def failing_aio_producer(broker) -> FailingAIOKafkaProducer:
+    return FailingAIOKafkaProducer(broker=broker)
+
+
+@pytest.fixture
+def consume_all(broker):
+    """Return a function, which returns all records of a topic"""
+
+    def consume(topic: str, group_id=None) -> list:
+        consumer = FakeKafkaConsumer(topic, group_id=group_id, auto_offset_reset="earliest", broker=broker)
+        records = consumer.poll(timeout_ms=10, max_records=10000)
+        consumer.close()
+        return [r for partition_records in records.values() for r in partition_records]
+
+    return consume
+
+
+@pytest.fixture
+def aio_consume_all(broker):
+    """Return a coroutine function, which returns all records of a topic"""
+
+    async def consume(topic: str, group_id=None) -> list:
+        consumer = FakeAIOKafkaConsumer(topic, group_id=group_id, auto_offset_reset="earliest", broker=broker)
+        await consumer.start()
+        records = await consumer.getmany(timeout_ms=10, max_records=10000)
+        await consumer.stop()
+        return [r for partition_records in records.values() for r in partition_records]
+
+    return consume
+
+
+@pytest.fixture
+def failed_records() -> list:
+    """Three consumed records of "raw" topic with the parser modules, which failed to process them"""
+    from fvhiot.utils.data import data_pack
+
+    records = [Record("raw", 0, i, 1700000000000 + i, b"dev", data_pack({"i": i})) for i in range(3)]
+    return list(zip(records, ["elsys", "digita", "elsys"]))
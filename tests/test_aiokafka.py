@@ -0,0 +1,336 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("msgpack")
+pytest.importorskip("aiokafka")
+
+from aiokafka import TopicPartition  # noqa: E402
+
+from fvhiot.utils import aiokafka as aiokafka_module  # noqa: E402
+from fvhiot.utils.aiokafka import (  # noqa: E402
+    BatchProducer,
+    DeadLetterQueue,
+    KeyOrderedDispatcher,
+    OffsetTracker,
+    iter_batches,
+    replay_dead_letters,
+    seek_partitions,
+)
+from fvhiot.utils.data import data_pack, data_pack_envelope, data_unpack  # noqa: E402
+from fvhiot.utils.fakekafka import FakeAIOKafkaConsumer, FakeAIOKafkaProducer, FakeBroker  # noqa: E402
+
+
+async def make_consumer(broker, messages=()):
+    producer = FakeAIOKafkaProducer(broker=broker)
+    for message in messages:
+        await producer.send("raw", value=data_pack(message))
+    consumer = FakeAIOKafkaConsumer("raw", group_id="sink", auto_offset_reset="earliest", broker=broker)
+    await consumer.start()
+    return consumer
+
+
+async def submit_all(dispatcher, consumer):
+    records = await consumer.getmany(timeout_ms=10)
+    for tp, partition_records in records.items():
+        for record in partition_records:
+            await dispatcher.submit(tp, record)
+
+
+class SlowProducer(FakeAIOKafkaProducer):
+    """Delivers batches after a delay and fails them"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.futures = []
+
+    async def send_batch(self, batch, topic, *, partition):
+        future = asyncio.get_running_loop().create_future()
+        asyncio.get_running_loop().call_later(0.01, future.set_exception, RuntimeError("broker down"))
+        self.futures.append(future)
+        return future
+
+
+class TestBatchProducer:
+    def test_error_while_sending_waits_for_sent_batches(self, broker):
+        def pack(message):
+            if message["i"] == 50:
+                raise ValueError("bad message")
+            return data_pack(message)
+
+        async def run():
+            producer = SlowProducer(broker=broker, max_batch_size=200)
+            with pytest.raises(ValueError):
+                await BatchProducer(producer, pack=pack).send_many("raw", [{"i": i} for i in range(100)])
+            assert producer.futures
+            assert all(f.done() for f in producer.futures)
+
+        asyncio.run(run())
+
+
+class TestSeekPartitions:
+    def test_offsets_are_clamped(self, broker):
+        async def run():
+            producer = FakeAIOKafkaProducer(broker=broker)
+            for i in range(10):
+                await producer.send("raw", value=data_pack({"i": i}))
+            consumer = FakeAIOKafkaConsumer(broker=broker)
+            targets = [
+                list((await seek_partitions(consumer, "raw", offsets={0: offset})).values())[0]
+                for offset in (-3, -100, 100, 4)
+            ]
+            assert targets == [7, 0, 10, 4]
+
+        asyncio.run(run())
+
+
+class TestEnvelopes:
+    def test_iter_batches_and_dispatcher(self, broker):
+        async def run():
+            producer = FakeAIOKafkaProducer(broker=broker)
+            await producer.send("raw", value=data_pack_envelope([{"i": 0}, {"i": 1}]))
+            await producer.send("raw", value=data_pack({"i": 2}))
+            consumer = await make_consumer(broker)
+            batch = await iter_batches(consumer, timeout_ms=10).__anext__()
+            assert batch.messages == [{"i": 0}, {"i": 1}, {"i": 2}]
+            await consumer.seek_to_beginning()
+            processed = []
+
+            async def handler(message):
+                processed.append(message["i"])
+                if len(processed) == 3:
+                    dispatcher.stop()
+
+            dispatcher = KeyOrderedDispatcher(consumer, handler)
+            await dispatcher.run(timeout_ms=10)
+            assert processed == [0, 1, 2]
+
+        asyncio.run(run())
+        assert broker.committed_offset("sink", "raw", 0) == 2
+
+
+class TestKeyOrderedDispatcher:
+    def test_order_per_key(self, broker):
+        messages = [{"k": i % 3, "i": i} for i in range(30)]
+
+        async def run():
+            consumer = await make_consumer(broker, messages)
+            processed = []
+
+            async def handler(message):
+                # Later messages of a key finish sooner, if they are not serialized
+                await asyncio.sleep((30 - message["i"]) / 10000)
+                processed.append(message)
+                if len(processed) == len(messages):
+                    dispatcher.stop()
+
+            dispatcher = KeyOrderedDispatcher(consumer, handler, workers=3, key=lambda r: data_unpack(r.value)["k"])
+            await dispatcher.run(timeout_ms=10)
+            return processed
+
+        processed = asyncio.run(run())
+        for k in range(3):
+            assert [m["i"] for m in processed if m["k"] == k] == list(range(k, 30, 3))
+        assert broker.committed_offset("sink", "raw", 0) == 30
+
+    def test_commit_up_to_lowest_incomplete(self, broker):
+        messages = [{"k": 0, "i": 0}, {"k": 1, "i": 1}, {"k": 2, "i": 2}, {"k": 0, "i": 3}]
+
+        async def run():
+            consumer = await make_consumer(broker, messages)
+            gate = asyncio.Event()
+            processed = []
+
+            async def handler(message):
+                if message["k"] == 1:
+                    await gate.wait()
+                processed.append(message["i"])
+
+            dispatcher = KeyOrderedDispatcher(consumer, handler, workers=3, key=lambda r: data_unpack(r.value)["k"])
+            await submit_all(dispatcher, consumer)
+            while len(processed) < 3:
+                await asyncio.sleep(0.001)
+            await dispatcher.commit()
+            assert broker.committed_offset("sink", "raw", 0) == 1
+            gate.set()
+            await dispatcher.drain()
+            await dispatcher.commit()
+            assert broker.committed_offset("sink", "raw", 0) == 4
+            await dispatcher.close()
+
+        asyncio.run(run())
+
+    def test_skip_revoked_partitions(self):
+        broker = FakeBroker(partitions=2)
+
+        async def run():
+            producer = FakeAIOKafkaProducer(broker=broker)
+            for i in range(8):
+                await producer.send("raw", value=data_pack({"i": i}), partition=i % 2)
+            consumer = await make_consumer(broker)
+            processed = []
+
+            async def handler(message):
+                processed.append(message["i"])
+
+            dispatcher = KeyOrderedDispatcher(consumer, handler, workers=2)
+            consumer.subscribe(["raw"], listener=dispatcher)
+            records = await consumer.getmany(timeout_ms=10)
+            # Another member joins, partition 1 is revoked before the fetched records are submitted
+            other = FakeAIOKafkaConsumer("raw", group_id="sink", broker=broker)
+            await other.start()
+            await consumer.getmany(timeout_ms=0)
+            assert consumer.assignment() == {TopicPartition("raw", 0)}
+            for tp, partition_records in records.items():
+                for record in partition_records:
+                    await dispatcher.submit(tp, record)
+            await dispatcher.close()
+            assert processed == [0, 2, 4, 6]
+            assert TopicPartition("raw", 1) not in dispatcher.offsets.committable()
+
+        asyncio.run(run())
+        assert broker.committed_offset("sink", "raw", 0) == 4
+        assert broker.committed_offset("sink", "raw", 1) is None
+
+    def test_handler_error(self, broker):
+        messages = [{"i": i} for i in range(5)]
+
+        async def run():
+            consumer = await make_consumer(broker, messages)
+
+            async def handler(message):
+                if message["i"] == 2:
+                    raise ValueError("broken")
+
+            dispatcher = KeyOrderedDispatcher(consumer, handler, workers=2)
+            with pytest.raises(ValueError):
+                await dispatcher.run(timeout_ms=10)
+
+        asyncio.run(run())
+        assert broker.committed_offset("sink", "raw", 0) == 2
+
+
+class TestOffsetTracker:
+    @pytest.fixture
+    def clock(self, fake_time):
+        return fake_time(aiokafka_module)
+
+    def test_commit_every(self, broker, clock):
+        tp = TopicPartition("raw", 0)
+
+        async def run():
+            consumer = await make_consumer(broker)
+            tracker = OffsetTracker(consumer, commit_interval=0, commit_every=3)
+            for offset in range(5):
+                tracker.add(tp, offset)
+            tracker.complete(tp, 1)
+            tracker.complete(tp, 0)
+            assert tracker.committable() == {tp: 2}
+            assert not await tracker.maybe_commit()
+            assert broker.committed_offset("sink", "raw", 0) is None
+            tracker.complete(tp, 3)
+            assert await tracker.maybe_commit()
+            assert broker.committed_offset("sink", "raw", 0) == 2
+            assert len(tracker) == 2
+            tracker.complete(tp, 4)
+            assert not await tracker.maybe_commit()
+            tracker.complete(tp, 2)
+            assert tracker.committable() == {tp: 5}
+
+        asyncio.run(run())
+
+    def test_commit_interval(self, broker, clock):
+        tp = TopicPartition("raw", 0)
+
+        async def run():
+            consumer = await make_consumer(broker)
+            tracker = OffsetTracker(consumer, commit_interval=5.0)
+            tracker.add(tp, 10)
+            tracker.complete(tp, 10)
+            clock.now += 4.9
+            assert not await tracker.maybe_commit()
+            clock.now += 0.1
+            assert await tracker.maybe_commit()
+            assert broker.committed_offset("sink", "raw", 0) == 11
+            assert tracker.committable() == {}
+
+        asyncio.run(run())
+
+    def test_commit_skips_unassigned(self, broker, clock):
+        tp, other = TopicPartition("raw", 0), TopicPartition("other", 0)
+
+        async def run():
+            consumer = await make_consumer(broker)
+            tracker = OffsetTracker(consumer)
+            for t in (tp, other):
+                tracker.add(t, 0)
+                tracker.complete(t, 0)
+            await tracker.commit()
+            assert tracker.committable() == {}
+            assert broker.committed_offset("sink", "raw", 0) == 1
+            assert broker.committed_offset("sink", "other", 0) is None
+
+        asyncio.run(run())
+
+    def test_forget(self, clock):
+        broker = FakeBroker(partitions=2)
+        tp0, tp1 = TopicPartition("raw", 0), TopicPartition("raw", 1)
+
+        async def run():
+            consumer = await make_consumer(broker)
+            tracker = OffsetTracker(consumer)
+            tracker.add(tp0, 0)
+            tracker.add(tp1, 0)
+            tracker.forget([tp1])
+            tracker.complete(tp1, 0)  # Revoked partition, ignored
+            tracker.complete(tp0, 0)
+            await tracker.commit()
+            assert broker.committed_offset("sink", "raw", 0) == 1
+            assert broker.committed_offset("sink", "raw", 1) is None
+
+        asyncio.run(run())
+
+
+class TestDeadLetters:
+    def test_flush_keeps_letters_on_failure(self, failing_aio_producer, failed_records, aio_consume_all):
+        async def run():
+            dlq = DeadLetterQueue(failing_aio_producer, "dlq")
+            for record, parser_module in failed_records:
+                await dlq.add(record, ValueError("bad payload"), parser_module)
+            with pytest.raises(RuntimeError):
+                await dlq.flush()
+            assert len(dlq) == 3
+            failing_aio_producer.fail = False
+            assert await dlq.flush() == 3
+            assert len(dlq) == 0
+            assert [data_unpack(r.value)["offset"] for r in await aio_consume_all("dlq")] == [0, 1, 2]
+
+        asyncio.run(run())
+
+    def test_replay(self, broker, failing_aio_producer, failed_records, aio_consume_all):
+        async def replay(producer, *args, **kwargs):
+            consumer = FakeAIOKafkaConsumer("dlq", group_id="replay", auto_offset_reset="earliest", broker=broker)
+            await consumer.start()
+            try:
+                return await replay_dead_letters(consumer, producer, *args, timeout_ms=10, **kwargs)
+            finally:
+                await consumer.stop()
+
+        async def run():
+            dlq = DeadLetterQueue(FakeAIOKafkaProducer(broker=broker), "dlq")
+            for record, parser_module in failed_records:
+                await dlq.add(record, ValueError("bad payload"), parser_module)
+            await dlq.flush()
+            producer = FakeAIOKafkaProducer(broker=broker)
+            # Filtered replay never commits, other parser modules' letters stay in the topic
+            assert await replay(producer, "elsys", topic="fixed") == 2
+            assert broker.committed_offset("replay", "dlq", 0) is None
+            fixed = [data_unpack(r.value) for r in await aio_consume_all("fixed")]
+            assert fixed == [{"i": 0}, {"i": 2}]
+            with pytest.raises(RuntimeError):
+                await replay(failing_aio_producer)
+            assert broker.committed_offset("replay", "dlq", 0) is None
+            assert await replay(producer) == 3
+            assert broker.committed_offset("replay", "dlq", 0) == 3
+
+        asyncio.run(run())
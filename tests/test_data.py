@@ -0,0 +1,134 @@
+import datetime
+import io
+import json
+
+import pytest
+
+pytest.importorskip("msgpack")
+
+from fvhiot.utils.compression import compress, data_pack_compressed, data_unpack_compressed, train_dictionary  # noqa: E402
+from fvhiot.utils.data import (  # noqa: E402
+    Envelope,
+    data_pack,
+    data_pack_batches,
+    data_pack_envelope,
+    data_pack_into,
+    data_pack_stream,
+    data_unpack,
+    data_unpack_many,
+    data_unpack_paths,
+    data_unpack_stream,
+)
+
+MESSAGES = [{"device": {"device_id": f"dev{i}"}, "data": [i, i * 1.5], "body": b"\x00" * i} for i in range(100)]
+
+
+class TestStream:
+    def test_file_object(self):
+        f = io.BytesIO()
+        assert data_pack_stream(f, MESSAGES) == len(MESSAGES)
+        f.seek(0)
+        assert list(data_unpack_stream(f, read_size=64)) == MESSAGES
+
+    def test_path(self, tmp_path):
+        path = tmp_path / "archive.msgpack"
+        with open(path, "wb") as f:
+            data_pack_stream(f, MESSAGES)
+        assert list(data_unpack_stream(path, read_size=64)) == MESSAGES
+        (tmp_path / "empty.msgpack").touch()
+        assert list(data_unpack_stream(tmp_path / "empty.msgpack")) == []
+
+    def test_bytes_and_chunks(self):
+        packed = b"".join(data_pack(m) for m in MESSAGES)
+        assert list(data_unpack_stream(packed, read_size=7)) == MESSAGES
+        chunks = [packed[i : i + 13] for i in range(0, len(packed), 13)]
+        assert list(data_unpack_stream(iter(chunks))) == MESSAGES
+        assert data_unpack(data_pack(MESSAGES[5])) == MESSAGES[5]
+
+
+class TestDatetimes:
+    def test_roundtrip(self):
+        ts = datetime.datetime(2024, 2, 29, 12, 21, 30, 123000, tzinfo=datetime.timezone(datetime.timedelta(hours=2)))
+        message = {"timestamp": ts, "data": {"time": ts.isoformat()}}
+        unpacked = data_unpack(data_pack(message, datetimes=True), datetimes=True)
+        assert unpacked["timestamp"] == ts
+        assert unpacked["timestamp"].tzinfo == datetime.timezone.utc
+        assert unpacked["data"]["time"] == ts.isoformat()
+
+    def test_old_messages(self):
+        message = {"timestamp": "2024-02-29T12:21:30.123000+00:00"}
+        assert data_unpack(data_pack(message), datetimes=True) == message
+
+    def test_naive_datetime(self):
+        with pytest.raises(ValueError):
+            data_pack({"timestamp": datetime.datetime(2024, 2, 29)}, datetimes=True)
+
+
+class TestEnvelope:
+    def test_envelope(self):
+        envelope = Envelope(data_pack_envelope(MESSAGES))
+        assert len(envelope) == len(MESSAGES)
+        assert list(envelope) == MESSAGES
+        assert list(data_unpack_many(data_pack_envelope([]))) == []
+
+    def test_batches(self):
+        frames = list(data_pack_batches(MESSAGES, max_count=30))
+        assert [len(Envelope(f)) for f in frames] == [30, 30, 30, 10]
+        frames = list(data_pack_batches(MESSAGES, max_bytes=500))
+        assert all(len(f) <= 500 for f in frames)
+        assert [m for f in frames for m in data_unpack_many(f)] == MESSAGES
+
+    def test_unbatched_message(self):
+        assert list(data_unpack_many(data_pack(MESSAGES[3]))) == [MESSAGES[3]]
+        assert list(data_unpack_many(b"[1]", unpack=json.loads)) == [[1]]
+        assert list(data_unpack_many(data_pack_envelope(MESSAGES[:2]), unpack=json.loads)) == MESSAGES[:2]
+
+
+class TestCompression:
+    @pytest.mark.parametrize("codec", ["zlib", "zstd"])
+    def test_roundtrip(self, codec):
+        if codec == "zstd":
+            pytest.importorskip("zstandard")
+        samples = [data_pack(m) for m in MESSAGES]
+        dictionary = train_dictionary(samples, 1024, codec)
+        for message in MESSAGES:
+            packed = data_pack_compressed(message, codec, dictionary=dictionary)
+            assert data_unpack_compressed(packed, [dictionary]) == message
+        with pytest.raises(ValueError):
+            data_unpack_compressed(compress(samples[0], codec, dictionary=dictionary))
+
+    def test_zlib_dictionary_skips_large_samples(self):
+        samples = [data_pack(m) for m in MESSAGES]
+        dictionary = train_dictionary([b"x" * 40000] + samples, 1024, "zlib")
+        assert 0 < len(dictionary.data) <= 1024
+        assert b"x" * 100 not in dictionary.data
+        with pytest.raises(ValueError):
+            train_dictionary([b"x" * 2000], 1024, "zlib")
+
+    def test_uncompressed(self):
+        assert data_unpack_compressed(data_pack(MESSAGES[1])) == MESSAGES[1]
+
+
+class TestPaths:
+    def test_paths(self):
+        message = {"body": b"x" * 10000, "device": {"device_id": "dev1", "tags": ["a", "b"]}, "request": {"path": "/"}}
+        paths = [("device", "device_id"), ("request", "path"), ("device", "tags", 1), ("missing",), ("device",)]
+        assert data_unpack_paths(data_pack(message), paths) == ["dev1", "/", "b", None, message["device"]]
+        assert data_unpack_paths(data_pack(message), [("body", "x")], default="-") == ["-"]
+        assert data_unpack_paths(data_pack(message), [()]) == [message]
+
+
+class TestPackInto:
+    def test_pack_into(self):
+        buffer = bytearray(b"header")
+        assert data_pack_into(buffer, MESSAGES) == len(MESSAGES)
+        assert list(data_unpack_stream(memoryview(buffer)[6:])) == MESSAGES
+        size = len(buffer)
+        with pytest.raises(TypeError):
+            data_pack_into(buffer, [{"ok": 1}, {"not packable": object()}])
+        assert len(buffer) == size
+        assert data_pack_into(buffer, [{"ok": 1}]) == 1
+
+    def test_unpack_memoryview(self):
+        packed = b"xx" + data_pack(MESSAGES[7])
+        assert data_unpack(memoryview(packed)[2:]) == MESSAGES[7]
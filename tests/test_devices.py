@@ -0,0 +1,112 @@
+import pytest
+
+from fvhiot.models.device import PatchDevice, StumpDevice
+from fvhiot.utils import devices as devices_module
+from fvhiot.utils.devices import DeviceCache
+
+
+def device_dict(device_id: str, name: str = "Sensor") -> dict:
+    return {
+        "device_id": device_id,
+        "device_metadata": {
+            "device_type": "sensor",
+            "parser_module": "fvhiot.parsers.elsys",
+            "name": name,
+            "description": "Test device",
+            "state": "active",
+        },
+        "device_state": {"state": "ok", "location": "Helsinki"},
+    }
+
+
+@pytest.fixture
+def clock(fake_time):
+    return fake_time(devices_module)
+
+
+class Loader:
+    def __init__(self, known: list):
+        self.known = known
+        self.calls = []
+
+    def __call__(self, device_id: str):
+        self.calls.append(device_id)
+        return device_dict(device_id) if device_id in self.known else None
+
+
+class TestDeviceCache:
+    def test_ttl(self, clock):
+        loader = Loader(["dev1"])
+        cache = DeviceCache(loader, ttl=300)
+        assert cache.get("dev1").device_metadata.parser_module == "fvhiot.parsers.elsys"
+        clock.now += 299
+        cache.get("dev1")
+        assert loader.calls == ["dev1"]
+        clock.now += 2
+        cache.get("dev1")
+        assert loader.calls == ["dev1", "dev1"]
+        assert (cache.hits, cache.misses) == (1, 2)
+
+    def test_negative_caching(self, clock):
+        loader = Loader([])
+        cache = DeviceCache(loader, negative_ttl=60)
+        assert cache.get("unknown") is None
+        assert cache.get("unknown") is None
+        assert loader.calls == ["unknown"]
+        clock.now += 61
+        assert cache.get("unknown") is None
+        assert loader.calls == ["unknown", "unknown"]
+        cache = DeviceCache(loader, negative_ttl=0)
+        cache.get("unknown")
+        assert "unknown" not in cache
+
+    def test_lru_eviction(self, clock):
+        cache = DeviceCache(Loader(["dev1", "dev2", "dev3"]), maxsize=2)
+        cache.get("dev1")
+        cache.get("dev2")
+        cache.get("dev1")  # dev2 is now the least recently used
+        cache.get("dev3")
+        assert "dev1" in cache and "dev3" in cache and "dev2" not in cache
+
+    def test_patch(self, clock):
+        cache = DeviceCache(Loader(["dev1"]))
+        cache.get("dev1")
+        patch = PatchDevice.model_validate(
+            {"device_id": "dev1", "device_metadata": {"name": "Renamed"}, "device_state": {"state": "broken"}}
+        )
+        cache.apply(patch)
+        device = cache.get("dev1")
+        assert device.device_metadata.name == "Renamed"
+        assert device.device_metadata.parser_module == "fvhiot.parsers.elsys"  # not set in patch, kept
+        assert device.device_state.state == "broken"
+        assert device.device_state.location == "Helsinki"
+        cache.apply({"device_id": "dev2", "device_metadata": {"name": "Not cached"}, "device_state": {}})
+        assert "dev2" not in cache
+
+    def test_stump(self, clock):
+        cache = DeviceCache(Loader(["dev1", "dev2"]))
+        cache.get("dev1")
+        cache.get("dev2")
+        cache.apply(StumpDevice(device_id="dev1"))
+        cache.apply({"device_id": "dev2"})
+        assert len(cache) == 0
+
+    def test_snapshot(self, clock, tmp_path):
+        path = tmp_path / "devices.json"
+        cache = DeviceCache(Loader(["dev1", "dev2", "dev3"]), snapshot_path=str(path))
+        for device_id in ["dev1", "dev2", "dev3", "unknown"]:
+            cache.get(device_id)
+        assert cache.save_snapshot() == 3
+        warm = DeviceCache(Loader([]), maxsize=2)
+        assert warm.load_snapshot(str(path)) == 2
+        assert warm.get("dev3").device_id == "dev3"
+        assert "dev1" not in warm
+        assert DeviceCache().load_snapshot(str(tmp_path / "missing.json")) == 0
+
+    def test_snapshot_without_path(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        with pytest.raises(ValueError):
+            DeviceCache().save_snapshot()
+        with pytest.raises(ValueError):
+            DeviceCache().load_snapshot()
+        assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,82 @@
+import asyncio
+import datetime
+
+import pytest
+
+pytest.importorskip("msgpack")
+pytest.importorskip("kafka")
+pytest.importorskip("aiokafka")
+
+from fvhiot.utils import aiokafka as fvh_aiokafka  # noqa: E402
+from fvhiot.utils import kafka as fvh_kafka  # noqa: E402
+from fvhiot.utils.data import data_pack  # noqa: E402
+from fvhiot.utils.fakekafka import reset_broker  # noqa: E402
+
+MESSAGES = [{"device": {"device_id": f"dev{i % 5}"}, "data": {"temp": i}} for i in range(50)]
+
+
+@pytest.fixture
+def broker(monkeypatch):
+    monkeypatch.setenv("KAFKA_BACKEND", "memory")
+    return reset_broker(partitions=3)
+
+
+class TestSync:
+    def test_consume_batches(self, broker):
+        producer = fvh_kafka.get_kafka_producer_by_envs()
+        consumer = fvh_kafka.get_kafka_consumer("raw", group_id="parser")
+        consumer.poll(timeout_ms=0)  # Join the group before producing (auto_offset_reset is "latest")
+        for message in MESSAGES:
+            fvh_kafka.send_for_device(producer, "raw", message["device"]["device_id"], message)
+        consumed = []
+        for _tp, messages in fvh_kafka.consume_batches(consumer, max_records=7, timeout_ms=10):
+            consumed.extend(messages)
+            if len(consumed) == len(MESSAGES):
+                break
+        assert sorted(consumed, key=lambda m: m["data"]["temp"]) == MESSAGES
+        # The last batch is committed when the next one is requested
+        committed = [broker.committed_offset("parser", "raw", p) or 0 for p in range(3)]
+        assert sum(committed) == len(MESSAGES) - len(messages)
+
+    def test_group_rebalance(self, broker):
+        consumers = [fvh_kafka.get_kafka_consumer("raw", group_id="parser") for _ in range(2)]
+        for consumer in consumers:
+            consumer.poll(timeout_ms=0)
+        consumers[0].poll(timeout_ms=0)
+        assert [len(c.assignment()) for c in consumers] == [2, 1]
+        consumers[1].close()
+        consumers[0].poll(timeout_ms=0)
+        assert len(consumers[0].assignment()) == 3
+
+    def test_seek_partitions(self, broker):
+        producer = fvh_kafka.get_kafka_producer()
+        for i, message in enumerate(MESSAGES):
+            producer.send("raw", value=data_pack(message), partition=i % 3, timestamp_ms=1000 * i)
+        consumer = fvh_kafka.get_kafka_consumer("raw", offset=-2)
+        assert sum(len(r) for r in consumer.poll(timeout_ms=0).values()) == 6
+        since = datetime.datetime.fromtimestamp(45, tz=datetime.timezone.utc)
+        targets = fvh_kafka.seek_partitions(consumer, "raw", since=since)
+        assert sorted(targets.values()) == [15, 15, 15]
+
+
+class TestAsync:
+    def test_batch_producer_and_seek(self, broker):
+        async def run():
+            producer = await fvh_aiokafka.get_aiokafka_producer_by_envs()
+            consumer = await fvh_aiokafka.get_aiokafka_consumer(["raw"], group_id="parser")
+            sent = await fvh_aiokafka.BatchProducer(producer).send_many(
+                "raw", MESSAGES, key=lambda m: m["device"]["device_id"]
+            )
+            assert sent == len(MESSAGES)
+            consumed = []
+            async for batch in fvh_aiokafka.iter_batches(consumer, timeout_ms=10):
+                consumed.extend(batch)
+                await batch.commit()
+                if len(consumed) == len(MESSAGES):
+                    break
+            assert sorted(consumed, key=lambda m: m["data"]["temp"]) == MESSAGES
+            targets = await fvh_aiokafka.seek_partitions(consumer, "raw", last=1)
+            records = await consumer.getmany(timeout_ms=0)
+            assert sum(len(r) for r in records.values()) == len(targets)
+
+        asyncio.run(run())
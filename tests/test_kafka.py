@@ -0,0 +1,172 @@
+import time
+
+import pytest
+
+pytest.importorskip("msgpack")
+pytest.importorskip("kafka")
+
+from fvhiot.utils import kafka as kafka_module  # noqa: E402
+from fvhiot.utils.data import data_pack, data_unpack  # noqa: E402
+from fvhiot.utils.fakekafka import FakeKafkaConsumer, FakeKafkaProducer  # noqa: E402
+from fvhiot.utils.kafka import (  # noqa: E402
+    DeadLetterQueue,
+    FvhKafkaProducer,
+    PartitionWorkerRunner,
+    _reset_clients_after_fork,
+    consume_batches,
+    replay_dead_letters,
+    seek_partitions,
+    send_envelopes,
+)
+
+
+class SlowCommitConsumer(FakeKafkaConsumer):
+    def commit(self, offsets=None):
+        time.sleep(0.02)
+        super().commit(offsets)
+
+
+class TestSeekPartitions:
+    def test_offsets_are_clamped(self, broker):
+        producer = FakeKafkaProducer(broker=broker)
+        for i in range(10):
+            producer.send("raw", value=data_pack({"i": i}))
+        consumer = FakeKafkaConsumer(broker=broker)
+        assert list(seek_partitions(consumer, "raw", offsets={0: -3}).values()) == [7]
+        assert list(seek_partitions(consumer, "raw", offsets={0: -100}).values()) == [0]
+        assert list(seek_partitions(consumer, "raw", offsets={0: 100}).values()) == [10]
+        assert list(seek_partitions(consumer, "raw", last=100).values()) == [0]
+
+
+class TestEnvelopes:
+    def test_consume_batches(self, broker):
+        producer = FakeKafkaProducer(broker=broker)
+        futures = send_envelopes(producer, "raw", [{"i": i} for i in range(5)], max_count=2)
+        assert len(futures) == 3
+        producer.send("raw", value=data_pack({"i": 5}))
+        consumer = FakeKafkaConsumer("raw", group_id="sink", auto_offset_reset="earliest", broker=broker)
+        tp, messages = next(consume_batches(consumer, timeout_ms=10))
+        assert messages == [{"i": i} for i in range(6)]
+
+    def test_partition_worker_runner(self, broker):
+        producer = FakeKafkaProducer(broker=broker)
+        send_envelopes(producer, "raw", [{"i": i} for i in range(10)], max_count=4)
+        consumer = FakeKafkaConsumer("raw", group_id="sink", auto_offset_reset="earliest", broker=broker)
+        processed = []
+
+        def handler(message):
+            processed.append(message["i"])
+            if len(processed) == 10:
+                runner.stop()
+
+        runner = PartitionWorkerRunner(consumer, handler, poll_timeout_ms=10, commit_interval=0)
+        runner.run()
+        assert processed == list(range(10))
+        assert broker.committed_offset("sink", "raw", 0) == 3
+
+
+class TestPartitionWorkerRunner:
+    def test_commit_while_processing(self, broker):
+        producer = FakeKafkaProducer(broker=broker)
+        for i in range(20):
+            producer.send("raw", value=data_pack({"i": i}))
+        consumer = SlowCommitConsumer("raw", group_id="sink", auto_offset_reset="earliest", broker=broker)
+        processed = []
+
+        def handler(message):
+            time.sleep(0.005)
+            processed.append(message["i"])
+            if len(processed) == 20:
+                runner.stop()
+
+        runner = PartitionWorkerRunner(consumer, handler, max_records=5, poll_timeout_ms=10, commit_interval=0)
+        runner.run()
+        assert processed == list(range(20))
+        assert broker.committed_offset("sink", "raw", 0) == 20
+
+
+class FakeApp:
+    def __init__(self, **config):
+        self.config = dict(config)
+        self.extensions = {}
+
+
+class TestFvhKafkaProducer:
+    @pytest.fixture(autouse=True)
+    def memory_backend(self, monkeypatch):
+        monkeypatch.setenv("KAFKA_BACKEND", "memory")
+        monkeypatch.delenv("KAFKA_PRODUCER_PROFILE", raising=False)
+
+    def test_created_lazily_per_process(self, monkeypatch):
+        ext = FvhKafkaProducer(FakeApp())
+        assert ext._client is None
+        producer = ext.producer
+        assert ext.producer is producer
+        monkeypatch.setattr(kafka_module.os, "getpid", lambda: -1)
+        child_producer = ext.producer
+        assert child_producer is not producer
+        assert ext.producer is child_producer
+
+    def test_reset_after_fork(self):
+        ext = FvhKafkaProducer(FakeApp())
+        producer = ext.producer
+        _reset_clients_after_fork()
+        assert ext._client is None
+        assert ext.producer is not producer
+
+    def test_close(self):
+        ext = FvhKafkaProducer(FakeApp())
+        ext.close()  # Nothing created yet
+        producer = ext.producer
+        ext.close()
+        assert ext._client is None
+        assert ext.producer is not producer
+
+    def test_batching_settings(self, monkeypatch):
+        created = []
+        monkeypatch.setattr(kafka_module, "get_kafka_producer", lambda **kwargs: created.append(kwargs))
+        FvhKafkaProducer(FakeApp()).get_producer()
+        assert created[0]["linger_ms"] == 20
+        assert created[0]["bootstrap_servers"] == ["localhost:9092"]
+        FvhKafkaProducer(FakeApp(PRODUCER_PROFILE="bulk")).get_producer()
+        assert created[1]["compression_type"] == "gzip"
+
+
+class TestDeadLetters:
+    def test_flush_keeps_letters_on_failure(self, failing_producer, failed_records, consume_all):
+        dlq = DeadLetterQueue(failing_producer, "dlq")
+        for record, parser_module in failed_records:
+            dlq.add(record, ValueError("bad payload"), parser_module)
+        with pytest.raises(RuntimeError):
+            dlq.flush()
+        assert len(dlq) == 3
+        assert dlq.count == 0
+        failing_producer.fail = False
+        assert dlq.flush() == 3
+        assert len(dlq) == 0
+        assert [data_unpack(r.value)["offset"] for r in consume_all("dlq")] == [0, 1, 2]
+
+    def test_replay(self, broker, failing_producer, failed_records, consume_all):
+        dlq = DeadLetterQueue(FakeKafkaProducer(broker=broker), "dlq")
+        for record, parser_module in failed_records:
+            dlq.add(record, ValueError("bad payload"), parser_module)
+        dlq.flush()
+        producer = FakeKafkaProducer(broker=broker)
+
+        def replay(producer, *args, **kwargs):
+            consumer = FakeKafkaConsumer("dlq", group_id="replay", auto_offset_reset="earliest", broker=broker)
+            try:
+                return replay_dead_letters(consumer, producer, *args, timeout_ms=10, **kwargs)
+            finally:
+                consumer.close()
+
+        # Filtered replay never commits, other parser modules' letters stay in the topic
+        assert replay(producer, "elsys", topic="fixed") == 2
+        assert broker.committed_offset("replay", "dlq", 0) is None
+        assert [data_unpack(r.value) for r in consume_all("fixed")] == [{"i": 0}, {"i": 2}]
+        with pytest.raises(RuntimeError):
+            replay(failing_producer)
+        assert broker.committed_offset("replay", "dlq", 0) is None
+        assert replay(producer) == 3
+        assert broker.committed_offset("replay", "dlq", 0) == 3
+        assert [data_unpack(r.value) for r in consume_all("raw")] == [{"i": 0}, {"i": 1}, {"i": 2}]
@@ -0,0 +1,97 @@
+import pytest
+
+import collections
+
+from fvhiot.utils.kafkatools import (
+    ContiguousOffsets,
+    LagMonitor,
+    dead_letter,
+    get_producer_settings,
+    partition_for_device,
+)
+
+TP = collections.namedtuple("TP", "topic partition")
+Record = collections.namedtuple("Record", "serialized_key_size serialized_value_size")
+ConsumerRecord = collections.namedtuple("ConsumerRecord", "topic partition offset timestamp key value")
+
+
+class TestContiguousOffsets:
+    def test_out_of_order(self):
+        offsets = ContiguousOffsets()
+        for o in [10, 11, 12, 15, 16]:  # offsets may have gaps, e.g. in compacted topics
+            offsets.add(o)
+        assert offsets.complete(11) is None
+        assert offsets.complete(10) == 12
+        assert offsets.complete(15) == 12
+        assert offsets.complete(12) == 16
+        assert len(offsets) == 1
+        assert offsets.complete(16) == 17
+        assert len(offsets) == 0
+
+    def test_compact_intervals(self):
+        offsets = ContiguousOffsets()
+        for o in range(100000):
+            offsets.add(o)
+        for o in range(1, 100000):
+            offsets.complete(o)
+        assert len(offsets._ends) == 1  # completed offsets are merged into one interval
+        assert offsets.complete(0) == 100000
+        with pytest.raises(ValueError):
+            offsets.add(5)
+
+
+class TestPartitionForDevice:
+    def test_stable_and_consistent(self):
+        devices = [f"70B3D57050{i:06X}" for i in range(2000)]
+        before = [partition_for_device(d, 12) for d in devices]
+        assert before == [partition_for_device(d, 12) for d in devices]
+        assert set(before) == set(range(12))
+        after = [partition_for_device(d, 13) for d in devices]
+        moved = [(a, b) for a, b in zip(before, after) if a != b]
+        assert all(b == 12 for a, b in moved)
+        assert len(moved) < len(devices) / 6
+
+
+class TestProducerSettings:
+    def test_profiles_and_overrides(self, monkeypatch):
+        monkeypatch.delenv("KAFKA_PRODUCER_PROFILE", raising=False)
+        assert get_producer_settings() == {}
+        monkeypatch.setenv("KAFKA_PRODUCER_PROFILE", "bulk")
+        monkeypatch.setenv("KAFKA_PRODUCER_LINGER_MS", "50")
+        monkeypatch.setenv("KAFKA_PRODUCER_COMPRESSION_TYPE", "none")
+        settings = get_producer_settings(flavor="aiokafka")
+        assert settings["linger_ms"] == 50
+        assert settings["compression_type"] is None
+        assert settings["max_batch_size"] == 1048576 and "batch_size" not in settings
+        assert get_producer_settings("low_latency")["linger_ms"] == 50
+        with pytest.raises(ValueError):
+            get_producer_settings("fast")
+
+
+class TestLagMonitor:
+    def test_snapshot_and_prometheus(self):
+        monitor = LagMonitor(labels={"group": "parser"})
+        monitor.observe({TP("raw", 0): [Record(-1, 100)] * 3, TP("raw", 1): [Record(8, 50)]})
+        monitor.update({TP("raw", 0): 90, TP("raw", 1): 10}, {TP("raw", 0): 100})
+        snapshot = monitor.snapshot()
+        assert snapshot["lag"] == 10
+        assert snapshot["partitions"]["raw/1"]["lag"] is None
+        assert (snapshot["messages"], snapshot["bytes"]) == (4, 358)
+        assert snapshot["messages_per_second"] > 0
+        text = monitor.prometheus()
+        assert 'fvhiot_kafka_consumer_lag{group="parser",topic="raw",partition="0"} 10\n' in text
+        assert 'fvhiot_kafka_consumer_messages_total{group="parser"} 4\n' in text
+
+
+class TestDeadLetter:
+    def test_dead_letter(self):
+        pytest.importorskip("msgpack")
+        from fvhiot.utils.data import data_pack, data_unpack
+
+        record = ConsumerRecord("raw", 3, 1234, 1700000000000, b"70B3D57050000001", b"\x81\xa1a\x01")
+        letter = data_unpack(data_pack(dead_letter(record, ValueError("bad payload"), "elsys")))
+        assert (letter["topic"], letter["partition"], letter["offset"]) == ("raw", 3, 1234)
+        assert (letter["key"], letter["value"]) == (record.key, record.value)
+        assert letter["parser_module"] == "elsys"
+        assert (letter["error"], letter["error_message"]) == ("builtins.ValueError", "bad payload")
+        assert letter["failed_at"].endswith("+00:00")
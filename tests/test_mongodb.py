@@ -0,0 +1,45 @@
+import datetime
+
+import pytest
+from pydantic import ValidationError
+
+from fvhiot.models.mongodb import create_mongo_documents, parse_datetime
+
+META = {"device_id": "70B3D57050000001", "name": "test"}
+
+
+class TestParseDatetime:
+    @pytest.mark.parametrize(
+        "value",
+        ["2022-03-02T12:21:30.123000+00:00", "2022-03-02T12:21:30.123000Z", "2022-03-02T12:21:30.123000+0000"],
+    )
+    def test_formats(self, value):
+        expected = datetime.datetime(2022, 3, 2, 12, 21, 30, 123000, tzinfo=datetime.timezone.utc)
+        assert parse_datetime(value) == expected
+
+    def test_offset_without_colon(self):
+        assert parse_datetime("2022-03-02T14:21:30+0200").utcoffset() == datetime.timedelta(hours=2)
+
+
+class TestCreateMongoDocuments:
+    def test_documents(self):
+        datalines = [{"time": "2022-03-02T12:21:30Z", "data": {"temp": 1.5}}]
+        documents = create_mongo_documents(datalines, META)
+        assert documents[0]["time"] == datetime.datetime(2022, 3, 2, 12, 21, 30, tzinfo=datetime.timezone.utc)
+        assert documents[0]["meta"] is META
+        assert documents[0]["data"] == {"temp": 1.5}
+
+    def test_naive_time(self):
+        with pytest.raises(ValidationError):
+            create_mongo_documents([{"time": "2022-03-02T12:21:30", "data": {}}], META)
+
+    def test_missing_device_id(self):
+        with pytest.raises(ValidationError):
+            create_mongo_documents([{"time": "2022-03-02T12:21:30Z", "data": {}}], {"name": "test"})
+        assert create_mongo_documents([{"time": "2022-03-02T12:21:30Z"}], {}, validate=False)[0]["meta"] == {}
+
+    @pytest.mark.parametrize("validate", [True, False])
+    def test_unparsable_time(self, validate):
+        with pytest.raises(ValidationError) as exc_info:
+            create_mongo_documents([{"time": "garbage", "data": {}}], META, validate=validate)
+        assert exc_info.value.errors()[0]["loc"] == (0, "time")
@@ -0,0 +1,49 @@
+from fvhiot.utils.ocpp import ConnectorStateCache
+
+
+def status_notification(status: str, error_code: str = "NoError", connector_id: int = 1) -> dict:
+    return {
+        "messageType": "StatusNotification",
+        "chargeBoxId": "CB1",
+        "payload": {"connectorId": connector_id, "status": status, "errorCode": error_code},
+    }
+
+
+class TestConnectorStateCache:
+    def test_only_transitions_are_emitted(self):
+        cache = ConnectorStateCache()
+        assert cache.should_emit(status_notification("Available"), now=0)
+        assert not cache.should_emit(status_notification("Available"), now=1)
+        assert cache.should_emit(status_notification("Charging"), now=2)
+        assert cache.should_emit(status_notification("Charging", "GroundFailure"), now=3)
+        assert cache.should_emit(status_notification("Charging", connector_id=2), now=4)
+        assert cache.emitted == 4 and cache.suppressed == 1
+
+    def test_other_messages_pass_through(self):
+        cache = ConnectorStateCache()
+        assert cache.should_emit({"messageType": "MeterValues", "chargeBoxId": "CB1", "payload": {}})
+        assert cache.should_emit({"messageType": "MeterValues", "chargeBoxId": "CB1", "payload": {}})
+
+    def test_keepalive(self):
+        cache = ConnectorStateCache(keepalive=60)
+        assert cache.should_emit(status_notification("Available"), now=0)
+        assert not cache.should_emit(status_notification("Available"), now=59)
+        assert cache.should_emit(status_notification("Available"), now=60)
+        assert not cache.should_emit(status_notification("Available"), now=100)
+
+    def test_max_connectors(self):
+        cache = ConnectorStateCache(max_connectors=2)
+        for connector_id in [1, 2, 1, 3]:
+            cache.update("CB1", connector_id, "Available", "NoError", now=0)
+        assert len(cache) == 2
+        assert ("CB1", 2) not in cache
+        assert cache.evicted == 1
+
+    def test_snapshot_restore(self):
+        cache = ConnectorStateCache()
+        cache.update("CB1", 1, "Available", "NoError", now=10)
+        cache.update("CB2", 1, "Faulted", "GroundFailure", now=20)
+        restored = ConnectorStateCache.from_snapshot(cache.snapshot(), max_connectors=1)
+        assert len(restored) == 1
+        assert restored.get("CB2", 1) == ("Faulted", "GroundFailure", 20.0)
+        assert not restored.update("CB2", 1, "Faulted", "GroundFailure", now=30)
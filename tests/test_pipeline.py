@@ -0,0 +1,114 @@
+import pytest
+
+pytest.importorskip("msgpack")
+pytest.importorskip("kafka")
+
+from kafka import TopicPartition  # noqa: E402
+
+from fvhiot.utils.data import data_pack, data_unpack  # noqa: E402
+from fvhiot.utils.fakekafka import FakeKafkaConsumer, FakeKafkaProducer  # noqa: E402
+from fvhiot.utils.kafka import send_envelopes  # noqa: E402
+from fvhiot.utils.kafkatools import ContiguousOffsets  # noqa: E402
+from fvhiot.utils.pipeline import ParserPipeline, _InFlight  # noqa: E402
+
+
+def make_pipeline(broker, parse, messages=(), **kwargs):
+    producer = FakeKafkaProducer(broker=broker)
+    for message in messages:
+        producer.send("raw", value=data_pack(message))
+    consumer = FakeKafkaConsumer("raw", group_id="parser", auto_offset_reset="earliest", broker=broker)
+    kwargs.setdefault("poll_timeout_ms", 10)
+    kwargs.setdefault("commit_interval", 0)
+    return ParserPipeline(consumer, producer, "parsed", parse, **kwargs)
+
+
+class TestParserPipeline:
+    def test_parse_and_produce(self, broker, consume_all):
+        seen = []
+
+        def parse(message):
+            seen.append(message["i"])
+            if len(seen) == 10:
+                pipeline.stop()
+            if message["i"] % 2:
+                return None
+            return [{"i": message["i"], "n": n} for n in range(2)]
+
+        pipeline = make_pipeline(broker, parse, [{"i": i} for i in range(10)])
+        pipeline.run()
+        parsed = [data_unpack(r.value) for r in consume_all("parsed")]
+        assert sorted((m["i"], m["n"]) for m in parsed) == [(i, n) for i in range(0, 10, 2) for n in range(2)]
+        assert broker.committed_offset("parser", "raw", 0) == 10
+        stats = pipeline.stats()
+        assert stats["consumed"] == 10
+        assert stats["parsed"] == 10
+        assert stats["produced"] == 10
+        assert stats["in_flight"] == 0
+
+    def test_parse_error(self, broker, consume_all):
+        errors = []
+
+        def parse(message):
+            if message["i"] == 2:
+                pipeline.stop()
+                raise ValueError("broken")
+            return message
+
+        def on_error(value, err):
+            errors.append((data_unpack(value), str(err)))
+
+        pipeline = make_pipeline(broker, parse, [{"i": i} for i in range(3)], on_error=on_error)
+        pipeline.run()
+        assert errors == [({"i": 2}, "broken")]
+        assert [data_unpack(r.value) for r in consume_all("parsed")] == [{"i": 0}, {"i": 1}]
+        assert broker.committed_offset("parser", "raw", 0) == 3
+        assert pipeline.counters["parse_errors"] == 1
+
+    def test_envelopes(self, broker, consume_all):
+        seen = []
+
+        def parse(message):
+            seen.append(message["i"])
+            if message["i"] == 1:
+                raise ValueError("broken")
+            if len(seen) == 6:
+                pipeline.stop()
+            return message
+
+        pipeline = make_pipeline(broker, parse, on_error=lambda value, err: None)
+        send_envelopes(pipeline.producer, "raw", [{"i": i} for i in range(6)], max_count=3)
+        pipeline.run()
+        assert [data_unpack(r.value) for r in consume_all("parsed")] == [{"i": i} for i in range(6) if i != 1]
+        assert broker.committed_offset("parser", "raw", 0) == 2
+        assert pipeline.counters["parsed"] == 5
+        assert pipeline.counters["parse_errors"] == 1
+
+    def test_invalid_executor(self, broker):
+        with pytest.raises(ValueError):
+            make_pipeline(broker, lambda m: m, executor="fork")
+
+    def test_revoked_records_dont_complete_redelivered(self, broker):
+        pipeline = make_pipeline(broker, lambda m: m)
+        tp = TopicPartition("raw", 0)
+        offsets = pipeline._offsets.setdefault(tp, ContiguousOffsets())
+        old = []
+        for offset in (5, 6):
+            offsets.add(offset)
+            old.append(_InFlight(tp, offset, b"", offsets))
+        pipeline.on_partitions_revoked([tp])
+        assert tp not in pipeline._offsets
+        # Same offsets are redelivered after the partition is assigned again
+        offsets = pipeline._offsets.setdefault(tp, ContiguousOffsets())
+        new = []
+        for offset in (5, 6):
+            offsets.add(offset)
+            new.append(_InFlight(tp, offset, b"", offsets))
+        for item in old:
+            pipeline._complete(item)
+        assert offsets.committable is None
+        assert len(offsets) == 2
+        for item in new:
+            pipeline._complete(item)
+        assert offsets.committable == 7
+        pipeline._commit()
+        assert broker.committed_offset("parser", "raw", 0) == 7
@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("starlette")
+
+from pydantic import BaseModel, ValidationError  # noqa: E402
+from starlette.requests import Request  # noqa: E402
+
+from fvhiot.models.requests import RequestModel  # noqa: E402
+from fvhiot.utils.http import starlettetools, validate_data_from_request  # noqa: E402
+from fvhiot.utils.http.starlettetools import extract_data_from_starlette_request  # noqa: E402
+
+BODY = b'{"DevEUI_uplink": {"DevEUI": "70B3D57050000001"}}'
+
+
+def make_request(body: bytes = BODY) -> Request:
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "scheme": "https",
+        "server": ("example.com", 443),
+        "path": "/api/v1/data",
+        "query_string": b"token=abc",
+        "headers": [(b"host", b"example.com"), (b"content-type", b"application/json")],
+        "client": ("192.0.2.1", 12345),
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        return messages.pop(0)
+
+    return Request(scope, receive)
+
+
+def extract(mode: str, body: bytes = BODY):
+    return asyncio.run(extract_data_from_starlette_request(make_request(body), mode=mode))
+
+
+class NotAMatch(BaseModel):
+    missing: int
+
+
+class TestExtract:
+    @pytest.mark.parametrize("mode", ["dict", "original", "light"])
+    def test_dict_modes(self, mode):
+        data = extract(mode)
+        assert isinstance(data, dict)
+        assert data["scheme"] == "https"
+        assert data["path"] == "/api/v1/data"
+        assert data["remote_addr"] == "192.0.2.1"
+        assert data["request"]["get"] == {"token": "abc"}
+        assert data["request"]["body"] == BODY
+        assert validate_data_from_request(data)
+
+    def test_model_mode(self):
+        data = extract("model")
+        assert isinstance(data, RequestModel)
+        assert data.request.body == BODY
+
+    def test_invalid_mode(self):
+        with pytest.raises(ValueError):
+            extract("fast")
+
+    def test_validation_error(self, monkeypatch):
+        monkeypatch.setattr(starlettetools, "RequestModel", NotAMatch)
+        assert extract("dict")["request"]["body"] == BODY
+        with pytest.raises(ValidationError):
+            extract("model")
+
+
+class TestValidateDataFromRequest:
+    def test_scheme_is_mandatory(self):
+        data = extract("original")
+        assert validate_data_from_request(data)
+        data["shceme"] = data.pop("scheme")
+        assert not validate_data_from_request(data)